@@ -22,7 +22,7 @@
 #   You should have received a copy of the GNU General Public License along
 #   with this program; if not, write to the Free Software Foundation, Inc.,
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
-import datetime, re, time
+import datetime, json, os, re, time
 import serial
 import math
 import copy
@@ -35,6 +35,36 @@ MOVEABLE_WIDTH = (431 * STEPS_PER_MM)
 MOVEABLE_HEIGHT= (390 * STEPS_PER_MM)
 
 SHORT_TIMEOUT=0.5
+CMD_SLEEP=0.01 # seconds to wait after a command with no response
+BAUD_RATE=9600
+
+# Rapid speed in steps/second. You can run as high as 4000steps/second but you miss steps,
+# a SpeedLearner finds out how fast a particular machine can go
+MAX_SPEED = 1500
+FASTEST_SPEED = 4000
+SPEED_STEP = 250
+RAPID_AT = 20
+FASTEST_AT = 21 # what the QuickCircuit software uses for its quickest moves
+ADAPT_MOVES = 20 # rapids without missing steps before a SpeedLearner tries going faster
+HOMING_TOLERANCE = 5 # steps the corner can seem to move between homings without any being missed
+
+# Homing (find_corner) speeds in steps/second, and how far it backs off and approaches slowly in steps
+HOMING_FAST = 2000
+HOMING_SLOW = 250
+HOMING_APPROACH = 1000
+
+# Steps away from the corner to go straight to, before moving onto the limits (see move_to_corner)
+CORNER_MARGIN = 1000
+
+# Sent by the QuickCircuit software before drilling, what they do is a mystery (see COMMANDS)
+DRILL_SETUP = [ "PS4192", "PR2" ]
+
+# A model of acceleration, for timing moves and choosing AT for them (see plan_acceleration.)
+# These are estimates to be tuned against the real machine, not measurements
+AT_RAMP_STEPS = 25 # steps the head speeds up (and slows down) over for each AT away from AT1 (none)
+START_SPEED = 400 # steps/second the steppers can start & stop at without a ramp
+MAX_ACCEL = 2400 # steps/second^2 they can speed up at, ie AT20 for rapids at MAX_SPEED
+PLAN_WINDOW = 1000 # moves planned together
 
 # Function to calculate the "central angle" property of an
 # arc, which is passed to the controller.
@@ -69,6 +99,154 @@ class AMCError(EnvironmentError):
     def __init__(self, error):
         EnvironmentError.__init__(self, (-1, error))
 
+# Upper bounds (seconds) of the buckets in Metrics latency histograms
+METRIC_BUCKETS = [ 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float("inf") ]
+
+class Metrics:
+    """
+    Counters and latency histograms for a controller session, to find out
+    where the time goes during a real job. Set a controller's metrics
+    attribute to one of these to collect them.
+
+    Each counter or histogram has a name and an optional type label (the
+    command, operation, reason for sleeping, etc.) The labels passed in
+    are added to everything exported, ie which machine it is.
+    """
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.counters = collections.defaultdict(float) # (name, type) -> total
+        self.histograms = {} # (name, type) -> [ bucket counts, sum, count ]
+
+    def count(self, name, type=None, amount=1):
+        self.counters[(name, type)] += amount
+
+    def observe(self, name, type, seconds):
+        histogram = self.histograms.get((name, type))
+        if histogram is None:
+            histogram = self.histograms[(name, type)] = [ [ 0 ] * len(METRIC_BUCKETS), 0.0, 0 ]
+        for n, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                histogram[0][n] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def snapshot(self):
+        """ Return everything as a dict, for JSON """
+        result = { "time" : time.time(), "labels" : self.labels, "counters" : {}, "histograms" : {} }
+        for (name, type), value in self.counters.items():
+            result["counters"].setdefault(name, {})[type or ""] = value
+        for (name, type), (buckets, total, count) in self.histograms.items():
+            result["histograms"].setdefault(name, {})[type or ""] = {
+                "buckets" : [ [ bound, n ] for bound, n in zip(METRIC_BUCKETS[:-1], buckets) ],
+                "sum" : total, "count" : count }
+        return result
+
+    def prometheus(self):
+        """ Return everything in the Prometheus text exposition format """
+        def labels(type, **extra):
+            pairs = sorted(self.labels.items()) + ([ ("type", type) ] if type else []) + extra.items()
+            return "{%s}" % ",".join('%s="%s"' % pair for pair in pairs) if pairs else ""
+        lines = []
+        for name in sorted(set(name for name, type in self.counters)):
+            lines.append("# TYPE amc2500_%s_total counter" % name)
+            for (n, type), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append("amc2500_%s_total%s %r" % (name, labels(type), value))
+        for name in sorted(set(name for name, type in self.histograms)):
+            lines.append("# TYPE amc2500_%s histogram" % name)
+            for (n, type), (buckets, total, count) in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(METRIC_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append("amc2500_%s_bucket%s %d" % (name, labels(type, le="+Inf" if bound == float("inf") else repr(bound)), cumulative))
+                lines.append("amc2500_%s_sum%s %r" % (name, labels(type), total))
+                lines.append("amc2500_%s_count%s %d" % (name, labels(type), count))
+        return "\n".join(lines) + "\n"
+
+
+class SpeedLearner:
+    """
+    Learns the fastest rapid speed & acceleration (AT) a machine can use
+    without missing steps, and keeps it in a JSON file of machines.
+
+    Each setting is a (steps/second, AT) pair, from MAX_SPEED up to
+    FASTEST_SPEED and then the quickest AT. When steps are missed it
+    goes back down one and stays there.
+
+    An open loop controller reports the steps it was told to move, so
+    missed steps only really show up when homing (see find_corner) finds
+    the corner somewhere else. A setting has to get through homing
+    before the next one up is tried, after ADAPT_MOVES rapids, so
+    without homing the speed never goes up.
+    """
+    def __init__(self, path=None, machine="default"):
+        self.path = path
+        self.machine = machine
+        self.settings = [ (speed, RAPID_AT) for speed in range(MAX_SPEED, FASTEST_SPEED + 1, SPEED_STEP) ]
+        self.settings.append((FASTEST_SPEED, FASTEST_AT))
+        self.level = 0
+        self.settled = False
+        self.verified = False # has homing found no missed steps at this setting
+        self.moves = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                learnt = json.load(f).get(machine)
+            if learnt is not None and tuple(learnt["setting"]) in self.settings:
+                self.level = self.settings.index(tuple(learnt["setting"]))
+                self.settled = learnt["settled"]
+                self.verified = learnt.get("verified", False)
+
+    def setting(self):
+        return self.settings[self.level]
+
+    def moved(self, missed):
+        """ Record a rapid at the current setting, and whether steps were
+        missed. Returns True if the setting has changed """
+        if missed:
+            return self._slow_down()
+        self.moves += 1
+        if self.settled or not self.verified or self.moves < ADAPT_MOVES or self.level == len(self.settings) - 1:
+            return False
+        self.level += 1
+        self.verified = False
+        self.moves = 0
+        self.save()
+        return True
+
+    def homed(self, error):
+        """ Record the error (dx,dy steps) homing found in where the corner
+        is. Returns True if the setting has changed """
+        if max(abs(error[0]), abs(error[1])) > HOMING_TOLERANCE:
+            return self._slow_down()
+        self.verified = True
+        self.save()
+        return False
+
+    def _slow_down(self):
+        self.settled = True
+        self.moves = 0
+        changed = self.level > 0
+        if changed:
+            self.level -= 1
+        self.save()
+        return changed
+
+    def save(self):
+        if self.path is None:
+            return
+        machines = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                machines = json.load(f)
+        machines[self.machine] = { "setting" : self.setting(), "settled" : self.settled, "verified" : self.verified }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(machines, f, indent=2, sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
+
+
 class AMC2500:
     """
     Class to remote control an AMC2500 w/ a Quick Circuit 5000 attached.
@@ -92,7 +270,26 @@ class AMC2500:
         self.trace=trace
         self.debug=debug
         self.limits = (0,0)
+        self.corner = None # last known position of the X-,Y- corner, in steps
+        self.speeds = None # a SpeedLearner, to learn how fast rapids can go
+        self._limit_hit = False # whether the last move stopped at a limit
+        self._cur_at = None # the controller's AT, which isn't part of the saved state
+        self.plan_acceleration = False # whether programs set AT for each move (see plan_acceleration)
         self.jogging = False
+        self._jog_axes = [] # hardware axes jogging, which stop_jog has to stop
+        self.metrics = None # a Metrics, if they're being collected
+        self._operations = { "move" : self._move_by_steps,
+                             "move_to" : self._move_to_steps,
+                             "arc" : self._arc_by_steps,
+                             "head" : self.set_head_down,
+                             "spindle" : self.set_spindle_on,
+                             "spindle_speed" : self.set_spindle_speed,
+                             "speed" : lambda steps_per_second, at=None: self._set_step_speed(steps_per_second, at=at),
+                             "accel" : self._set_acceleration,
+                             "max_speed" : self.set_max_speed,
+                             "dwell" : self.dwell,
+                             "drill" : self.drill,
+                             "drill_setup" : self.setup_drilling }
 
         # set up initial state as an anonymous object, so we can save/restore it later on
         state = type("AMC2500_InternalState", (), {})()
@@ -102,6 +299,7 @@ class AMC2500:
         state.spindle_on = False
         state.spindle_speed = -1
         state.pos = (0,0) # pos always stored in steps
+        state.carry = (0.0,0.0) # fractional steps not yet moved, left over from rounding
 
         self._states = [ state ]
 
@@ -138,6 +336,7 @@ class AMC2500:
             self.move_to(*restore.pos)
         else: # not moving back, so just accept where we are
             restore.pos = self.state.pos
+            restore.carry = self.state.carry
         self.set_speed(restore.cur_step_speed)
         self.set_spindle_speed(restore.spindle_speed)
         if restore.spindle_on and not self.get_spindle_on():
@@ -171,7 +370,26 @@ class AMC2500:
     def _units_to_steps(self, units):
         if isinstance(units, tuple):
             return tuple([ self._units_to_steps(u) for u in list(units) ])
-        return int(float(units) * self.state.steps_per_unit)
+        return int(round(float(units) * self.state.steps_per_unit))
+
+    def _carry_steps(self, dx, dy):
+        """ Convert a relative move in units to whole steps, carrying the
+        fractional part over to the next move so it doesn't drift
+        """
+        carry = self.state.carry
+        exact = (float(dx) * self.state.steps_per_unit + carry[0],
+                 float(dy) * self.state.steps_per_unit + carry[1])
+        steps = (int(round(exact[0])), int(round(exact[1])))
+        self.state.carry = (exact[0] - steps[0], exact[1] - steps[1])
+        return steps
+
+    def _steps_to(self, x, y):
+        """ Convert an absolute position in units to the whole steps to get there
+        from the current position, keeping the fractional part as the carry
+        """
+        self.state.carry = (0.0,0.0)
+        return self._carry_steps(x - self._steps_to_units(self.state.pos[0]),
+                                 y - self._steps_to_units(self.state.pos[1]))
 
     def get_pos(self):
         """ Get the current (estimated) absolute position of the head
@@ -183,8 +401,12 @@ class AMC2500:
         self._steps_to_units(self.state.cur_step_speed)
 
     def set_max_speed(self):
-        """ You can run as high as 4000steps/second but you miss steps """
-        self.set_speed(self._steps_to_units(1500))
+        """ Set the speed for rapids, MAX_SPEED or whatever self.speeds has learnt """
+        (speed, at) = self.speeds.setting() if self.speeds is not None else (MAX_SPEED, RAPID_AT)
+        self._set_step_speed(speed, at=at)
+
+    def _at_max_speed(self):
+        return self.speeds is not None and self.state.cur_step_speed == self.speeds.setting()[0]
 
     def set_speed(self, speed, force_redundant_set=False):
         """ Set head speed (units/second for the currently set unit)
@@ -216,15 +438,29 @@ class AMC2500:
         """
         if speed == 0:
             raise AMCError("Cannot set speed to 0 units/second")
-        steps_per_second = max(self._units_to_steps(speed), 1)
+        return self._set_step_speed(max(self._units_to_steps(speed), 1), force_redundant_set)
+
+    def _set_step_speed(self, steps_per_second, force_redundant_set=False, at=None):
         if self.state.cur_step_speed == steps_per_second and not force_redundant_set:
+            if at is not None:
+                self._set_acceleration(at)
             return
         self.state.cur_step_speed = steps_per_second
         self._write("VS%d" % steps_per_second) ## ???
         self._write("VM%d" % steps_per_second)
-        self._write("AT%d" % (20 if steps_per_second > 1000 else -10)) ## guesses at useful values
+        if at is None:
+            at = RAPID_AT if steps_per_second > 1000 else -10 ## guesses at useful values
+        # VS/VM may reset AT, only planned programs (which are still experimental) take the risk
+        self._set_acceleration(at, force_redundant_set or not self.plan_acceleration)
         self.set_spindle_speed(self.state.spindle_speed) # setting speed seems to reset this back to full speed
 
+    def _set_acceleration(self, at, force_redundant_set=False):
+        """ Set AT (see set_speed), only sending it if it's changed or force_redundant_set """
+        if at == self._cur_at and not force_redundant_set:
+            return
+        self._cur_at = at
+        self._write("AT%d" % at)
+
     def set_spindle_speed(self, ss):
         """
         Set the spindle speed
@@ -240,7 +476,7 @@ class AMC2500:
         ss = min(99, max(ss, 0))
         self._write_pos("SS%d" % round(ss),10)
         if changing_speed:
-            time.sleep(0.3) # spindle takes time to spin up/down
+            self.dwell(0.3) # spindle takes time to spin up/down
 
     def set_head_down(self, is_down):
         """
@@ -254,9 +490,31 @@ class AMC2500:
             return
         res = self._write_pos("HD" if is_down else "HU", SHORT_TIMEOUT)
         self.state.head_down = is_down
-        time.sleep(0.3) # head movements not instant
+        if self.metrics is not None and not is_down:
+            self.metrics.count("head_lifts")
+        self.dwell(0.3) # head movements not instant
         return res
 
+    def dwell(self, seconds):
+        """ Wait for a number of seconds with the head where it is """
+        self._sleep(seconds, "dwell")
+
+    def drill(self, seconds):
+        """ Drill a hole where the head is, leaving the head down for seconds """
+        self.set_head_down(True)
+        self.dwell(seconds)
+        self.set_head_down(False)
+
+    def setup_drilling(self):
+        """ Experimental: send the commands the QuickCircuit software sends before drilling """
+        for cmd in DRILL_SETUP:
+            self._write(cmd)
+
+    def _sleep(self, seconds, reason):
+        time.sleep(seconds)
+        if self.metrics is not None:
+            self.metrics.count("sleep_seconds", reason, seconds)
+
     def get_spindle_on(self):
         return self.state.spindle_on
 
@@ -269,7 +527,7 @@ class AMC2500:
         self.state.spindle_on = spindle_on
         self._write("MO%d" % ( 1 if spindle_on else 0 ))
         self.set_spindle_speed(self.state.spindle_speed) # setting on seems to reset this back to full speed
-        time.sleep(0.3) # spindle takes time to spin up/down
+        self.dwell(0.3) # spindle takes time to spin up/down
 
     def jog(self, x, y, jog_speed=1000):
         """
@@ -290,14 +548,20 @@ class AMC2500:
         if self.limits[1] != 0 and (y * self.limits[1] < 0) :
             self.limits = (self.limits[0], 0)
 
+        self.set_jog_speed(jog_speed)
         if x != 0:
-            self._write("VJ%d" % jog_speed)
             self._write("JAY%s" % jog_dir(x)) # swapped hw axes
+            self._jog_axes.append("Y")
         if y != 0:
-            self._write("VJ%d" % jog_speed)
             self._write("JAX%s" % jog_dir(y)) # swapped hw axes
+            self._jog_axes.append("X")
      
         self.jogging = True
+
+    def set_jog_speed(self, jog_speed):
+        """ Set the speed for jogging, steps/second. Can be changed while
+        jogging to ramp the speed up or down """
+        self._write("VJ%d" % jog_speed)
         
     def stop_jog(self):
         """
@@ -309,9 +573,13 @@ class AMC2500:
         """
         if not self.jogging:
             self._error("Not jogging, stop makes no sense")
+        moved = (0, 0)
+        for axis in self._jog_axes: # only stopping what's moving saves waiting on the other axis
+            (dx, dy) = self._write_pos("JA%s0" % axis, SHORT_TIMEOUT)
+            moved = (moved[0] + dx, moved[1] + dy)
+        self._jog_axes = []
         self.jogging = False
-        self._write_pos("JAX0", SHORT_TIMEOUT)
-        self._write_pos("JAY0", SHORT_TIMEOUT)
+        return moved
     
     def move_by(self, dx, dy):
         """
@@ -319,9 +587,7 @@ class AMC2500:
 
         If successful, returns the actual number of units moved as a tuple (dx,dy)
         """
-        dx_s = self._units_to_steps(dx)
-        dy_s = self._units_to_steps(dy)
-
+        (dx_s, dy_s) = self._carry_steps(dx, dy)
         return self._move_by_steps(dx_s, dy_s)
 
     def _move_by_steps(self, dx_s, dy_s):
@@ -334,7 +600,17 @@ class AMC2500:
             self.limits = (self.limits[0], 0)
 
         # todo: calculate an appropriate timeout based on our known stepping rate
-        return self._write_pos("DA%d,%d,0\nGO" % (dy_s, dx_s), 180)
+        start = self.state.pos
+        result = self._write_pos("DA%d,%d,0\nGO" % (dy_s, dx_s), 180)
+        if self._at_max_speed() and not self._limit_hit:
+            moved = (self.state.pos[0] - start[0], self.state.pos[1] - start[1])
+            missed = moved != (dx_s, dy_s) # only if the controller says so, see SpeedLearner
+            if missed:
+                self._error("Rapid moved %d,%d steps instead of %d,%d, slowing down" % (moved + (dx_s, dy_s)))
+            if self.speeds.moved(missed):
+                self._debug("Rapids now %d steps/second, AT%d" % self.speeds.setting())
+                self.set_max_speed()
+        return result
 
 
     def arc_by(self, dx, dy, i, j, cw):
@@ -343,22 +619,19 @@ class AMC2500:
 
         If successful, returns the actual number of units moved as a tuple (dx,dy)
         """
-        dx_s = self._units_to_steps(dx)
-        dy_s = self._units_to_steps(dy)
-
-        i_s = self._units_to_steps(i)
-        j_s = self._units_to_steps(j)
-
-        if dx_s == 0 and dy_s == 0:
-            return # sending 0,0 breaks the controller
-
-        if i_s == 0 and j_s == 0:
-            return # sending 0,0 is likely to break the controller
-
-        if i_s == dx_s and j_s == dy_s:
-            return # sending (i,j) == (dx,dy) is likely to break the controller
+        # the centre is relative to where the head should be, not where the last
+        # whole step left it
+        carry = self.state.carry
+        i_s = int(round(float(i) * self.state.steps_per_unit + carry[0]))
+        j_s = int(round(float(j) * self.state.steps_per_unit + carry[1]))
+        (dx_s, dy_s) = self._carry_steps(dx, dy)
+        return self._arc_by_steps(dx_s, dy_s, i_s, j_s, cw)
+
+    def _arc_by_steps(self, dx_s, dy_s, i_s, j_s, cw):
+        if not _valid_arc(dx_s, dy_s, i_s, j_s):
+            return
 
-       	arc_s = central_angle_steps(i_s, j_s, dx_s, dy_s, cw)
+        arc_s = central_angle_steps(i_s, j_s, dx_s, dy_s, cw)
 
         return self._write_pos("CR%d,%d,0,%d,%d,0,%d\nGO" % (j_s, i_s, 
             dy_s, dx_s, arc_s),180)
@@ -367,23 +640,37 @@ class AMC2500:
         """
         Move the axis to an absolute position x,y based on currently known position
         """
-        print "Moving to %.1f,%.1f" % (x,y)
-        (x_s, y_s) = self._units_to_steps(x), self._units_to_steps(y)
-        (dx_s, dy_s) = (x_s-self.state.pos[0], y_s-self.state.pos[1])
-        print "Steps, moving %d,%d->%d,%d delta %d,%d" % (self.state.pos[0],self.state.pos[1],x_s,y_s,dx_s,dy_s)
-        return self._move_by_steps(dx_s,dy_s)
+        self._debug("Moving to %.1f,%.1f" % (x,y))
+        (dx_s, dy_s) = self._steps_to(x, y)
+        (x_s, y_s) = (self.state.pos[0]+dx_s, self.state.pos[1]+dy_s)
+        self._debug("Steps, moving %d,%d->%d,%d delta %d,%d" % (self.state.pos[0],self.state.pos[1],x_s,y_s,dx_s,dy_s))
+        return self._move_to_steps(x_s, y_s)
+
+    def _move_to_steps(self, x_s, y_s):
+        return self._move_by_steps(x_s - self.state.pos[0], y_s - self.state.pos[1])
 
     def arc_to(self, x, y, i, j, cw):
         """
         Move the axis to an absolute position x,y based on currently known position
         """
-        (x_s, y_s) = self._units_to_steps(x), self._units_to_steps(y)        
-        (dx_s, dy_s) = (x_s-self.state.pos[0], y_s-self.state.pos[1])
-        (i_s, j_s) = self._units_to_steps(i), self._units_to_steps(j)        
+        (i_s, j_s) = self._units_to_steps(i), self._units_to_steps(j)
         (di_s, dj_s) = (i_s-self.state.pos[0], j_s-self.state.pos[1])
-        return self.arc_by(self._steps_to_units(dx_s), self._steps_to_units(dy_s),
-                                self._steps_to_units(di_s), self._steps_to_units(dj_s),cw)
+        (dx_s, dy_s) = self._steps_to(x, y)
+        return self._arc_by_steps(dx_s, dy_s, di_s, dj_s, cw)
+
 
+    def run(self, op):
+        """
+        Run one operation from a program compiled by Compiler, a tuple of
+        the operation name and its arguments (all in steps):
+        ("move", dx, dy), ("move_to", x, y) (from wherever the head really
+        is), ("arc", dx, dy, i, j, cw), ("head", is_down),
+        ("spindle", spindle_on), ("spindle_speed", ss),
+        ("speed", steps_per_second) or ("speed", steps_per_second, at),
+        ("max_speed",), ("accel", at), ("dwell", seconds), ("drill", seconds)
+        or ("drill_setup",)
+        """
+        return self._operations[op[0]](*op[1:])
 
     def zero(self):
         """
@@ -391,47 +678,120 @@ class AMC2500:
         """
         return self.find_corner(-1, -1, True)
 
-    def find_corner(self, lx, ly, zero_there=False):
+    def find_corner(self, lx, ly, zero_there=False, approach=HOMING_APPROACH):
         """
         Find a corner based on limits (+1 or -1 for lx & ly) and optionally
         zero the current position on it
         
-        Works by stepping quickly to the limit, backing off slowly, then moving in slowly 
-        to the limit again
-        """
+        Works by moving both axes quickly onto the limits (straight to near
+        the corner if it's been found before, otherwise the size of the bed
+        towards it), backing off by half of approach (in steps), then moving
+        in slowly to the limits again
 
+        If the limits aren't near the corner found before, it searches the
+        whole bed instead. Raises AMCError if it can't get onto the limits.
+
+        Returns a dict with the "seconds" it took, and the "error" (dx,dy
+        in steps) between the corner found and where it was known to be
+        before, or None if it wasn't known
+        """
+        start = time.time()
         self.set_head_down(False)
         self.set_spindle_on(False)
         self.save_state()
-        fast=self._steps_to_units(2000)
-        slow=self._steps_to_units(250)
-        big=self._steps_to_units(80000)
-        small=self._steps_to_units(1000)
-        self.set_speed(fast)
-        while self.limits[0] != lx:
-            self.move_by(big if lx > 0 else -1*big,0)
-        self.move_by(-1*small/2 if lx > 0 else small/2,0)
-        self.set_speed(slow)
-        self.move_by(small if lx > 0 else -1*small,0)
-        if self.limits[0] != lx:
-            self._error("Failed to find X limit %d, got limit value %d" % (lx, self.limits[0]))
-
-        self.set_speed(fast)
-        while self.limits[1] != ly:
-            self.move_by(0, big if ly>0 else -1*big)
-        self.move_by(0, -1*small/2 if ly>0 else small/2)
-        self.set_speed(slow)
-        self.move_by(0,small if ly > 0 else -1*small)
-        if self.limits[1] != ly:
-            self._error("Failed to find Y limit %d, got limit value %d" % (ly, self.limits[1]))
-        self.restore_state()
+        self.set_units_steps()
+        known = self.corner if (lx, ly) == (-1, -1) else None
+        try:
+            self.set_speed(HOMING_FAST)
+            self.limits = (0,0) # may be out of date after arcs, they'll be found again
+            search = known is None
+            if known is not None:
+                self.move_to(known[0] - lx * approach, known[1] - ly * approach)
+                try:
+                    self._move_onto_limits(lx, ly, (2 * approach, 2 * approach))
+                except AMCError, err: # a long way out, maybe steps were missed
+                    self._error("%s near the known corner, searching the whole bed" % err)
+                    search = True
+            if search:
+                self._move_onto_limits(lx, ly, (int(MOVEABLE_WIDTH), int(MOVEABLE_HEIGHT)))
+            self._move_by_steps(-lx * approach / 2, -ly * approach / 2)
+            self.set_speed(HOMING_SLOW)
+            self._move_onto_limits(lx, ly, (approach, approach))
+            corner = self.state.pos
+        except AMCError:
+            self.corner = None # wherever it is, it can't be trusted any more
+            raise
+        finally:
+            self.restore_state()
+
+        result = { "seconds" : time.time() - start, "error" : None }
+        if (lx, ly) == (-1, -1):
+            if known is not None:
+                result["error"] = (corner[0] - known[0], corner[1] - known[1])
+                if self.speeds is not None and self.speeds.homed(result["error"]):
+                    self._error("Homing found the corner %d,%d steps out, slowing rapids to %d steps/second, AT%d" % (
+                        result["error"] + self.speeds.setting()))
+            self.corner = corner
+        if self.metrics is not None:
+            self.metrics.observe("homing_seconds", None, result["seconds"])
+        self._debug("Found corner %d,%d in %.1fs" % (lx, ly, result["seconds"]))
         if zero_there:
             self.zero_here()
+        return result
+
+    def move_to_corner(self):
+        """
+        Drive the head into the X-,Y- corner at max speed. If the corner
+        is known it goes straight to just short of it, otherwise it moves
+        the size of the bed towards it, then moves onto the limits.
+
+        Quicker than find_corner, but not as exact as it doesn't back off
+        and approach slowly. Like find_corner, it searches the whole bed if
+        the limits aren't near the known corner, and raises AMCError if it
+        can't get onto them.
+        """
+        self.save_state()
+        try:
+            self.set_units_steps()
+            self.set_max_speed()
+            self.limits = (0,0) # may be out of date after arcs, they'll be found again
+            search = self.corner is None
+            if not search:
+                self.move_to(self.corner[0] + CORNER_MARGIN, self.corner[1] + CORNER_MARGIN)
+                try:
+                    self._move_onto_limits(-1, -1, (2 * CORNER_MARGIN, 2 * CORNER_MARGIN))
+                except AMCError, err:
+                    self._error("%s near the known corner, searching the whole bed" % err)
+                    search = True
+            if search:
+                self._move_onto_limits(-1, -1, (int(MOVEABLE_WIDTH), int(MOVEABLE_HEIGHT)))
+            self.corner = self.state.pos
+        except AMCError:
+            self.corner = None # wherever it is, it can't be trusted any more
+            raise
+        finally:
+            self.restore_state()
+
+    def _move_onto_limits(self, lx, ly, (reach_x, reach_y)):
+        """ Move towards the lx,ly limits (+1 or -1) until the head is on both,
+        at most reach_x,reach_y steps each time (the head stops at the first limit)
+
+        Raises AMCError if it doesn't get onto both """
+        for attempt in range(3):
+            if self.limits == (lx, ly):
+                return
+            self._move_by_steps(0 if self.limits[0] == lx else lx * reach_x,
+                                0 if self.limits[1] == ly else ly * reach_y)
+        if self.limits != (lx, ly):
+            raise AMCError("Failed to find limits %d,%d, got limit values %d,%d" % ((lx, ly) + self.limits))
 
     def zero_here(self):
         """Zero the head on the current coordinates without moving it"""
         self._debug("Zeroing here (was %d,%d steps)" % self.state.pos)
+        if self.corner is not None: # the corner stays put
+            self.corner = (self.corner[0] - self.state.pos[0], self.corner[1] - self.state.pos[1])
         self.state.pos = (0,0)
+        self.state.carry = (0.0,0.0)
 
     def reinitialise(self):
         self._debug("Reinitialising...")
@@ -447,15 +807,20 @@ class AMC2500:
             print "%s D %s" % (ts(), msg)
     
     def _write(self, cmd, response_timeout_s=None):
-        CMD_SLEEP=0.01
         while self.ser.inWaiting() > 0:
             dumped = self.ser.read(self.ser.inWaiting())
             print "WARNING dumping unexpected %d chars '%s'" % (len(dumped),dumped)
         self.ser.write("%s\n" % cmd)
         if self.trace:
             print "%s W %s" % (ts(), cmd)
+        metrics = self.metrics
+        if metrics is not None:
+            cmd_type = re.match(_RE_TYPE, cmd).group(0)
+            metrics.count("serial_commands", cmd_type)
+            metrics.count("serial_bytes_out", None, len(cmd) + 1)
+            start = time.time()
         if response_timeout_s is None:
-            time.sleep(CMD_SLEEP)
+            self._sleep(CMD_SLEEP, "command")
         else:
             ser = self.ser
             t = ser.timeout
@@ -466,17 +831,23 @@ class AMC2500:
                 rsp.append(ln)
                 if self.trace:
                     print "%s R %s" % (ts(), ln)                
+                if metrics is not None:
+                    metrics.count("serial_bytes_in", None, len(ln))
                 if ln.startswith("ER"):
                     self._debug("Error State")
+                    if metrics is not None:
+                        metrics.count("controller_errors")
                     self.reinitialise()
                     raise AMCError("Controller Error: %s (command was %s)" % (ln[1:], cmd))
                 if not (ln.startswith("OK") or ln.startswith("ES")):
-                    time.sleep(CMD_SLEEP)
+                    self._sleep(CMD_SLEEP, "response")
                 if ser.inWaiting() > 0:
                         continue
                 break
                     
             ser.timeout = t
+            if metrics is not None:
+                metrics.observe("response_seconds", cmd_type, time.time() - start)
             return rsp
 
     def _write_pos(self, cmd, response_timeout_s):
@@ -487,6 +858,7 @@ class AMC2500:
         """
         rsp = self._write(cmd, response_timeout_s)
         dpos = (0,0)
+        self._limit_hit = False
         for l in rsp:       
             at_limits = False
             #todo: parse this stuff properly
@@ -504,15 +876,20 @@ class AMC2500:
                 self.state.pos = (self.state.pos[0]+dpos[0], self.state.pos[1]+dpos[1])
                 if emergency_stop:
                     self._debug("Emergency Stop")
+                    if self.metrics is not None:
+                        self.metrics.count("emergency_stops")
                     self.reinitialise()
                     raise AMCError("Emergency Stop button was pushed")                     
                 if at_limits:
+                    self._limit_hit = True
                     ld = 1 if vals["dir"] == "+" else -1
                     if vals["axis"] == "Y": # axes swapped from h/w, so X
                         self.limits = (ld, self.limits[1])
                     elif vals["axis"] == "X": # Y
                         self.limits = (self.limits[0], ld)                    
                     self._debug("At limits (%d,%d)" % self.limits)
+                    if self.metrics is not None:
+                        self.metrics.count("limit_events", ("X" if vals["axis"] == "Y" else "Y") + vals["dir"])
         return (self._steps_to_units(dpos[0]), self._steps_to_units(dpos[1]))
 
 
@@ -531,6 +908,362 @@ class SimController(AMC2500):
     def _get_serial(self, port):
         return FakeSerial()
 
+def _valid_arc(dx_s, dy_s, i_s, j_s):
+    """ Can the controller be sent an arc with these (step) parameters? """
+    if dx_s == 0 and dy_s == 0:
+        return False # sending 0,0 breaks the controller
+    if i_s == 0 and j_s == 0:
+        return False # sending 0,0 is likely to break the controller
+    if i_s == dx_s and j_s == dy_s:
+        return False # sending (i,j) == (dx,dy) is likely to break the controller
+    return True
+
+
+def at_ramp_steps(at):
+    """ Steps the head takes to reach full speed with this AT (in the model) """
+    return abs(at - 1) * AT_RAMP_STEPS
+
+def move_seconds(steps, speed, at):
+    """ Seconds a move of steps takes at speed (steps/second) with this AT, in
+    the model: speeding up and slowing down evenly over the ramp, or for
+    the half of the move each if that's too short to reach full speed """
+    ramp = at_ramp_steps(at)
+    if steps >= 2 * ramp:
+        return (steps + 2 * ramp) / float(speed)
+    return 2 * math.sqrt(2 * ramp * steps) / speed
+
+def least_at(steps, speed):
+    """ The shortest ramp AT a move of steps at speed can use without missing
+    steps (in the model.) That's a ramp which keeps to MAX_ACCEL, or which
+    is too long for a short move to get going faster than START_SPEED """
+    if speed <= START_SPEED:
+        return 1
+    need = min(speed * speed / (2.0 * MAX_ACCEL), speed * speed * steps / (2.0 * START_SPEED * START_SPEED))
+    return min(1 + int(math.ceil(need / AT_RAMP_STEPS)), RAPID_AT)
+
+def _arc_sweep(dx_s, dy_s, i_s, j_s, cw):
+    """ Angle (radians, negative clockwise) an arc turns through """
+    sweep = math.atan2(dy_s - j_s, dx_s - i_s) - math.atan2(-j_s, -i_s)
+    if cw and sweep >= 0:
+        sweep -= 2 * math.pi
+    elif not cw and sweep <= 0:
+        sweep += 2 * math.pi
+    return sweep
+
+
+class Compiler(AMC2500):
+    """
+    Lowers calls on a controller into a program of operations in whole
+    steps (see AMC2500.run), which are added to the program list instead
+    of being sent anywhere. All of the unit conversion, carrying and
+    state saving & restoring happens here, so running the program only
+    has to send each operation.
+
+    Moves are assumed to go exactly as asked, as nothing stops the head.
+    Absolute moves stay absolute though, so when the program is run they
+    start from wherever the head really got to.
+    """
+    def __init__(self):
+        self.program = []
+        AMC2500.__init__(self, debug=False, trace=False)
+        # start by putting the controller into the state this starts in
+        self.program = [ ("head", False), ("spindle", False),
+                         ("speed", self.state.cur_step_speed), ("spindle_speed", self.state.spindle_speed) ]
+
+    def _get_serial(self, port):
+        return FakeSerial()
+
+    def _write(self, cmd, response_timeout_s=None):
+        pass # only reached while initialising
+
+    def dwell(self, seconds):
+        self.program.append(("dwell", seconds))
+
+    def drill(self, seconds):
+        self.program.append(("drill", seconds))
+
+    def setup_drilling(self):
+        self.program.append(("drill_setup",))
+
+    def _set_step_speed(self, steps_per_second, force_redundant_set=False, at=None):
+        if self.state.cur_step_speed == steps_per_second and not force_redundant_set:
+            return
+        self.state.cur_step_speed = steps_per_second
+        self.program.append(("speed", steps_per_second))
+
+    def set_max_speed(self):
+        # rapids go at whatever the controller running the program has learnt
+        if self.state.cur_step_speed != MAX_SPEED:
+            self.state.cur_step_speed = MAX_SPEED
+            self.program.append(("max_speed",))
+
+    def set_spindle_speed(self, ss):
+        self.state.spindle_speed = ss
+        self.program.append(("spindle_speed", ss))
+
+    def set_head_down(self, is_down):
+        if is_down != self.state.head_down:
+            self.state.head_down = is_down
+            self.program.append(("head", is_down))
+
+    def set_spindle_on(self, spindle_on):
+        if spindle_on != self.state.spindle_on:
+            self.state.spindle_on = spindle_on
+            self.program.append(("spindle", spindle_on))
+
+    def _move_by_steps(self, dx_s, dy_s):
+        if dx_s == 0 and dy_s == 0:
+            return
+        self.program.append(("move", dx_s, dy_s))
+        self.state.pos = (self.state.pos[0]+dx_s, self.state.pos[1]+dy_s)
+        return self._steps_to_units((dx_s, dy_s))
+
+    def _move_to_steps(self, x_s, y_s):
+        (dx_s, dy_s) = (x_s - self.state.pos[0], y_s - self.state.pos[1])
+        if dx_s == 0 and dy_s == 0:
+            return
+        self.program.append(("move_to", x_s, y_s))
+        self.state.pos = (x_s, y_s)
+        return self._steps_to_units((dx_s, dy_s))
+
+    def _arc_by_steps(self, dx_s, dy_s, i_s, j_s, cw):
+        if not _valid_arc(dx_s, dy_s, i_s, j_s):
+            return
+        self.program.append(("arc", dx_s, dy_s, i_s, j_s, cw))
+        self.state.pos = (self.state.pos[0]+dx_s, self.state.pos[1]+dy_s)
+        return self._steps_to_units((dx_s, dy_s))
+
+
+def plan_acceleration(program, window=PLAN_WINDOW):
+    """
+    Generator which chooses an AT for each move in a program from Compiler,
+    adding ("accel", at) operations and giving ("speed", steps_per_second)
+    operations the AT to use (instead of the guess set_speed makes.)
+
+    Each move gets an AT with a ramp no shorter than it needs (see
+    least_at), but changing AT costs a command, so the ATs are chosen to
+    take the least time over each window of moves around it. Rapids at
+    ("max_speed",) keep the AT that sets.
+    """
+    switch_seconds = len("AT-10\n") * 10.0 / BAUD_RATE + CMD_SLEEP
+    speed = None # steps/second, or None for rapids
+    at = None # the controller's AT, if known
+    pos = (0, 0) # where the program has got to, for the length of ("move_to", x, y)
+    pending = [] # operations waiting for the window to be planned
+    moves = [] # (index in pending, steps, speed)
+
+    def plan(at):
+        """ Work out the ATs for the pending moves, returning the planned
+        operations and the AT they leave set """
+        states = sorted(set([ least_at(steps, speed) for (_, steps, speed) in moves ] + ([ at ] if at is not None else [])))
+        costs = dict((state, 0.0 if state == at else float("inf")) for state in states)
+        best = 0.0 # least cost so far, which any state can switch from
+        came_from = [] # for each move, the state each state was in for the move before
+        for (_, steps, speed) in moves:
+            need = least_at(steps, speed)
+            switch_from = min(costs, key=costs.get)
+            new_costs = {}
+            previous = {}
+            for state in states:
+                if state < need:
+                    new_costs[state] = float("inf")
+                    continue
+                stay = costs[state]
+                change = best + switch_seconds
+                previous[state] = state if stay <= change else switch_from
+                new_costs[state] = min(stay, change) + move_seconds(steps, speed, state)
+            came_from.append(previous)
+            costs = new_costs
+            best = min(costs.values())
+        planned = {}
+        state = min(costs, key=costs.get) if moves else None
+        for n in range(len(moves) - 1, -1, -1):
+            planned[moves[n][0]] = state
+            state = came_from[n].get(state)
+        upcoming = [ None ] * len(pending) # the AT of the next planned move after each operation
+        for n in range(len(pending) - 2, -1, -1):
+            upcoming[n] = planned.get(n + 1, upcoming[n + 1])
+        result = []
+        for n, op in enumerate(pending):
+            if op[0] == "speed": # set the AT the next move wants along with the speed
+                at = upcoming[n] or at or (RAPID_AT if op[1] > 1000 else -10)
+                op = ("speed", op[1], at)
+            elif n in planned and planned[n] != at:
+                at = planned[n]
+                result.append(("accel", at))
+            result.append(op)
+        return result, at
+
+    for op in program:
+        if op[0] in ("max_speed", "tool_change") or len(moves) >= window:
+            (planned, at) = plan(at)
+            for planned_op in planned:
+                yield planned_op
+            del pending[:]
+            del moves[:]
+        if op[0] == "max_speed":
+            speed = None
+            at = None # whatever the controller has learnt
+        elif op[0] == "tool_change":
+            at = None # engrave moves the head around, setting speeds as it goes
+        elif op[0] == "speed":
+            speed = op[1]
+        elif op[0] in ("move", "move_to", "arc"):
+            if op[0] == "move_to":
+                (dx, dy) = (op[1] - pos[0], op[2] - pos[1])
+            else:
+                (dx, dy) = op[1:3]
+            pos = (pos[0] + dx, pos[1] + dy)
+            if speed is not None:
+                if op[0] == "arc":
+                    steps = abs(_arc_sweep(*op[1:])) * math.hypot(op[3], op[4])
+                else:
+                    steps = math.hypot(dx, dy)
+                moves.append((len(pending), steps, speed))
+        pending.append(op)
+    for planned_op in plan(at)[0]:
+        yield planned_op
+
+
+class ModelController(AMC2500):
+    """
+    A model of an AMC2500 for dry runs. Nothing is sent anywhere and
+    nothing sleeps, instead it totals up the time the real controller
+    would take and the serial traffic it would need (see report().)
+
+    Moves are timed at the current speed, or with ramps set true, with the
+    acceleration AT sets (see move_seconds, which is only an estimate.)
+    There are no limit switches, so nothing stops the head. Homing takes the X-,Y- corner to be where the head was the first
+    time it looked for it.
+    """
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.bounds = None # (min x, min y, max x, max y) in steps
+        self.ramps = False
+        self.home = None # where homing finds the X-,Y- corner, in steps
+        AMC2500.__init__(self, debug=False, trace=False)
+
+    def _get_serial(self, port):
+        return FakeSerial()
+
+    def dwell(self, seconds):
+        self.totals["wait_seconds"] += seconds
+
+    def _set_step_speed(self, steps_per_second, force_redundant_set=False, at=None):
+        before = self.state.cur_step_speed
+        AMC2500._set_step_speed(self, steps_per_second, force_redundant_set, at)
+        if self.state.cur_step_speed != before:
+            self.totals["speed_changes"] += 1
+
+    def _set_acceleration(self, at, force_redundant_set=False):
+        if at != self._cur_at:
+            self.totals["accel_changes"] += 1
+        AMC2500._set_acceleration(self, at, force_redundant_set)
+
+    def set_spindle_speed(self, ss):
+        if ss != self.state.spindle_speed:
+            self.totals["spindle_changes"] += 1
+        AMC2500.set_spindle_speed(self, ss)
+
+    def set_spindle_on(self, spindle_on):
+        if spindle_on != self.state.spindle_on:
+            self.totals["spindle_changes"] += 1
+        AMC2500.set_spindle_on(self, spindle_on)
+
+    def set_head_down(self, is_down):
+        if self.state.head_down and not is_down:
+            self.totals["head_lifts"] += 1
+        return AMC2500.set_head_down(self, is_down)
+
+    def _move_by_steps(self, dx_s, dy_s):
+        start = self.state.pos
+        result = AMC2500._move_by_steps(self, dx_s, dy_s)
+        if result is not None:
+            self._travel(math.hypot(dx_s, dy_s), [ start, self.state.pos ])
+        return result
+
+    def _move_onto_limits(self, lx, ly, reach):
+        if (lx, ly) == (-1, -1):
+            if self.home is None:
+                self.home = self.state.pos
+            self._move_by_steps(self.home[0] - self.state.pos[0], self.home[1] - self.state.pos[1])
+        self.limits = (lx, ly)
+
+    def zero_here(self):
+        if self.home is not None:
+            self.home = (self.home[0] - self.state.pos[0], self.home[1] - self.state.pos[1])
+        AMC2500.zero_here(self)
+
+    def _arc_by_steps(self, dx_s, dy_s, i_s, j_s, cw):
+        start = self.state.pos
+        result = AMC2500._arc_by_steps(self, dx_s, dy_s, i_s, j_s, cw)
+        if result is not None:
+            radius = math.hypot(i_s, j_s)
+            a0 = math.atan2(-j_s, -i_s)
+            sweep = _arc_sweep(dx_s, dy_s, i_s, j_s, cw)
+            # sample the arc for its bounds, the ends alone miss any bulge
+            centre = (start[0] + i_s, start[1] + j_s)
+            points = [ (centre[0] + radius * math.cos(a0 + sweep * n / 16),
+                        centre[1] + radius * math.sin(a0 + sweep * n / 16)) for n in range(17) ]
+            self._travel(abs(sweep) * radius, points)
+        return result
+
+    def _travel(self, steps, points):
+        """ Account for moving the head steps along a path through points (in steps) """
+        kind = "cut" if self.state.head_down else "rapid"
+        if self.ramps:
+            self.totals["%s_seconds" % kind] += move_seconds(steps, self.state.cur_step_speed, self._cur_at)
+        else:
+            self.totals["%s_seconds" % kind] += steps / self.state.cur_step_speed
+        self.totals["%s_distance" % kind] += steps / STEPS_PER_MM
+        for (x, y) in points:
+            if self.bounds is None:
+                self.bounds = (x, y, x, y)
+            self.bounds = (min(self.bounds[0], x), min(self.bounds[1], y),
+                           max(self.bounds[2], x), max(self.bounds[3], y))
+
+    def _write(self, cmd, response_timeout_s=None):
+        self.totals["serial_commands"] += len(cmd.split("\n"))
+        self.totals["serial_bytes"] += len(cmd) + 1
+        self.totals["serial_seconds"] += (len(cmd) + 1) * 10.0 / BAUD_RATE # 8N1, 10 bits a byte
+        if response_timeout_s is None:
+            self.totals["serial_seconds"] += CMD_SLEEP
+            return
+        # reply as if the move went exactly as asked
+        line = cmd.split("\n")[0]
+        move = re.search(_RE_DA, line) or re.search(_RE_CR, line)
+        if move is not None:
+            return [ "OK%s,%s,0" % (move.group("x"), move.group("y")) ]
+        return [ "OK0,0,0" ]
+
+    def report(self):
+        """
+        Return a dict describing the job so far:
+        - seconds is the estimated total time, made up of cut_seconds,
+        rapid_seconds, wait_seconds (for the head, spindle & dwells) and
+        serial_seconds (sending commands)
+        - cut_distance and rapid_distance are in mm
+        - head_lifts, spindle_changes, speed_changes and accel_changes count
+        those changes
+        - serial_commands and serial_bytes are the traffic sent to the controller
+        - bounds is (min x, min y, max x, max y) in mm from the starting point,
+        and size is the width & height of that
+        - fits is whether that size fits in the engraver's moveable area
+        """
+        result = dict((key, self.totals[key]) for key in
+                      [ "cut_seconds", "rapid_seconds", "wait_seconds", "serial_seconds", "cut_distance",
+                        "rapid_distance" ])
+        for key in "head_lifts", "spindle_changes", "speed_changes", "accel_changes", "serial_commands", "serial_bytes":
+            result[key] = int(self.totals[key])
+        result["seconds"] = sum(self.totals[key] for key in
+                                [ "cut_seconds", "rapid_seconds", "wait_seconds", "serial_seconds" ])
+        bounds = self.bounds or (0, 0, 0, 0)
+        result["bounds"] = tuple(b / STEPS_PER_MM for b in bounds)
+        result["size"] = ((bounds[2] - bounds[0]) / STEPS_PER_MM, (bounds[3] - bounds[1]) / STEPS_PER_MM)
+        result["fits"] = bounds[2] - bounds[0] <= MOVEABLE_WIDTH and bounds[3] - bounds[1] <= MOVEABLE_HEIGHT
+        return result
+
+
 class FakeSerial:
     """ A fake AMC2500 serial port, like serial() but fakes its responses """
     def __init__(self, *args):
@@ -538,6 +1271,8 @@ class FakeSerial:
         self.y = 0 # track our own position
         self.timeout = None
         self.buffer = [] # what we have waiting to read back to the caller
+        self.jog_speed = 0
+        self.jogging = {} # hardware axis -> (direction, time of the last update, steps jogged before it)
 
     def open(self):
         pass
@@ -551,8 +1286,16 @@ class FakeSerial:
               move = re.search(_RE_CR, line)
 
             print line
+            jog = re.search(_RE_JOG, line)
+            if jog is not None:
+                move = self._jog(jog.group("axis"), jog.group("dir"))
+            elif re.search(r"^VJ[0-9]+$", line): # jog speed, applies from now on
+                for axis in self.jogging:
+                    self._jogged(axis)
+                self.jog_speed = int(line[2:])
             if move is not None:
-                move = move.groupdict()
+                if not isinstance(move, dict):
+                    move = move.groupdict()
                 dx = int(move["x"])
                 dy = int(move["y"])
 
@@ -565,7 +1308,7 @@ class FakeSerial:
                         pos = maxx
                     if pos < 0:
                         limit = -1
-                        delta = delta + pos
+                        delta = delta - pos
                         pos = 0                
                     return (delta, pos, limit)
 
@@ -573,7 +1316,7 @@ class FakeSerial:
                 (dy, self.y, limit_y) = get_limit(dy, self.y, MOVEABLE_HEIGHT)
                 if limit_x != 0:
                     self.buffer.insert(0, "LIX%s,%d,%d,0" % ("+" if limit_x > 0 else "-", dx, dy))
-                if limit_y != 0:
+                elif limit_y != 0: # one limit message, even if both were hit
                     self.buffer.insert(0, "LIY%s,%d,%d,0" % ("+" if limit_y > 0 else "-", dx, dy))
                 if limit_x == 0 and limit_y == 0:
                     self.buffer.insert(0, "OK%d,%d,0" % (dx, dy))
@@ -595,6 +1338,23 @@ class FakeSerial:
 
         return len(data)
 
+    def _jogged(self, axis):
+        """ Add up the steps jogged along axis at the jog speed so far """
+        (direction, since, steps) = self.jogging[axis]
+        now = time.time()
+        self.jogging[axis] = (direction, now, steps + direction * self.jog_speed * (now - since))
+
+    def _jog(self, axis, direction):
+        """ Start or stop jogging an axis, returning the move it made once stopped """
+        if direction != "0":
+            self.jogging[axis] = (1 if direction == "+" else -1, time.time(), 0)
+            return None
+        if axis not in self.jogging:
+            return { "x" : 0, "y" : 0 }
+        self._jogged(axis)
+        steps = int(self.jogging.pop(axis)[2])
+        return { "x" : steps if axis == "X" else 0, "y" : steps if axis == "Y" else 0 }
+
     def readline(self):
         if len(self.buffer) > 0:
             time.sleep(0.01)
@@ -617,8 +1377,10 @@ _RE_CIRC=r"(?P<i>[-\d]+),(?P<j>[-\d]+),(?P<k>[-\d]+)"
 _RE_OK = r"OK" + _RE_AXES
 _RE_ES = r"ES" + _RE_AXES
 _RE_DA = r"^DA" + _RE_AXES + "$"
+_RE_JOG = r"^JA(?P<axis>[XY])(?P<dir>[-+0])$"
 _RE_CR = r"^CR" + _RE_CIRC + "," + _RE_AXES +",[-\d]+$"
 _RE_LIMIT = r"LI(?P<axis>.)(?P<dir>.)," + _RE_AXES
+_RE_TYPE = r"[A-Z]*"
 
 def ts():
     return datetime.datetime.now().isoformat()
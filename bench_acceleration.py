@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Benchmark choosing AT for each move (engrave_gcode.py --plan-acceleration)
+against one AT for each speed, timing synthetic isolation paths of many
+short segments on the controller model (amc2500.ModelController.)
+"""
+import argparse, time
+import amc2500, engrave_gcode, gcode_optimise
+from bench_optimise import synthetic_contours
+
+parser = argparse.ArgumentParser(description='Benchmark acceleration planning on synthetic isolation paths.')
+parser.add_argument('--segments', type=int, default=100000,
+                    help="Number of G1 segments to generate (default 100000.)")
+parser.add_argument('--contour-lengths', type=int, nargs='*', default=[ 1000, 100, 20 ],
+                    help="Numbers of segments in each synthetic contour to compare, fewer make shorter segments (default 1000 100 20.)")
+parser.add_argument('--max-deviation', type=float, default=0.025,
+                    help="Deviation threshold in mm for the optimised runs (default 0.025mm.)")
+
+
+def model(commands, options):
+    """ Compile commands with engrave_gcode options and run them on a ModelController,
+    returning its report and the seconds compiling took """
+    args = engrave_gcode.parser.parse_args(options)
+    controller = amc2500.ModelController()
+    controller.ramps = True # both ways are timed with the acceleration model
+    controller.plan_acceleration = args.plan_acceleration
+    start = time.time()
+    for op in engrave_gcode.compile_program(commands, args):
+        if op[0] not in ("done", "message", "tool_change"):
+            controller.run(op)
+    return controller.report(), time.time() - start
+
+def main():
+    args = parser.parse_args()
+    settings = dict(gcode_optimise.DEFAULT_SETTINGS, max_deviation=args.max_deviation)
+    for contour_length in args.contour_lengths:
+        commands = list(synthetic_contours(args.segments, contour_length, True))
+        optimised = gcode_optimise.run_passes(commands, gcode_optimise.DEFAULT_PASSES, settings)[0]
+        for label, program in ("as generated", commands), ("optimised", optimised):
+            print "%d segment contours, %s" % (contour_length, label)
+            (before, _) = model(program, [])
+            (after, seconds) = model(program, [ "--plan-acceleration" ])
+            for name, report in ("one AT per speed", before), ("planned AT", after):
+                print "  %-20s %9.0fs total %9.0fs cutting %7d AT changes" % (
+                    name, report["seconds"], report["cut_seconds"], report["accel_changes"])
+            print "  %-20s %9.0fs (%.0f%%), planning & modelling took %.1fs" % (
+                "saved", before["seconds"] - after["seconds"],
+                100 * (before["seconds"] - after["seconds"]) / before["seconds"], seconds)
+
+if __name__ == "__main__":
+    main()
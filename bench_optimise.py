@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark the gcode optimiser on large synthetic programs, comparing the
+pure Python kernels against the numpy ones, serial against chunked parallel
+optimisation, and the drill ordering travel distance for different amounts
+of optimisation time.
+"""
+import argparse, math, random, time
+import gcode_optimise
+
+parser = argparse.ArgumentParser(description='Benchmark gcode_optimise on synthetic input.')
+parser.add_argument('--segments', type=int, default=1000000,
+                    help="Number of G1 segments to generate (default 1000000.)")
+parser.add_argument('--contour-length', type=int, default=1000,
+                    help="Number of segments in each synthetic head-down contour (default 1000.)")
+parser.add_argument('--drills', type=int, default=5000,
+                    help="Number of drill cycles to generate (default 5000.)")
+parser.add_argument('--drill-times', type=float, nargs='*', default=[ 0.1, 1.0, 5.0 ],
+                    help="Drill order improvement times to compare, in seconds (default 0.1 1 5.)")
+parser.add_argument('--processes', type=int, nargs='*', default=[ 1, 2, 4 ],
+                    help="Process pool sizes to compare for the chunked passes (default 1 2 4.)")
+parser.add_argument('--max-deviation', type=float, default=0.025,
+                    help="Deviation threshold in mm (default 0.025mm.)")
+parser.add_argument('--seed', type=int, default=1)
+
+
+def synthetic_contours(segments, contour_length, absolute):
+    """ Yield commands for wobbly circular contours, like pcb2gcode isolation paths """
+    yield { "name" : "G21" }
+    yield { "name" : "G90" if absolute else "G91" }
+    pos = (0.0, 0.0)
+    contour = 0
+    while segments > 0:
+        count = min(segments, contour_length)
+        centre = (10 + (contour % 20) * 20, 10 + (contour / 20 % 20) * 20)
+        points = [ (centre[0] + (8 + 0.01*math.sin(n)) * math.cos(2*math.pi*n/count),
+                    centre[1] + (8 + 0.01*math.sin(n)) * math.sin(2*math.pi*n/count))
+                   for n in range(count+1) ]
+        yield _move("G0", pos, points[0], absolute, Z=1.0)
+        yield { "name" : "G1", "Z" : -0.1, "F" : 200.0 }
+        pos = points[0]
+        for p in points[1:]:
+            yield _move("G1", pos, p, absolute, Z=-0.1, F=200.0)
+            pos = p
+        segments -= count
+        contour += 1
+
+def synthetic_drills(count, seed):
+    yield { "name" : "G21" }
+    yield { "name" : "G90" }
+    rand = random.Random(seed)
+    for _ in range(count):
+        yield { "name" : "G81", "X" : rand.uniform(0, 300), "Y" : rand.uniform(0, 300), "R" : 1.0, "Z" : -0.1 }
+    yield { "name" : "M2" }
+
+def _move(name, (x0,y0), (x1,y1), absolute, **params):
+    c = dict(params, name=name)
+    c["X"], c["Y"] = (x1, y1) if absolute else (x1-x0, y1-y0)
+    return c
+
+def timed(label, fn):
+    start = time.time()
+    result = fn()
+    print "%-40s %8.2fs %9d commands" % (label, time.time() - start, len(result))
+    return result
+
+def main():
+    args = parser.parse_args()
+    numpy_min = gcode_optimise.NUMPY_MIN_POINTS
+    kernels = [ ("python", None) ]
+    if numpy_min is not None:
+        kernels.append(("numpy", numpy_min))
+    else:
+        print "numpy not available, only benchmarking the pure Python kernels"
+
+    for absolute in True, False:
+        commands = list(synthetic_contours(args.segments, args.contour_length, absolute))
+        print "%d command %s contour program" % (len(commands), "absolute" if absolute else "relative")
+        for name, setting in kernels:
+            gcode_optimise.NUMPY_MIN_POINTS = setting
+            timed("  optimise_deviation (%s)" % name,
+                  lambda: list(gcode_optimise.optimise_deviation(commands, args.max_deviation)))
+        timed("  optimise_arcs",
+              lambda: list(gcode_optimise.optimise_arcs(commands, args.max_deviation)))
+        settings = dict(gcode_optimise.DEFAULT_SETTINGS, max_deviation=args.max_deviation)
+        for processes in args.processes:
+            timed("  chunkable passes (%d processes)" % processes,
+                  lambda: gcode_optimise.run_passes(commands, gcode_optimise.CHUNKABLE_PASSES, settings,
+                                                    processes=processes)[0])
+
+    commands = list(synthetic_drills(args.drills, args.seed))
+    drills = [ (c["X"], c["Y"]) for c in commands if c["name"] == "G81" ]
+    print "%d drill program, %.0fmm travel in file order" % (args.drills, gcode_optimise.path_length((0,0), drills))
+    for optimise_time in [ 0 ] + args.drill_times:
+        result = timed("  optimise_drills (%gs improving)" % optimise_time,
+                       lambda: list(gcode_optimise.optimise_drills(commands, optimise_time)))
+        length = gcode_optimise.path_length((0,0), [ (c["X"], c["Y"]) for c in result if c["name"] == "G81" ])
+        print "%-40s %8.0fmm travel" % ("", length)
+    gcode_optimise.NUMPY_MIN_POINTS = numpy_min
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+Long running engraving daemon, which keeps the controller connection open
+and runs queued jobs back to back, preparing (parsing, optimising and
+compiling) the next job while the current one cuts.
+
+Jobs take the same options and files as engrave_gcode.py, and are
+submitted over a Unix socket with this same script:
+
+    engrave_daemon.py serve --sim &
+    engrave_daemon.py submit --max-deviation 0.05 top.ngc TC drill.ngc
+    engrave_daemon.py status
+
+Each job starts from wherever the head is when it starts (the end of the
+last job, which returns to its origin.) Submit a job with --hold to have
+it wait for "start" before it runs, to change boards in between.
+"""
+import argparse, json, os, socket, SocketServer, sys, threading, traceback
+import engrave_gcode, gcode_optimise, gcode_parse
+from amc2500 import AMC2500, AMCError, SimController, STEPS_PER_MM
+
+DEFAULT_SOCKET = "/tmp/engrave_daemon.sock"
+
+parser = argparse.ArgumentParser(description='Queue gcode jobs for the engraver, from a daemon which keeps it connected.')
+parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                    help="Unix socket the daemon listens on (default %s.)" % DEFAULT_SOCKET)
+commands = parser.add_subparsers(dest='command')
+
+serve = commands.add_parser('serve', help="Run the daemon")
+inner = serve.add_mutually_exclusive_group()
+inner.add_argument('-s', '--serial-port', default='/dev/ttyUSB0',
+                   help="Specify the serial port that the engraver is connected to.")
+inner.add_argument('--sim', action='store_true',
+                   help="Testing option: simulation run only (no real engraver involved.)")
+serve.add_argument('-v', '--verbose', action='store_true',
+                   help="Verbose mode (print every command the engraver executes.)")
+serve.add_argument('--metrics', metavar='FILE',
+                   help="Collect metrics for every job and export them to FILE (as for engrave_gcode.py.)")
+serve.add_argument('--metrics-format', choices=[ "prometheus", "json" ], default="prometheus",
+                   help="Format for the --metrics FILE (default prometheus.)")
+serve.add_argument('--adaptive-speed', action='store_true',
+                   help="Learn how fast rapids can go without missing steps, homing before and after each job (as for engrave_gcode.py.)")
+serve.add_argument('--speed-file', metavar='FILE', default=engrave_gcode.SPEED_FILE,
+                   help="Where --adaptive-speed keeps the learnt speeds (default %s.)" % engrave_gcode.SPEED_FILE)
+
+submit = commands.add_parser('submit', help="Queue a job, with engrave_gcode.py options and files")
+submit.add_argument('--hold', action='store_true',
+                    help="Don't run the job until it's started with the start command.")
+submit.add_argument('options', nargs=argparse.REMAINDER)
+
+commands.add_parser('status', help="Show the queue")
+for name, text in [ ("start", "Let a held job run, or restart the queue after a failure (with no ID)"),
+                    ("cancel", "Cancel a job that hasn't started running"),
+                    ("continue", "Carry on with a job once its tool has been changed") ]:
+    command = commands.add_parser(name, help=text)
+    command.add_argument('id', type=int, nargs='?' if name == "start" else None)
+
+# engrave_gcode options which don't make sense for a queued job
+UNSUPPORTED_OPTIONS = [ "report", "report_json", "compile", "journal", "resume", "metrics" ]
+
+
+class Job:
+    """ A queued job. state is one of queued, preparing, ready, running,
+    tool_change, done, failed or cancelled """
+    def __init__(self, id, options, hold):
+        self.id = id
+        self.options = options
+        self.hold = hold
+        self.state = "queued"
+        self.error = None
+        self.args = None
+        self.program = None
+        self.progress = { "read" : 0, "total" : 0, "done" : 0 }
+        self.tool_changed = threading.Event()
+
+    def describe(self):
+        return { "id" : self.id,
+                 "state" : self.state,
+                 "hold" : self.hold,
+                 "options" : self.options,
+                 "done" : self.progress["done"],
+                 "total" : self.progress["total"],
+                 "error" : self.error }
+
+
+class JobQueue:
+    """ The daemon's jobs, and the threads which prepare and run them in order
+
+    If the controller is collecting metrics, they're exported to
+    metrics_file while jobs run and after each job finishes.
+    """
+    def __init__(self, controller, metrics_file=None, metrics_format="prometheus"):
+        self.controller = controller
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.jobs = []
+        self.paused = False
+        self.stopping = False
+        self.changed = threading.Condition()
+        self._next_id = 1
+        self._threads = []
+
+    def start_threads(self):
+        for target in self._prepare_jobs, self._run_jobs:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop_threads(self):
+        """ Stop the threads once they've finished preparing or running the current job """
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, options, hold=False):
+        with self.changed:
+            job = Job(self._next_id, options, hold)
+            self._next_id += 1
+            self.jobs.append(job)
+            self.changed.notify_all()
+            return job
+
+    def find(self, id):
+        for job in self.jobs:
+            if job.id == id:
+                return job
+        raise ValueError("No job %d" % id)
+
+    def start(self, id=None):
+        with self.changed:
+            if id is None:
+                self.paused = False
+            else:
+                self.find(id).hold = False
+            self.changed.notify_all()
+
+    def cancel(self, id):
+        with self.changed:
+            job = self.find(id)
+            if job.state not in ("queued", "preparing", "ready"):
+                raise ValueError("Job %d is %s, it can't be cancelled" % (id, job.state))
+            job.state = "cancelled"
+            job.program = None
+            self.changed.notify_all()
+
+    def continue_job(self, id):
+        job = self.find(id)
+        if job.state != "tool_change":
+            raise ValueError("Job %d isn't waiting for a tool change" % id)
+        job.tool_changed.set()
+
+    def status(self):
+        with self.changed:
+            return { "paused" : self.paused, "jobs" : [ job.describe() for job in self.jobs ] }
+
+    def _prepare_jobs(self):
+        while True:
+            with self.changed:
+                # keep one job ready to go, so preparing doesn't hold too much in memory
+                while not any(job.state == "queued" for job in self.jobs) or \
+                      any(job.state == "ready" and not job.hold for job in self.jobs):
+                    if self.stopping:
+                        return
+                    self.changed.wait(1)
+                job = [ job for job in self.jobs if job.state == "queued" ][0]
+                job.state = "preparing"
+            try:
+                self.prepare(job)
+            except SystemExit: # from parsing bad options
+                self._finish(job, "failed", "Bad options %s" % " ".join(job.options))
+            except (IOError, ValueError, gcode_parse.ParserException), err:
+                self._finish(job, "failed", str(err))
+            except Exception, err: # anything else is a bug, but mustn't stall the queue
+                traceback.print_exc(file=sys.stdout) # with the rest of the daemon's log
+                self._finish(job, "failed", _describe_error(err))
+            else:
+                self._finish(job, "ready")
+
+    def prepare(self, job):
+        """ Parse, optimise and compile a job's program, ready to run """
+        args = engrave_gcode.parser.parse_args(job.options)
+        for name in UNSUPPORTED_OPTIONS:
+            if getattr(args, name):
+                raise ValueError("--%s can't be used for queued jobs" % name.replace("_", "-"))
+        if args.home_approach <= 0:
+            raise ValueError("--home-approach must be more than 0mm")
+        if args.hop_clearance <= 0:
+            raise ValueError("--hop-clearance must be more than 0mm")
+        args.dry_run = False
+        args.metrics, args.metrics_format = self.metrics_file, self.metrics_format
+        if args.program:
+            program = list(engrave_gcode.load_program(args.program))
+        elif args.panel:
+            if not args.pitch:
+                raise ValueError("--panel needs the --pitch between copies")
+            program, reports = engrave_gcode.panel_program(args)
+            if not engrave_gcode.model_program(program)["fits"]:
+                raise ValueError("The panel doesn't fit in the moveable area")
+        else:
+            commands = engrave_gcode.load_commands(args.files)
+            if not args.no_optimise:
+                commands, reports = gcode_optimise.run_passes(commands, args.passes.split(","),
+                                                              engrave_gcode._optimise_settings(args),
+                                                              processes=args.jobs)
+            program = list(engrave_gcode.compile_program(commands, args))
+        job.args = args
+        job.program = program
+        job.progress["total"] = job.progress["read"] = sum(1 for op in program if op[0] == "done")
+
+    def _run_jobs(self):
+        while True:
+            with self.changed:
+                job = self._next_job()
+                while job is None or job.state != "ready" or job.hold or self.paused:
+                    if self.stopping:
+                        return
+                    self.changed.wait(1)
+                    job = self._next_job()
+                job.state = "running"
+            print "Running job %d: %s" % (job.id, " ".join(job.options))
+            try:
+                approach = int(job.args.home_approach * STEPS_PER_MM)
+                if self.controller.corner is None:
+                    engrave_gcode.check_speeds(self.controller, approach)
+                # the daemon's stdin isn't for pausing jobs, it may not even be its own terminal
+                finished = engrave_gcode.engrave(self.controller, job.program, job.args, job.progress,
+                                                 jog=lambda: self._wait_for_tool_change(job), keyboard=False)
+                engrave_gcode.check_speeds(self.controller, approach)
+            except (AMCError, SystemExit), err:
+                self._machine_failed(job, str(err) or "Stopped")
+            except Exception, err: # anything else, like a serial port error
+                traceback.print_exc(file=sys.stdout) # with the rest of the daemon's log
+                self._machine_failed(job, _describe_error(err))
+            else:
+                self._finish(job, "done" if finished else "cancelled", None if finished else "Stopped early")
+            if self.metrics_file and self.controller.metrics is not None:
+                self.controller.metrics.count("jobs", job.state)
+                try:
+                    engrave_gcode.export_metrics(self.controller.metrics, self.metrics_file, self.metrics_format)
+                except EnvironmentError, err:
+                    print "Failed to export metrics to %s: %s" % (self.metrics_file, err)
+
+    def _machine_failed(self, job, error):
+        self._finish(job, "failed", error)
+        self.controller.corner = None # the head may not be where it's thought to be, home from scratch
+        with self.changed:
+            self.paused = True # something's wrong with the machine, don't start another job
+
+    def _next_job(self):
+        """ The first job that hasn't finished, jobs always run in the order they were submitted """
+        for job in self.jobs:
+            if job.state not in ("done", "failed", "cancelled"):
+                return job
+
+    def _wait_for_tool_change(self, job):
+        print "Job %d is waiting for a tool change" % job.id
+        job.tool_changed.clear()
+        job.state = "tool_change"
+        while not job.tool_changed.wait(1):
+            pass
+        job.state = "running"
+
+    def _finish(self, job, state, error=None):
+        with self.changed:
+            if job.state == "cancelled":
+                return
+            job.state = state
+            job.error = error
+            if state != "ready":
+                job.program = None
+            self.changed.notify_all()
+
+
+def _describe_error(err):
+    """ An error message for an exception nothing was expecting """
+    return "%s: %s" % (type(err).__name__, err)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """ Handles one JSON request per line, replying with a JSON line """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.queue_request(json.loads(line))
+            except (ValueError, KeyError), err:
+                reply = { "error" : str(err) }
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, queue):
+        if os.path.exists(path):
+            os.remove(path) # left over from a daemon that didn't stop cleanly
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.queue = queue
+
+    def queue_request(self, request):
+        command = request["command"]
+        if command == "submit":
+            return { "id" : self.queue.submit(request["options"], request.get("hold", False)).id }
+        elif command == "status":
+            return self.queue.status()
+        elif command == "start":
+            self.queue.start(request.get("id"))
+        elif command == "cancel":
+            self.queue.cancel(request["id"])
+        elif command == "continue":
+            self.queue.continue_job(request["id"])
+        else:
+            raise ValueError("Unknown command %s" % command)
+        return {}
+
+
+def request(path, message):
+    """ Send a request to the daemon listening at path, returning its reply """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        f = sock.makefile("rw")
+        f.write(json.dumps(message) + "\n")
+        f.flush()
+        return json.loads(f.readline())
+    finally:
+        sock.close()
+
+def _absolute_options(options):
+    """ Make the files in engrave_gcode options absolute, as the daemon runs somewhere else """
+    args = engrave_gcode.parser.parse_args(options)
+    paths = [ f for f in args.files if f != "TC" ] + ([ args.program ] if args.program else [])
+    return [ os.path.abspath(o) if o in paths else o for o in options ]
+
+def _print_status(status):
+    if status["paused"]:
+        print "Queue is paused after a failure, use start to carry on"
+    print "%4s %-12s %13s  %s" % ("ID", "State", "Done", "Job")
+    for job in status["jobs"]:
+        print "%4d %-12s %6d/%-6d  %s%s" % (job["id"], job["state"] + (" (held)" if job["hold"] and job["state"] in ("queued", "ready") else ""),
+                                            job["done"], job["total"], " ".join(job["options"]),
+                                            (": " + job["error"]) if job["error"] else "")
+
+def main():
+    args, unknown = parser.parse_known_args()
+    if args.command != "submit" and unknown:
+        parser.error("unrecognized arguments: %s" % " ".join(unknown))
+    if args.command == "serve":
+        controller = SimController() if args.sim else AMC2500(port=args.serial_port)
+        controller.trace = args.verbose
+        controller.debug = args.verbose
+        if args.metrics:
+            controller.metrics = engrave_gcode.machine_metrics(args)
+        if args.adaptive_speed:
+            controller.speeds = engrave_gcode.machine_speeds(args)
+        queue = JobQueue(controller, args.metrics, args.metrics_format)
+        queue.start_threads()
+        server = DaemonServer(args.socket, queue)
+        print "Listening on %s" % args.socket
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(args.socket)
+        return
+
+    message = { "command" : args.command }
+    if args.command == "submit":
+        options = unknown + args.options # engrave_gcode options before the first file aren't known here
+        message["options"] = _absolute_options([ o for o in options if o != "--" ])
+        message["hold"] = args.hold
+    elif getattr(args, "id", None) is not None:
+        message["id"] = args.id
+    try:
+        reply = request(args.socket, message)
+    except socket.error, err:
+        print "Can't talk to the daemon on %s: %s" % (args.socket, err)
+        sys.exit(1)
+    if "error" in reply:
+        print reply["error"]
+        sys.exit(1)
+    if args.command == "submit":
+        print "Queued job %d" % reply["id"]
+    elif args.command == "status":
+        _print_status(reply)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
-import argparse, sys, termios, tty, re, time, select
+import argparse, json, os, Queue, socket, sys, termios, threading, tty, re, time, select
 import gcode_parse, gcode_optimise
 
-from amc2500 import AMC2500, SimController
+from amc2500 import AMC2500, AMCError, Compiler, Metrics, HOMING_APPROACH, ModelController, SimController, SpeedLearner, MOVEABLE_WIDTH, MOVEABLE_HEIGHT, STEPS_PER_MM, plan_acceleration
+
+SPEED_FILE = os.path.expanduser("~/.amc2500_speeds.json")
+
+# Jogging from the keyboard (see JogEngine), all speeds in steps/second
+JOG_DIRECTIONS = { 'h' : (-1, 0), 'l' : (1, 0), 'j' : (0, 1), 'k' : (0, -1) }
+JOG_SPEEDS = [ 250, 500, 1000, 2000 ] # continuous jogging goes up a speed each JOG_RAMP_SECONDS
+JOG_RAMP_SECONDS = 0.5
+JOG_REPEAT_DELAY = 0.6 # seconds a keyboard waits before repeating a held key
+JOG_RELEASE = 0.1 # seconds without a repeat, once it's repeating, that mean a key's been let go
+JOG_MAX_NUDGES = 4 # nudges added up into one move, any more queued up are dropped
 
 parser = argparse.ArgumentParser(description='Engrave some gcode file(s) from the pcb2gcode package.')
 
@@ -16,20 +26,68 @@ group.add_argument('--no-spindle', action='store_true',
                     help='Testing option: keep the spindle motor off during the engraving pass.')
 group.add_argument('--head-up', action='store_true',
                     help='Testing option: keep the spindle head up during the engraving pass.')
+group.add_argument('--drill-commands', action='store_true',
+                    help="Experimental: send the PS & PR commands that the QuickCircuit software sends before drilling (see COMMANDS.)")
+group.add_argument('--plan-acceleration', action='store_true',
+                    help="Experimental: choose the acceleration (AT) for each move from its length and speed and those around it, instead of one setting for each speed.")
 group.add_argument('-n', '--no-jog', action='store_true',
                     help='Skip the "jog to find origin" step (use if the spindle head is already over the starting point.')
 
+group.add_argument('--report', action='store_true',
+                    help="Don't engrave anything, just run the job through a model of the controller and report the estimated time, serial traffic and size of the job.")
+group.add_argument('--report-json', metavar='FILE',
+                    help="As for --report, but also write the report to FILE as JSON.")
+
+group.add_argument('--journal', metavar='FILE',
+                    help="Home the engraver before starting, then keep a record in FILE of how far the job has got, so it can be continued with --resume if it's interrupted.")
+group.add_argument('--resume', action='store_true',
+                    help="Continue an interrupted job from where the --journal FILE says it got to. Give the same files and options as the first time.")
+group.add_argument('--home-approach', default=HOMING_APPROACH / STEPS_PER_MM, type=float,
+                    help="Distance to back off and approach the limits slowly from when homing for --journal or --resume (units mm, default %.1fmm.)" % (HOMING_APPROACH / STEPS_PER_MM))
+group.add_argument('--adaptive-speed', action='store_true',
+                    help="Home before and after the job to check for missed steps, speeding rapids up a little after each job that misses none and backing off when one does. What's learnt is kept in --speed-file for next time.")
+group.add_argument('--speed-file', metavar='FILE', default=SPEED_FILE,
+                    help="Where --adaptive-speed keeps the rapid speeds it has learnt for each engraver (default %s.)" % SPEED_FILE)
+
 group = parser.add_argument_group(title="Debugging")
 group.add_argument('-v', '--verbose', action='store_true',
                     help="Verbose mode (print every command the engraver executes to stderr.")
+group.add_argument('--metrics', metavar='FILE',
+                    help="Collect counters and latencies for the serial traffic and each operation while engraving, and export them to FILE as the job goes.")
+group.add_argument('--metrics-format', choices=[ "prometheus", "json" ], default="prometheus",
+                    help="Export metrics as a Prometheus text file, replaced each time, or append JSON lines (default prometheus.)")
+group.add_argument('--profile', action='store_true',
+                    help="Time each gcode command while engraving, and print the slowest source lines and kinds of command at the end.")
 
 group = parser.add_argument_group(title="GCode Optimisation")
 inner = group.add_mutually_exclusive_group()
-inner.add_argument('--max-deviation', default=0.025,
+inner.add_argument('--max-deviation', default=0.025, type=float,
                     help="Optimise out deviations from straight lines that are less than this much (units mm, default 0.025mm.)")
+group.add_argument('--drill-time', default=gcode_optimise.DRILL_OPTIMISE_TIME, type=float,
+                    help="Seconds to spend shortening the travel between each set of drill holes (default %.1fs, 0 for a quick nearest neighbour ordering only, which is always used with --journal or --resume.)" % gcode_optimise.DRILL_OPTIMISE_TIME)
+group.add_argument('--max-hop', default=gcode_optimise.MAX_HOP, type=float,
+                    help="Keep the head down when hopping between contours if the hop is no longer than this (units mm, default %.1fmm, 0 to always lift the head.)" % gcode_optimise.MAX_HOP)
+group.add_argument('--hop-clearance', default=gcode_optimise.HOP_CLEARANCE, type=float,
+                    help="Only keep the head down for hops which stay this close to toolpaths that are cut anyway (units mm, default %.3fmm.)" % gcode_optimise.HOP_CLEARANCE)
+group.add_argument('--passes', default=",".join(gcode_optimise.DEFAULT_PASSES),
+                    help="Comma separated list of optimiser passes to run, in order (default %s.)" % ",".join(gcode_optimise.DEFAULT_PASSES))
+group.add_argument('-j', '--jobs', default=1, type=int,
+                    help="Number of processes to optimise large programs with (default 1.)")
 inner.add_argument('--no-optimise', action='store_true',
                     help="Don't optimise the gcode at all, do exactly what it describes")
 
+group = parser.add_argument_group(title="Compiled Programs")
+group.add_argument('--compile', metavar='FILE',
+                    help="Don't engrave anything, just compile the gcode (with any optimisation, --head-up and --no-spindle) into a program of controller operations and save it in FILE.")
+group.add_argument('--program', metavar='FILE',
+                    help="Engrave a program saved with --compile, instead of gcode files.")
+
+group = parser.add_argument_group(title="Panels")
+group.add_argument('--panel', nargs=2, type=int, metavar=('ROWS', 'COLUMNS'),
+                    help="Engrave a panel of this many copies of the job, each one parsed and optimised once. Needs --pitch.")
+group.add_argument('--pitch', nargs=2, type=float, metavar=('X', 'Y'),
+                    help="Distance between the origins of the copies in a --panel (units mm.)")
+
 group = parser.add_argument_group(title="Files to Engrave")
 group.add_argument('files', nargs='*', help="Gcode files, which will be sent to the engraver in the order given. Insert the phrase TC by itself between any two files where you want a toolchange run.")
 
@@ -37,46 +95,108 @@ group.add_argument('files', nargs='*', help="Gcode files, which will be sent to
 def main():
     args = parser.parse_args()
 
-    if len(args.files) > 0:
-        print "Loading gcode..."
-    commands = [ ]
-    toolchange = False
-    for path in args.files:
-        if path == "TC":
-            toolchange = True
+    reports = None
+    if args.panel and not (args.pitch and args.files):
+        print "--panel needs gcode files and the --pitch between copies"
+        sys.exit(1)
+    if args.home_approach <= 0:
+        print "--home-approach must be more than 0mm"
+        sys.exit(1)
+    if args.hop_clearance <= 0:
+        print "--hop-clearance must be more than 0mm, use --max-hop 0 to always lift the head"
+        sys.exit(1)
+    if args.program:
+        if len(args.files) > 0 or args.panel:
+            print "Give either gcode files or a --program to engrave, not both"
+            sys.exit(1)
+        try:
+            total = sum(1 for op in load_program(args.program) if op[0] == "done")
+        except (IOError, ValueError), err:
+            print "Failed to load program %s: %s" % (args.program, err)
+            sys.exit(1)
+        progress = { "read" : 0, "total" : total }
+        program = load_program(args.program, progress)
+    else:
+        if len(args.files) > 0:
+            print "Loading gcode..."
+        try:
+            # parse everything once up front, to catch errors before starting and count the commands
+            counter = { "read" : 0 }
+            for c in load_commands(args.files, counter):
+                pass
+            total = counter["read"]
+        except gcode_parse.ParserException, err:
+            print "Failed to parse %s" % err
+            sys.exit(1)
+        progress = { "read" : 0, "total" : total }
+        commands = load_commands(args.files, progress)
+
+        if args.panel:
+            try:
+                program, reports = panel_program(args)
+            except ValueError, err:
+                print err
+                sys.exit(1)
+            copy_total = total
+            total = sum(1 for op in program if op[0] == "done")
+            progress = { "read" : total, "total" : total }
+            report = model_program(program)
+            print "Panel of %d copies is %.1fx%.1fmm" % ((args.panel[0] * args.panel[1],) + report["size"])
+            if not report["fits"]:
+                print "The panel doesn't fit in the %.0fx%.0fmm moveable area" % (MOVEABLE_WIDTH / STEPS_PER_MM, MOVEABLE_HEIGHT / STEPS_PER_MM)
+                sys.exit(1)
         else:
-            with open(path) as f:
+            if not args.no_optimise:
+                print "Gcode will be optimised ahead of the engraving as it goes."
                 try:
-                    commands.append({"name" : "message", "value" : "Starting gcode file %s" % path })
-                    if toolchange:
-                        commands += [ { "name" : "message", "value" : "Tool change requested on command line..." },
-                                      { "name" : "M6" }
-                                      ]
-                        toolchange = False
-                    commands += list(gcode_parse.parse(f.read()))
-                    commands.append({"name" : "message", "value" : "End of gcode file %s" % path })
-                except gcode_parse.ParserException, err:
-                    print "Failed to parse %s: %s" % (path, err)
+                    commands, reports = gcode_optimise.run_passes(commands, args.passes.split(","), _optimise_settings(args),
+                                                                  lazy=True, processes=args.jobs)
+                except ValueError, err:
+                    print err
                     sys.exit(1)
+            program = read_ahead(compile_program(commands, args))
 
-    if not args.no_optimise:
-        print "Optimising gcode..."
-        before = len(commands)
-        commands = gcode_optimise.optimise(commands, args.max_deviation)
-        print "(Before optimisation: %d commands. After optimisation: %d commands)" % (before, len(commands))
+    if args.compile:
+        count = save_program(program, args.compile)
+        print "Compiled %d commands into %s" % (count, args.compile)
+        if reports is not None:
+            _print_pass_reports(reports)
+        return
+
+    if args.report or args.report_json:
+        report_job(program, args, progress, reports)
+        return
+
+    resume = None
+    if args.resume:
+        if not args.journal:
+            print "--resume needs the --journal file from the interrupted job"
+            sys.exit(1)
+        try:
+            resume = Journal.load(args.journal)
+        except (IOError, ValueError), err:
+            print "Can't resume from journal %s: %s" % (args.journal, err)
+            sys.exit(1)
 
     print "Connecting to AMC controller..."
     controller = SimController() if args.sim else AMC2500(port=args.serial_port)
     controller.trace = args.verbose
     controller.debug = args.verbose
+    if args.metrics:
+        controller.metrics = machine_metrics(args)
+    if args.adaptive_speed:
+        controller.speeds = machine_speeds(args)
 
-    if not args.no_jog:
+    if not args.no_jog and not resume:
         if len(args.files) > 0:
             print "Jog the controller to set up the initial pass. When done, tool should be over the origin point."
         jog_controller(controller)
-    if len(args.files) == 0:
+    if len(args.files) == 0 and not args.program:
         return
-    print "Ready to start. Controller should be above origin of design."
+    if resume:
+        print "Ready to resume from command %d. The controller will home itself, then go back to where it got to." % resume[1]["index"]
+    else:
+        print "Ready to start. Controller should be above origin of design."
     print "This is %s." % ("a simulated run only" if args.sim else
                            "just a dry run (head up, no spindle.)" if (args.head_up and args.no_spindle) else
                            "a run with the engraving head up" if args.head_up else
@@ -86,34 +206,513 @@ def main():
     go = ""
     while go != "GO":
         go = raw_input("Type GO and press enter to start the engraving pass... ")
-    engrave(controller, commands, args)
+    args.dry_run = False
+    journal = None
+    if resume:
+        zero, record = resume
+        return_to_zero(controller, zero, int(args.home_approach * STEPS_PER_MM))
+        journal = Journal(args.journal, zero, record)
+    elif args.journal:
+        journal = Journal(args.journal, find_zero(controller, int(args.home_approach * STEPS_PER_MM)))
+    if controller.corner is None: # nothing to check against after the job
+        check_speeds(controller, int(args.home_approach * STEPS_PER_MM))
+    engrave(controller, program, args, progress, journal, resume and resume[1])
+    check_speeds(controller, int(args.home_approach * STEPS_PER_MM))
+    if reports is not None and all("time" in r for r in reports): # not if the job was stopped early
+        if args.panel: # all but the drills pass ran on one copy
+            removed = sum(r["commands_removed"] for r in reports if r["name"] != "drills")
+            print "(Before optimisation: %d commands a copy. After optimisation: %d commands a copy)" % (
+                copy_total, copy_total - removed)
+        else:
+            removed = sum(r["commands_removed"] for r in reports)
+            print "(Before optimisation: %d commands. After optimisation: %d commands)" % (total, total - removed)
+        _print_pass_reports(reports)
+
+
+def report_job(program, args, progress=None, pass_reports=None):
+    """ Dry run a program through a ModelController and print what it would take """
+    controller = ModelController()
+    controller.ramps = args.plan_acceleration
+    args.dry_run = True
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w") # the controller & engrave chat about every move
+    try:
+        engrave(controller, program, args, progress)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    report = controller.report()
+    if args.report_json:
+        with open(args.report_json, "w") as f:
+            json.dump(dict(report, passes=pass_reports or []), f, indent=2, sort_keys=True)
+    print "Estimated time %s (cutting %s, rapids %s, waiting %s, serial %s)" % tuple(
+        _duration(report[key]) for key in [ "seconds", "cut_seconds", "rapid_seconds", "wait_seconds", "serial_seconds" ])
+    print "Cutting %.0fmm, rapids %.0fmm" % (report["cut_distance"], report["rapid_distance"])
+    print "%(head_lifts)d head lifts, %(spindle_changes)d spindle changes, %(speed_changes)d speed changes, %(accel_changes)d acceleration changes" % report
+    print "%(serial_commands)d serial commands, %(serial_bytes)d bytes" % report
+    print "Job covers %.1f,%.1f to %.1f,%.1fmm from the origin" % report["bounds"]
+    print "Job size %.1fx%.1fmm, %s the %.0fx%.0fmm moveable area" % (report["size"] + (
+        "fits in" if report["fits"] else "DOES NOT FIT in", MOVEABLE_WIDTH / STEPS_PER_MM, MOVEABLE_HEIGHT / STEPS_PER_MM))
+    if pass_reports is not None:
+        _print_pass_reports(pass_reports)
 
+def model_program(program):
+    """ Run a program (a list) through a ModelController, returning its report """
+    controller = ModelController()
+    for op in program:
+        if op[0] not in ("done", "message", "tool_change"):
+            controller.run(op)
+    return controller.report()
 
-def _grabkey(wait_for_key):
-    """ Grab a key from stdin once one is available, but also clear any pending keyboard
-    buffer to defeat keyboard repeat rate backing them up
+def machine_metrics(args):
+    """ Return a Metrics labelled with which engraver this is """
+    return Metrics({ "host" : socket.gethostname(), "port" : "sim" if args.sim else args.serial_port })
 
-    In the case many characters are waiting in the stdin keyboard buffer, the last pressed
-    key is returned
+def machine_speeds(args):
+    """ Return a SpeedLearner for this engraver's entry in the speed file """
+    return SpeedLearner(args.speed_file, "%s:%s" % (socket.gethostname(), "sim" if args.sim else args.serial_port))
+
+def export_metrics(metrics, path, format):
+    """ Write metrics to path, either replacing a Prometheus text file
+    (atomically, for a scraper which may read it at any time) or appending
+    a JSON line """
+    if format == "json":
+        with open(path, "a") as f:
+            f.write(json.dumps(metrics.snapshot(), sort_keys=True) + "\n")
+    else:
+        with open(path + ".tmp", "w") as f:
+            f.write(metrics.prometheus())
+        os.rename(path + ".tmp", path)
+
+def _duration(seconds):
+    return "%dh%02dm%02ds" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+class Journal:
     """
-    old_settings = termios.tcgetattr(sys.stdin)
-    tty.setcbreak(sys.stdin.fileno(), termios.TCSANOW)
+    Append-only record of how far a job has got, so it can be resumed.
+
+    The first line has the position of the job's zero point relative to
+    the engraver's home corner, then there's a line after each command
+    with the number of commands done so far and the controller's state.
+    (The rest of the state comes from compiling the commands again.)
+    Each line is flushed so it survives the process being killed. Every
+    JOURNAL_ROTATE commands the file is replaced with just the latest line.
+    """
+    def __init__(self, path, zero, record=None):
+        self.path = path
+        self.zero = zero
+        self.count = 0
+        self._rewrite(record)
+
+    @staticmethod
+    def load(path):
+        """ Return (zero, last record) from the journal at path """
+        with open(path) as f:
+            lines = f.readlines()
+        zero = json.loads(lines[0])["zero"]
+        for line in reversed(lines[1:]):
+            if line.endswith("\n"): # anything after the last newline was cut short
+                return zero, json.loads(line)
+        raise ValueError("no commands were finished")
+
+    def record(self, index, name, line, controller):
+        state = controller.state
+        record = { "index" : index,
+                   "command" : [ name, line ],
+                   "pos" : state.pos,
+                   "speed" : state.cur_step_speed,
+                   "spindle_speed" : state.spindle_speed,
+                   "spindle_on" : state.spindle_on,
+                   "head_down" : state.head_down }
+        self.count += 1
+        if self.count >= JOURNAL_ROTATE:
+            self._rewrite(record)
+        else:
+            self._write(record)
+
+    def close(self, finished):
+        """ Close the journal, removing it if the job is finished """
+        self.f.close()
+        if finished:
+            os.remove(self.path)
+
+    def _write(self, record):
+        self.f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.f.flush()
+
+    def _rewrite(self, record):
+        """ Replace the journal with just the zero point & record (if any) """
+        if getattr(self, "f", None) is not None:
+            self.f.close()
+        with open(self.path + ".tmp", "w") as f:
+            f.write(json.dumps({ "zero" : self.zero }) + "\n")
+            if record is not None:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.rename(self.path + ".tmp", self.path) # so there's always a whole journal
+        self.f = open(self.path, "a")
+        self.count = 0
+
+# Commands between rewrites of the journal, to keep it small
+JOURNAL_ROTATE = 10000
+
+def find_zero(controller, approach=HOMING_APPROACH, message="Homing to record the starting point..."):
+    """ Home the controller and come back, returning the current position
+    relative to the home corner (in steps) """
+    controller.save_state()
+    controller.set_units_steps()
+    origin = controller.state.pos
+    print message
+    _print_homing(controller.find_corner(-1, -1, approach=approach))
+    corner = controller.state.pos
+    controller.set_max_speed()
+    controller.move_to(*origin)
+    controller.restore_state()
+    return (origin[0] - corner[0], origin[1] - corner[1])
+
+def check_speeds(controller, approach=HOMING_APPROACH):
+    """ Home the controller and come back, so its SpeedLearner can see if
+    any steps were missed since it last homed """
+    if controller.speeds is not None:
+        find_zero(controller, approach, "Homing to check for missed steps...")
+
+def return_to_zero(controller, zero, approach=HOMING_APPROACH):
+    """ Home the controller then go to zero (steps from the home corner) and zero there """
+    print "Homing to find the starting point again..."
+    _print_homing(controller.find_corner(-1, -1, True, approach))
+    controller.save_state()
+    controller.set_units_steps()
+    controller.set_max_speed()
+    controller.move_to(*zero)
+    controller.restore_state()
+    controller.zero_here()
+
+def _print_homing(result):
+    if result["error"] is None:
+        print "Homed in %.1fs" % result["seconds"]
+    else:
+        print "Homed in %.1fs, the corner was %d,%d steps from where it was last found" % ((result["seconds"],) + result["error"])
+
+def _restore_state(controller, args, record):
+    """ Put the controller back into the state saved in a journal record """
+    controller.set_head_down(False)
+    controller.set_units_steps()
+    controller.set_max_speed()
+    controller.move_to(*record["pos"])
+    controller.set_speed(record["speed"])
+    controller.set_spindle_speed(record["spindle_speed"])
+    controller.set_spindle_on(record["spindle_on"] and not args.no_spindle)
+    controller.set_head_down(record["head_down"] and not args.head_up)
+
+FILE_MESSAGE = "Starting gcode file %s"
+
+def load_commands(paths, progress=None):
+    """ Generator for all of the commands in the gcode files named in paths,
+    with messages and tool changes (for TC in paths) in between
+
+    If a progress dict is passed, its "read" count is updated as commands are read
+    """
+    toolchange = False
+    for path in paths:
+        if path == "TC":
+            toolchange = True
+            continue
+        with open(path) as f:
+            yield {"name" : "message", "value" : FILE_MESSAGE % path }
+            if toolchange:
+                yield { "name" : "message", "value" : "Tool change requested on command line..." }
+                yield { "name" : "M6" }
+                toolchange = False
+            try:
+                for c in gcode_parse.parse(f):
+                    if progress is not None:
+                        progress["read"] += 1
+                    yield c
+            except gcode_parse.ParserException, err:
+                raise gcode_parse.ParserException("%s: %s" % (path, err))
+            yield {"name" : "message", "value" : "End of gcode file %s" % path }
+
+
+def panel_program(args):
+    """ Load the gcode files, optimise them once and repeat them across
+    args.panel copies, args.pitch apart. Drills are ordered once the panel
+    is laid out, so the order covers the whole panel.
+
+    Returns the compiled program (a list) and the optimiser's pass reports,
+    which are for one copy except for the drills pass
+    """
+    commands = list(load_commands(args.files))
+    passes = [] if args.no_optimise else args.passes.split(",")
+    settings = _optimise_settings(args)
+    reports = []
+    copy_passes = [ name for name in passes if name != "drills" ]
+    if copy_passes:
+        commands, reports = gcode_optimise.run_passes(commands, copy_passes, settings, processes=args.jobs)
+    commands = gcode_optimise.panelise(commands, args.panel[0], args.panel[1], args.pitch)
+    if "drills" in passes:
+        commands, drill_reports = gcode_optimise.run_passes(commands, [ "drills" ], settings)
+        reports += drill_reports
+    return list(compile_program(commands, args)), reports
+
+def _optimise_settings(args):
+    """ Settings for gcode_optimise.run_passes from the command line
+
+    A job that may be resumed has to come out the same every time, so it
+    only gets the nearest neighbour drill ordering, which doesn't depend
+    on how long the 2-opt search gets to run.
+    """
+    resumable = args.journal or args.resume
+    return dict(gcode_optimise.DEFAULT_SETTINGS,
+                max_deviation=args.max_deviation,
+                drill_time=0 if resumable else args.drill_time,
+                max_hop=args.max_hop,
+                hop_clearance=args.hop_clearance)
+
+def _print_pass_reports(reports):
+    print "%-12s %8s %9s %12s %12s" % ("Pass", "Time", "Removed", "Rapid saved", "Est. saved")
+    for r in reports:
+        print "%-12s %7.2fs %9d %10.1fmm %11.1fs" % (r["name"], r["time"], r["commands_removed"],
+                                                    r["rapid_saved"], r["seconds_saved"])
+        if r["stats"]:
+            print "%-12s %s" % ("", ", ".join("%s %s" % (k.replace("_", " "), v) for k,v in sorted(r["stats"].items())))
+
+class KeyMonitor:
+    """ Watch the keyboard from a background thread while a job runs, so
+    the engrave loop only has to check a flag to see if a key was pressed.
+
+    The terminal stays in cbreak mode from start() until stop(). Nothing
+    is watched if stdin isn't a terminal.
+
+    If a keys queue is passed, every key is also put on it along with
+    the time it was typed, for a JogEngine.
+    """
+    def __init__(self, stream=sys.stdin, keys=None):
+        self.stream = stream
+        self.keys = keys
+        self.key = None
+        self._pressed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._old_settings = None
+
+    def start(self):
+        if self._thread is not None or not self.stream.isatty():
+            return
+        self._old_settings = termios.tcgetattr(self.stream)
+        tty.setcbreak(self.stream.fileno(), termios.TCSANOW)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        termios.tcsetattr(self.stream, termios.TCSADRAIN, self._old_settings)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            if select.select([self.stream], [], [], 0.1)[0]:
+                # unbuffered, so select still sees anything typed after this
+                self.key = os.read(self.stream.fileno(), 1)
+                if self.keys is not None:
+                    self.keys.put((self.key, time.time()))
+                self._pressed.set()
+
+    def pressed(self):
+        """ Return the last key pressed since this was last called, or None """
+        if not self._pressed.is_set():
+            return None
+        self._pressed.clear()
+        return self.key
+
+    def wait(self):
+        """ Wait for the next key press and return it """
+        self._pressed.clear()
+        while not self._pressed.wait(0.5): # a timeout keeps Ctrl-C working
+            pass
+        self._pressed.clear()
+        return self.key
+
+class JogEngine:
+    """ Jog the controller from keys typed (see jog_controller), on its own
+    thread so keys keep coming in while the controller is busy.
+
+    Keys come from the keys queue as (key, time typed), from a KeyMonitor.
+    Nudges typed while the head is still moving are added up into one
+    move. A terminal can't tell when a key is let go, so a capital is held
+    down for as long as it keeps repeating: jogging starts at the first
+    of JOG_SPEEDS, speeds up while the key's held, and stops when the
+    repeats do.
+    """
+    def __init__(self, controller, keys, monitor=None):
+        self.controller = controller
+        self.keys = keys
+        self.monitor = monitor # stopped while asking for the isolation width
+        self.nudge = pow(2,5)
+        self.error = None # sys.exc_info() for anything that went wrong on the thread
+        self._saved_nudge = None
+        self._jog = None # while jogging, dict of the key held, when it started & was last seen, and the speed
+        self._waiting = [] # keys taken off the queue while adding up nudges, still to do
+        self._finished = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._finished.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop handling keys, waiting for anything the controller's doing to finish """
+        if self._thread is None:
+            return
+        self._finished.set()
+        self._thread.join()
+        self._thread = None
+
+    def wait(self):
+        """ Wait until ! is typed, raising anything that went wrong on the thread """
+        while not self._finished.wait(0.5): # a timeout keeps Ctrl-C working
+            pass
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _run(self):
+        try:
+            while not self._finished.is_set():
+                key = self._next_key()
+                if key is not None:
+                    self._key(*key)
+                self._check_jog()
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            try:
+                if self.controller.jogging:
+                    self.controller.stop_jog()
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()
+            self._finished.set()
+
+    def _next_key(self):
+        if self._waiting:
+            return self._waiting.pop(0)
+        try:
+            return self.keys.get(True, 0.02 if self._jog is not None else 0.1)
+        except Queue.Empty:
+            return None
+
+    def _key(self, key, typed):
+        controller = self.controller
+        c = key.lower()
+        if self._jog is not None:
+            if key == self._jog["key"]: # still held
+                self._jog["seen"] = typed
+                self._jog["repeating"] = True
+            else: # any other key stops jogging, and that's all it does
+                self._stop_jog()
+            return
+        if c in JOG_DIRECTIONS:
+            if key == c:
+                self._nudge(key)
+            else:
+                controller.jog(*(JOG_DIRECTIONS[c] + (JOG_SPEEDS[0],)))
+                self._jog = { "key" : key, "started" : typed, "seen" : typed, "repeating" : False, "speed" : 0 }
+        elif re.match("[0-9]", c):
+            self.nudge = pow(2,ord(c) - ord("0"))
+        elif c == "d":
+            self._saved_nudge = self.nudge
+            self.nudge = 0
+            controller.set_head_down(True)
+        elif c == "u" and self._saved_nudge is not None:
+            controller.set_head_down(False)
+            self.nudge = self._saved_nudge
+            self._saved_nudge = None
+        elif c == "s":
+            controller.set_spindle_on(not controller.get_spindle_on())
+        elif c in [ 'q','w','e','r','t','y' ]:
+            controller.set_spindle_speed({ 'q':10, 'w':20, 'e':40, 'r':60, 't':80, 'y':99 }[c])
+        elif c == "i":
+            if self.monitor is not None:
+                self.monitor.stop() # let raw_input have the keyboard
+            try:
+                _isolation_test(controller)
+            finally:
+                if self.monitor is not None:
+                    self.monitor.start()
+        elif c == "!":
+            self._finished.set()
+
+    def _nudge(self, key):
+        """ Nudge the head, along with any more nudges already typed """
+        (dx, dy) = JOG_DIRECTIONS[key]
+        count = 1
+        while True:
+            try:
+                (key, typed) = self.keys.get_nowait()
+            except Queue.Empty:
+                break
+            if key not in JOG_DIRECTIONS:
+                self._waiting.append((key, typed))
+                break
+            if count < JOG_MAX_NUDGES: # any more are a held key running on
+                dx += JOG_DIRECTIONS[key][0]
+                dy += JOG_DIRECTIONS[key][1]
+                count += 1
+        self.controller.move_by(dx * self.nudge, dy * self.nudge)
+
+    def _check_jog(self):
+        """ Stop jogging if the key's been let go, or speed up if it's still held """
+        if self._jog is None:
+            return
+        now = time.time()
+        if now - self._jog["seen"] > (JOG_RELEASE if self._jog["repeating"] else JOG_REPEAT_DELAY):
+            self._stop_jog()
+            return
+        speed = min(int((now - self._jog["started"]) / JOG_RAMP_SECONDS), len(JOG_SPEEDS) - 1)
+        if speed != self._jog["speed"]:
+            self.controller.set_jog_speed(JOG_SPEEDS[speed])
+            self._jog["speed"] = speed
+
+    def _stop_jog(self):
+        self._jog = None
+        self.controller.stop_jog()
+
+def _isolation_test(controller):
+    width = raw_input("Enter the isolation width to test in mm (engraver will make two parallel 15mm lines this far apart.)\n> ")
     try:
-        # call to select indicates if there is anything ready in stdin
-        #
-        # for wait_for_key, first call has timeout == None so blocks until something is ready,
-        # other calls have timeout == 0 so only poll for more characters buffered
-        timeout = None if wait_for_key else 0
-        result = None
-        while len(select.select([sys.stdin], [], [], timeout)[0]) > 0:
-            result = sys.stdin.read(1)
-            timeout = 0
-        return result
-    finally:
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
+        width = float(width)
+        if width <= 0 or width > 10:
+            raise ValueError()
+        controller.save_state()
+        try:
+            controller.set_units_mm()
+            controller.set_speed(4) # 4mm/sec for test pass
+            controller.set_spindle_on(True)
+            controller.set_head_down(True)
+            controller.move_by(15, 0)
+            controller.set_head_down(False)
+            controller.move_by(0,width)
+            controller.set_head_down(True)
+            controller.move_by(-15, 0)
+            controller.set_head_down(False)
+            controller.set_spindle_on(False)
+            controller.move_by(0,-width)
+        finally:
+            controller.restore_state()
+        print "Finished the isolation width test"
+    except ValueError:
+        print "Invalid isolation width, going back to jogging..."
 
 def jog_controller(controller):
-    print "HJKL (capitals) to start continuous jog in a direction, any key to stop jogging."
+    if not sys.stdin.isatty():
+        print "Can't jog the controller without a terminal to type in (use -n to skip jogging.)"
+        sys.exit(1)
+    print "Hold HJKL (capitals) to jog continuously in a direction, faster the longer it's held. Let go or press any other key to stop."
     print "hjkl (no capitals) to nudge the head around in a direction."
     print "0-9 to set the number of steps to nudge by (0 for 1 step, 1 for 2 steps, 9 for 512 steps.)"
     print "D/U to move head Down/Up to check position or cut depth."
@@ -123,99 +722,47 @@ def jog_controller(controller):
     print "Type ! when you're done"
     print
 
-    speed = pow(2,5)
-    saved_speed = None
-    jogging = False
     controller.set_head_down(False)
     controller.set_spindle_on(False)
     controller.save_state()
     controller.set_units_steps()
+    keys = Queue.Queue()
+    monitor = KeyMonitor(keys=keys)
+    engine = JogEngine(controller, keys, monitor)
+    monitor.start()
+    engine.start()
     try:
-        while True:
-            rc = _grabkey(True)
-            c = rc.lower()
-            if c == 'j':
-                if rc == 'j':
-                    controller.move_by(0,speed)
-                else:
-                    controller.jog(0,1)
-                    jogging = True
-            elif c == 'k':
-                if rc == 'k':
-                    controller.move_by(0, -speed)
-                else:
-                    controller.jog(0,-1)
-                    jogging = True
-            elif c == 'h':
-                if rc == 'h':
-                    controller.move_by(-speed,0)
-                else:
-                    controller.jog(-1,0)
-                    jogging = True
-            elif c == 'l':
-                if rc == 'l':
-                    controller.move_by(speed,0)
-                else:
-                    controller.jog(1,0)
-                    jogging = True
-            elif re.match("[0-9]", c):
-                speed = pow(2,ord(c) - ord("0"))
-            elif c == "d":
-                saved_speed = speed
-                speed = 0
-                controller.set_head_down(True)
-            elif c == "u" and saved_speed is not None:
-                controller.set_head_down(False)
-                speed = saved_speed
-                saved_speed = None
-            elif c == "s":
-                controller.set_spindle_on(not controller.get_spindle_on())
-            elif c in [ 'q','w','e','r','t','y' ]:
-                speed = { 'q':10, 'w':20, 'e':40, 'r':60, 't':80, 'y':99 }[c]
-                controller.set_spindle_speed(speed)
-            elif c == "i":
-                width = raw_input("Enter the isolation width to test in mm (engraver will make two parallel 15mm lines this far apart.)\n> ")
-                try:
-                    width = float(width)
-                    if width <= 0 or width > 10:
-                        raise ValueError()
-                    controller.save_state()
-                    try:
-                        controller.set_units_mm()
-                        controller.set_speed(4) # 4mm/sec for test pass
-                        controller.set_spindle_on(True)
-                        controller.set_head_down(True)
-                        controller.move_by(15, 0)
-                        controller.set_head_down(False)
-                        controller.move_by(0,width)
-                        controller.set_head_down(True)
-                        controller.move_by(-15, 0)
-                        controller.set_head_down(False)
-                        controller.set_spindle_on(False)
-                        controller.move_by(0,-width)
-                    finally:
-                        controller.restore_state()
-                    print "Finished the isolation width test"
-                except ValueError:
-                    print "Invalid isolation width, going back to jogging..."
-            elif c == "!":
-                return
-            if jogging:
-                _grabkey(True)
-                controller.stop_jog()
-                jogging = False
+        engine.wait()
     except KeyboardInterrupt:
+        engine.stop()
         controller.set_head_down(False)
         controller.set_spindle_on(False)
         sys.exit(1)
     finally:
+        engine.stop()
+        monitor.stop()
         controller.restore_state()
 
-def engrave(controller, commands, args):
+def compile_program(commands, args):
+    """ Compile commands (any iterable) into a program of operations for
+    AMC2500.run, using an amc2500.Compiler. Returns a generator
+
+    A ("done", name, line) operation follows the operations for each
+    command. The ("message", text) and ("tool_change",) operations are
+    for engrave to deal with. With --plan-acceleration the program sets
+    the AT for each move (see amc2500.plan_acceleration.)
+    """
+    program = _compile_commands(commands, args)
+    if args.plan_acceleration:
+        return plan_acceleration(program)
+    return program
+
+def _compile_commands(commands, args):
+    """ Generator for the operations of compile_program """
+    controller = Compiler()
     controller.zero_here()
     controller.set_units_mm()
-    current = 0
-    args.absolute = False
+    modes = { "absolute" : False, "drilling" : False }
 
     def linear_move(c):
         """G00, G01"""
@@ -228,7 +775,7 @@ def engrave(controller, commands, args):
             controller.save_state()
             controller.set_max_speed()
         try:
-            if args.absolute:
+            if modes["absolute"]:
                 controller.move_to(c["X"], c["Y"])
             else:
                 controller.move_by(c["X"], c["Y"])
@@ -237,6 +784,20 @@ def engrave(controller, commands, args):
         if is_fast:
             controller.restore_state()
 
+    def arc_move(c):
+        """G02, G03"""
+        if "F" in c:
+            controller.set_speed(float(c["F"])/60) # mm/min to mm/sec
+        if "Z" in c:
+            controller.set_head_down(c["Z"] < 0 and not args.head_up)
+        cw = c["name"] == "G2"
+        if modes["absolute"]:
+            # I,J are always relative to the start point
+            (x, y) = controller.get_pos()
+            controller.arc_to(c["X"], c["Y"], x + c.get("I",0), y + c.get("J",0), cw)
+        else:
+            controller.arc_by(c["X"], c["Y"], c.get("I",0), c.get("J",0), cw)
+
     def set_spindle_speed(c):
         """Sxxxxxxx"""
         rpm = c["S"]
@@ -246,7 +807,7 @@ def engrave(controller, commands, args):
 
     def finish_program(c):
         """M2"""
-        print "Program End!"
+        message({ "value" : "Program End!" })
         controller.set_head_down(False)
         controller.set_spindle_on(False)
         controller.set_max_speed()
@@ -254,57 +815,51 @@ def engrave(controller, commands, args):
 
     def tool_change(c):
         """M6"""
-        # move to the toolchange position
         controller.set_head_down(False)
         controller.set_spindle_on(False)
-        controller.save_state()
-        controller.set_units_mm()
-        controller.set_max_speed()
-        while controller.move_by(-200,0) == (-200,0):
-            pass # drive the controller to the toolchange position, 200mm at a time
-        while controller.move_by(0,-200) == (0,-200):
-            pass
-
-        print "Perform the tool change, jog the head around if necessary to make depth test cut(s)"
-        print "When you're done the controller will automatically return to the correct position"
-        jog_controller(controller)
-
-        # go back to where we were
-        controller.restore_state(True)
+        controller.program.append(("tool_change",)) # engrave does the rest, it comes back to the same place
 
     def drill_cycle(c):
         """G81/G82"""
-        controller.set_head_down(False)
-
-        # preliminary move
-        controller.save_state()
-        controller.set_max_speed() # may be too fast, check for skipped steps
-        if args.absolute:
+        if not modes["drilling"]: # rapid speed stays set for a whole run of drill cycles
+            controller.set_head_down(False)
+            controller.save_state()
+            controller.set_max_speed() # may be too fast, check for skipped steps
+            if args.drill_commands:
+                controller.setup_drilling()
+            modes["drilling"] = True
+        if modes["absolute"]:
             controller.move_to(c["X"],c["Y"])
         else:
             controller.move_by(c["X"],c["Y"])
-        controller.restore_state()
 
         # drillify!
-        controller.set_head_down(not args.head_up)
-        time.sleep(c.get("P",1.2)) # should maybe use R & Z here to calculate a dwell period for G81... ???
+        seconds = gcode_optimise.drill_dwell(c, controller.state.steps_per_unit == STEPS_PER_MM)
+        if args.head_up:
+            controller.dwell(seconds)
+        else:
+            controller.drill(seconds)
 
-        # done
-        controller.set_head_down(False)
+    def end_drilling():
+        if modes["drilling"]:
+            controller.restore_state()
+            modes["drilling"] = False
 
     def ignore(c):
         pass
 
     def message(c):
-        print c["value"]
+        controller.program.append(("message", c["value"]))
 
     def set_absolute(to):
-        args.absolute = to
+        modes["absolute"] = to
 
     ACTIONS = {
         "G0" : linear_move,
         "G1" : linear_move,
-        "G4" : lambda c: time.sleep(c.get("P",0)),
+        "G2" : arc_move,
+        "G3" : arc_move,
+        "G4" : lambda c: controller.dwell(c.get("P",0)),
         "G20" : lambda c: controller.set_units_inches(),
         "G21" : lambda c: controller.set_units_mm(),
         "G64" : ignore, # max deviation, ignore for now
@@ -324,30 +879,283 @@ def engrave(controller, commands, args):
         }
 
     for c in commands:
-        if args.verbose:
-            sys.stderr.write("%s\n" % c)
+        if c["name"] not in ("G81", "G82", "comment"):
+            end_drilling()
         try:
             ACTIONS[c["name"]](c)
-            if _grabkey(False):
-                print "Pausing! To quit right now, press Ctrl-C"
-                print "To return head to origin and -then- quit, press Q."
-                print "Pressing any other key will resume"
-                key = _grabkey(True).lower()
-                if key == 'q':
-                    break
-        except KeyboardInterrupt:
-            controller.set_head_down(False)
-            controller.set_spindle_on(False)
-            sys.exit(1)
         except KeyError:
-            print "Ignoring unexpected command %s (line %d)" % (c["name"], c["line"])
-        current += 1
-        print "Command %d/%d" % (current, len(commands))
+            message({ "value" : "Ignoring unexpected command %s (line %d)" % (c["name"], c["line"]) })
+        controller.program.append(("done", c["name"], c.get("line")))
+        for op in controller.program:
+            yield op
+        del controller.program[:]
+    end_drilling()
+    for op in controller.program:
+        yield op
+
+def save_program(program, path):
+    """ Write a compiled program to path, one JSON operation per line. Returns the number of commands in it """
+    count = 0
+    with open(path, "w") as f:
+        for op in program:
+            f.write(json.dumps(op) + "\n")
+            if op[0] == "done":
+                count += 1
+    return count
+
+def load_program(path, progress=None):
+    """ Generator for the operations in a program written by save_program
+
+    If a progress dict is passed, its "read" count is updated as commands are read
+    """
+    with open(path) as f:
+        for line in f:
+            op = tuple(json.loads(line))
+            if op[0] == "done" and progress is not None:
+                progress["read"] += 1
+            yield op
+
+# Operations read_ahead keeps ready, enough for a minute or more of engraving
+READ_AHEAD = 10000
+
+def read_ahead(program, size=READ_AHEAD):
+    """ Return a generator for the operations of a lazy program, which are
+    produced on another thread up to size operations ahead, starting now.
+    Parsing and optimising then happen while the controller is busy (or
+    the head is being jogged into place), instead of holding the machine
+    up mid job. Anything raised producing the program is raised by the
+    generator. """
+    ops = Queue.Queue(size)
+    stopped = threading.Event()
+    error = []
+    def put(op):
+        """ Wait for room for op, returning False if the reader has stopped """
+        while not stopped.is_set():
+            try:
+                ops.put(op, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for op in program:
+                if not put(op):
+                    return
+        except Exception:
+            error.append(sys.exc_info())
+        put(None)
+    def read():
+        try:
+            while True:
+                try:
+                    op = ops.get(True, 0.5) # a timeout keeps Ctrl-C working
+                except Queue.Empty:
+                    continue
+                if op is None:
+                    break
+                yield op
+            if error:
+                raise error[0][0], error[0][1], error[0][2]
+        finally:
+            stopped.set()
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start() # now, not when the job starts
+    return read()
+
+def tool_change(controller, monitor, jog=None):
+    """ Move to the toolchange position and let the user jog around, then go back to where we were
+
+    If a jog function is passed, it's called instead of jogging from the keyboard.
+    """
+    controller.set_head_down(False)
+    controller.set_spindle_on(False)
+    controller.save_state()
+    controller.move_to_corner() # the toolchange position
+
+    if jog is not None:
+        jog()
+    else:
+        print "Perform the tool change, jog the head around if necessary to make depth test cut(s)"
+        print "When you're done the controller will automatically return to the correct position"
+        monitor.stop() # jogging reads the keyboard itself
+        jog_controller(controller)
+        monitor.start()
+
+    # go back to where we were
+    controller.restore_state(True)
+
+# Seconds between progress messages while engraving
+PROGRESS_INTERVAL = 1.0
+
+# Number of source lines and kinds of command in a profile report
+PROFILE_TOP = 10
+
+class Profile:
+    """
+    Wall time spent on each gcode command while engraving, from the time
+    the previous command was done to the time it's done. That covers
+    compiling it (or waiting for read_ahead to read and optimise it, for
+    lazy programs) as well as running its operations on the controller.
+    """
+    def __init__(self):
+        self.lines = {} # (file, line, name) -> [ seconds, count ]
+        self.kinds = {} # name -> [ seconds, count ]
+        self.file = None
+        self.last = time.time()
+
+    def message(self, text):
+        """ Keep track of which file the lines are from """
+        if text.startswith(FILE_MESSAGE % ""):
+            self.file = text[len(FILE_MESSAGE % ""):]
+
+    def done(self, name, line):
+        now = time.time()
+        for totals, key in (self.lines, (self.file, line, name)), (self.kinds, name):
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = [ 0.0, 0 ]
+            total[0] += now - self.last
+            total[1] += 1
+        self.last = now
+
+    def skip(self):
+        """ Don't count the time since the last command (ie waiting for the user) """
+        self.last = time.time()
+
+    def report(self, top=PROFILE_TOP):
+        print "Slowest gcode lines:"
+        print "  %-30s %-8s %9s %6s" % ("Line", "Kind", "Time", "Count")
+        for (path, line, name), (seconds, count) in sorted(self.lines.items(), key=lambda i: -i[1][0])[:top]:
+            line = "-" if line is None else line
+            where = "%s:%s" % (os.path.basename(path), line) if path else str(line)
+            print "  %-30s %-8s %8.2fs %6d" % (where, name, seconds, count)
+        print "Slowest kinds of command:"
+        print "  %-8s %9s %6s %9s" % ("Kind", "Time", "Count", "Mean")
+        for name, (seconds, count) in sorted(self.kinds.items(), key=lambda i: -i[1][0])[:top]:
+            print "  %-8s %8.2fs %6d %8.4fs" % (name, seconds, count, seconds / count)
+
+def _print_progress(current, progress):
+    if progress is not None:
+        print "Command %d (%d/%d read)" % (current, progress["read"], progress["total"])
+    else:
+        print "Command %d" % current
+
+def engrave(controller, program, args, progress=None, journal=None, resume=None, jog=None, keyboard=True):
+    """ Engrave a program of operations from compile_program (or load_program).
+    Returns True if it got to the end, False if it was quit early
+
+    progress is a dict with the number of commands "read" from the files
+    so far and the "total", used to report progress for lazy iterables.
+    Its "done" count is updated as commands are done.
+
+    jog is passed on to tool_change for any tool changes. Unless keyboard
+    is False, keys typed pause the job (see KeyMonitor.)
+
+    If the controller is collecting metrics, each operation is timed and
+    they're exported to the args.metrics file along with the progress.
+    With args.profile, each command is timed (see Profile) and the
+    slowest are printed at the end.
+
+    If a Journal is passed, each command is recorded in it as it's done.
+    If a resume record from a journal is passed, the commands it had
+    finished are skipped and the controller state it had is restored.
+    """
+    controller.plan_acceleration = args.plan_acceleration
+    controller.zero_here()
+    current = 0
+    last_progress = 0
+    monitor = KeyMonitor()
+    skip = resume["index"] if resume is not None else 0
+    metrics = controller.metrics if args.metrics else None
+    profile = Profile() if args.profile and not args.dry_run else None
+
+    if keyboard and not args.dry_run:
+        monitor.start()
+    finished = False
+    try:
+        for op in program:
+            try:
+                if op[0] == "done":
+                    current += 1
+                    if progress is not None:
+                        progress["done"] = current
+                    if current <= skip:
+                        if current == skip: # done before the job was interrupted
+                            if [ op[1], op[2] ] != resume["command"]:
+                                print "Command %d is %s (line %s) but the journal says it was %s (line %s), has the job changed?" % (
+                                    current, op[1], op[2], resume["command"][0], resume["command"][1])
+                                print "(The files or options given must be the same as the first time.)"
+                                sys.exit(1)
+                            print "Skipped the %d commands already done, returning to the last position" % current
+                            _restore_state(controller, args, resume)
+                            if profile is not None:
+                                profile.skip()
+                        continue
+                    if profile is not None:
+                        profile.done(op[1], op[2])
+                    if args.verbose:
+                        sys.stderr.write("%s (line %s)\n" % (op[1], op[2]))
+                    if journal is not None:
+                        journal.record(current, op[1], op[2], controller)
+                    if monitor.pressed():
+                        print "Pausing! To quit right now, press Ctrl-C"
+                        print "To return head to origin and -then- quit, press Q."
+                        print "Pressing any other key will resume"
+                        key = monitor.wait().lower()
+                        if key == 'q':
+                            break
+                        if profile is not None:
+                            profile.skip()
+                    if metrics is not None:
+                        metrics.count("gcode_commands")
+                    if time.time() - last_progress >= PROGRESS_INTERVAL:
+                        _print_progress(current, progress)
+                        if metrics is not None:
+                            export_metrics(metrics, args.metrics, args.metrics_format)
+                        last_progress = time.time()
+                elif current < skip:
+                    pass
+                elif op[0] == "message":
+                    print op[1]
+                    if profile is not None:
+                        profile.message(op[1])
+                elif op[0] == "tool_change":
+                    if not args.dry_run:
+                        tool_change(controller, monitor, jog)
+                elif metrics is not None:
+                    start = time.time()
+                    controller.run(op)
+                    metrics.count("operations", op[0])
+                    metrics.observe("operation_seconds", op[0], time.time() - start)
+                else:
+                    controller.run(op)
+            except KeyboardInterrupt:
+                controller.set_head_down(False)
+                controller.set_spindle_on(False)
+                sys.exit(1)
+            except AMCError:
+                if journal is not None:
+                    print "Stopped after command %d, run again with --resume to continue from there" % current
+                raise
+        else:
+            finished = True
+        _print_progress(current, progress)
+    finally:
+        monitor.stop()
+        if journal is not None:
+            journal.close(finished)
+        if metrics is not None:
+            export_metrics(metrics, args.metrics, args.metrics_format)
 
     controller.set_max_speed()
     controller.set_head_down(False)
     controller.set_spindle_on(False)
     controller.move_to(0,0)
+    if profile is not None:
+        profile.report()
+    return finished
 
 if __name__ == "__main__":
     main()
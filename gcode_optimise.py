@@ -1,9 +1,32 @@
-import math
+import collections, heapq, math, multiprocessing, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 MM_PER_INCH = 25.4
 
-def optimise(commands, deviation_threshold):
-    return list(optimise_drills(optimise_deviation(commands, deviation_threshold)))
+# Most commands any pass holds back at once, so memory use stays flat for big programs
+WINDOW = 10000
+
+# Use the numpy kernels (if numpy is available) for runs of at least this many points,
+# shorter runs are quicker in pure Python. Set to None to always use pure Python.
+NUMPY_MIN_POINTS = 64 if numpy is not None else None
+
+def optimise(commands, deviation_threshold, drill_time=None, max_hop=None, hop_clearance=None, stats=None):
+    """ Run all of the default optimiser passes over commands, returning the optimised list
+
+    If a stats dict is passed, it's updated with the stats from optimise_feeds.
+    """
+    settings = dict(DEFAULT_SETTINGS, max_deviation=deviation_threshold)
+    for key, value in [ ("drill_time", drill_time), ("max_hop", max_hop), ("hop_clearance", hop_clearance) ]:
+        if value is not None:
+            settings[key] = value
+    commands, reports = run_passes(commands, DEFAULT_PASSES, settings)
+    if stats is not None:
+        stats.update(reports[DEFAULT_PASSES.index("feeds")]["stats"])
+    return commands
 
 def point_line((ax,ay), (bx,by), (px,py)):
     """ Distance of point (px,py) from line between (ax,ay) and (bx,by) """
@@ -11,20 +34,9 @@ def point_line((ax,ay), (bx,by), (px,py)):
     abs_fact = abs( (px-ax)*(by-ay) - (py-ay)*(bx-ax) )
     return abs_fact / normal
 
-def lookahead(iterable, null_item=None):
-    iterator = iter(iterable) # in case a list is passed
-    pprev = iterator.next()
-    prev = iterator.next()
-    for item in iterator:
-        yield pprev, prev, item
-        pprev = prev
-        prev = item
-    yield (pprev, prev, null_item)
-    yield (prev, null_item, null_item)
-
 def annotate_state(commands):
     """ Walk the list of commands and yield tuples of (pos, units_mm, absolute, command) for each command:
-    - pos is the starting position (in current units) for the command
+    - pos is the position (in current units) once the command has run
     - units_mm is true if units are mm, false if inches
     - absolute is true if in absolute positioning mode
     - command is the original command
@@ -38,10 +50,10 @@ def annotate_state(commands):
         elif c["name"] == "G20" and units_mm:
             units_mm = False
             pos = (pos[0]/MM_PER_INCH, pos[1]/MM_PER_INCH)
-        elif c["name"] == "G21":
+        elif c["name"] == "G21" and not units_mm:
             units_mm = True
             pos = (pos[0]*MM_PER_INCH, pos[1]*MM_PER_INCH)
-        elif c["name"] in ("G0", "G1"):
+        elif c["name"] in ("G0", "G1", "G2", "G3", "G81", "G82"):
                 if "X" in c:
                     if absolute:
                         pos = (c["X"], pos[1])
@@ -55,62 +67,1478 @@ def annotate_state(commands):
         yield pos,units_mm,absolute,c
 
 
-def optimise_deviation(commands, thres_mm):
+def point_segment((ax,ay), (bx,by), (px,py)):
+    """ Distance of point (px,py) from the line segment between (ax,ay) and (bx,by) """
+    dx, dy = bx-ax, by-ay
+    length_sq = dx*dx + dy*dy
+    if length_sq == 0:
+        return math.hypot(px-ax, py-ay)
+    t = max(0, min(1, ((px-ax)*dx + (py-ay)*dy) / length_sq))
+    return math.hypot(px-(ax+t*dx), py-(ay+t*dy))
+
+def simplify_polyline(points, thres):
+    """
+    Ramer-Douglas-Peucker simplification of a list of (x,y) points.
+
+    Returns a sorted list of the indexes of the points to keep. The first and
+    last points are always kept, and no dropped point is further than thres
+    from the simplified polyline.
     """
-    Go over any sequences of linear movements and combine any that are
-    within "threshold" mm deviation from a straight line
-    """
-    skip_next = False
-    thres = thres_mm # keep threshold in current units
-    thres_is_mm = True
-    for (pos,units_mm,absolute,a),b,c in lookahead(annotate_state(commands)):
-        b = b[-1] if b else None
-        c = c[-1] if c else None
-        if skip_next:
-            skip_next = False
+    if _use_numpy(len(points)):
+        return _simplify_polyline_numpy(numpy.asarray(points, dtype=float), thres)
+    keep = set([0, len(points)-1])
+    stack = [ (0, len(points)-1) ]
+    while stack:
+        first, last = stack.pop()
+        worst, worst_dist = None, thres
+        for i in range(first+1, last):
+            dist = point_segment(points[first], points[last], points[i])
+            if dist >= worst_dist:
+                worst, worst_dist = i, dist
+        if worst is not None:
+            keep.add(worst)
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return sorted(keep)
+
+def _use_numpy(count):
+    return NUMPY_MIN_POINTS is not None and count >= NUMPY_MIN_POINTS
+
+def segment_distances(a, b, points):
+    """ numpy version of point_segment, distances of each row of the Nx2 array points
+    from the line segment between a and b """
+    d = b - a
+    length_sq = numpy.dot(d, d)
+    rel = points - a
+    if length_sq == 0:
+        return numpy.hypot(rel[:,0], rel[:,1])
+    t = numpy.clip(numpy.dot(rel, d) / length_sq, 0, 1)
+    offset = rel - numpy.outer(t, d)
+    return numpy.hypot(offset[:,0], offset[:,1])
+
+def _simplify_polyline_numpy(points, thres):
+    """ simplify_polyline for an Nx2 array of points, computing each pass's deviations in batch """
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [ (0, len(points)-1) ]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
             continue
-        if thres_is_mm and not units_mm:
-            thres = thres / MM_PER_INCH
-            thres_is_mm = False
-        if units_mm and not thres_is_mm:
-            thres = thres * MM_PER_INCH
-            thres_is_mm = True
-        if a["name"] in ("G0", "G1"):
-            try:
-                if absolute and b and c and "G1" == a["name"] == b["name"] == c["name"] and a["Z"]==b["Z"]==c["Z"]:
-                    dist = point_line((a.get("X", pos[0]), a.get("Y", pos[1])),(c["X"], c["Y"]),(b["X"], b["Y"]))
-                    skip_next = dist < thres
-                elif (not absolute) and b and "G1" == a["name"] == b["name"] and a["Z"]==b["Z"]:
-                    dist = point_line((0,0), (b["X"],b["Y"]), (a["X"],a["Y"]))
-                    skip_next = dist < thres
-            except KeyError:
-                pass
-        yield a
-
-
-def optimise_drills(commands):
+        dists = segment_distances(points[first], points[last], points[first+1:last])
+        worst = first + 1 + int(numpy.argmax(dists))
+        if dists[worst-first-1] >= thres:
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return [ int(i) for i in numpy.flatnonzero(keep) ]
+
+def _is_run_move(c, run):
+    """ Can command c be part of the same-Z run of G1 moves run (a list of commands)? """
+    if c["name"] != "G1" or "X" not in c or "Y" not in c:
+        return False
+    if not run:
+        return True
+    return c.get("Z") == run[0].get("Z") and c.get("F") == run[0].get("F")
+
+def linear_runs(commands):
+    """ Split commands into runs of same-Z G1 moves, yielding tuples of (start, run, absolute, units_mm):
+    - start is the position before the run, or None if this isn't a run of moves
+    - run is a list of G1 commands, or a list of just one other command if start is None
+    - absolute & units_mm are the modes the run is in
+    """
+    run = []
+    run_start = None
+    run_mode = None
+    prev_pos = (0,0)
+    for pos,units_mm,absolute,c in annotate_state(commands):
+        if run and (len(run) >= WINDOW or not (_is_run_move(c, run) and (absolute, units_mm) == run_mode)):
+            yield (run_start, run) + run_mode
+            run = []
+        if _is_run_move(c, run):
+            if not run:
+                run_start = prev_pos
+                run_mode = (absolute, units_mm)
+            run.append(c)
+        else:
+            yield None, [ c ], absolute, units_mm
+        prev_pos = pos
+    if run:
+        yield (run_start, run) + run_mode
+
+def run_points(start, run, absolute):
+    """ Return the list of absolute (x,y) points visited by a run of moves, beginning with start """
+    points = [ start ]
+    for c in run:
+        if absolute:
+            points.append((c["X"], c["Y"]))
+        else:
+            points.append((points[-1][0]+c["X"], points[-1][1]+c["Y"]))
+    return points
+
+def optimise_deviation(commands, thres_mm):
+    """
+    Go over any runs of same-Z linear movements and simplify each one
+    as a polyline, dropping any points that are within "threshold" mm
+    deviation from the simplified path.
+    """
+    for start, run, absolute, units_mm in linear_runs(commands):
+        if start is None:
+            for c in run:
+                yield c
+        else:
+            thres = thres_mm if units_mm else thres_mm / MM_PER_INCH
+            for c in _simplify_run(start, run, absolute, thres):
+                yield c
+
+def _simplify_run(start, run, absolute, thres):
+    """ Simplify a run of G1 moves starting from position start, yielding the moves to keep """
+    if len(run) < 2:
+        for c in run:
+            yield c
+        return
+    if _use_numpy(len(run)+1):
+        points = numpy.empty((len(run)+1, 2))
+        points[0] = start
+        points[1:] = [ (c["X"], c["Y"]) for c in run ]
+        if not absolute:
+            points = numpy.cumsum(points, axis=0)
+        keep = _simplify_polyline_numpy(points, thres)
+        points = points.tolist()
+    else:
+        points = run_points(start, run, absolute)
+        keep = simplify_polyline(points, thres)
+    for c in _kept_moves(run, points, keep, absolute):
+        yield c
+
+def _kept_moves(run, points, keep, absolute):
+    """ Yield the moves of run that go to the kept indexes of its points """
+    for prev, i in zip(keep, keep[1:]):
+        c = run[i-1]
+        if not absolute and prev != i-1:
+            # relative moves need to cover the distance of the dropped ones too
+            c = dict(c)
+            c["X"] = points[i][0] - points[prev][0]
+            c["Y"] = points[i][1] - points[prev][1]
+        yield c
+
+# Size of one AMC2500 motor step (4 thou), moves shorter than this can't be made on their own
+STEP_MM = 25.4 / 4000
+
+def optimise_steps(commands):
+    """
+    Go over any runs of same-Z linear movements and merge moves that
+    are shorter than a motor step on both axes into the moves that
+    follow them, so the controller isn't sent moves it can't make.
+    """
+    for start, run, absolute, units_mm in linear_runs(commands):
+        if start is None:
+            for c in run:
+                yield c
+        else:
+            step = STEP_MM if units_mm else STEP_MM / MM_PER_INCH
+            points = run_points(start, run, absolute)
+            for c in _kept_moves(run, points, merge_substeps(points, step), absolute):
+                yield c
+
+def merge_substeps(points, step):
+    """ Return the indexes of points to keep so that no two kept points are
+    less than step apart on both axes. The first and last points are always kept.
+    """
+    keep = [ 0 ]
+    for i in range(1, len(points)):
+        (x, y), (kx, ky) = points[i], points[keep[-1]]
+        if abs(x - kx) >= step or abs(y - ky) >= step:
+            keep.append(i)
+    last = len(points) - 1
+    if keep[-1] != last:
+        if len(keep) > 1:
+            keep[-1] = last # end point is within a step of the last kept one, so take its place
+        else:
+            keep.append(last)
+    return keep
+
+# Three points always lie on some circle, so an arc has to replace at least this
+# many segments before the fit actually says anything about the path
+MIN_ARC_SEGMENTS = 3
+
+# Arcs are kept under a half turn, the controller's central angle calculation
+# (see amc2500.central_angle_steps) can't tell a major arc from a minor one
+MAX_ARC_SWEEP = math.pi * 0.95
+
+def optimise_arcs(commands, thres_mm):
+    """
+    Go over any runs of same-Z linear movements and replace chains of
+    points that lie within "threshold" mm of a circle with a single
+    G2/G3 arc move.
+    """
+    for start, run, absolute, units_mm in linear_runs(commands):
+        if start is None:
+            for c in run:
+                yield c
+        else:
+            thres = thres_mm if units_mm else thres_mm / MM_PER_INCH
+            for c in _fit_arcs(start, run, absolute, thres):
+                yield c
+
+def circle_centre((ax,ay), (bx,by), (cx,cy)):
+    """ Centre of the circle through three points, or None if they're collinear """
+    d = 2 * (ax*(by-cy) + bx*(cy-ay) + cx*(ay-by))
+    if d == 0:
+        return None
+    a2, b2, c2 = ax*ax+ay*ay, bx*bx+by*by, cx*cx+cy*cy
+    return ((a2*(by-cy) + b2*(cy-ay) + c2*(ay-by)) / d,
+            (a2*(cx-bx) + b2*(ax-cx) + c2*(bx-ax)) / d)
+
+def fit_arc(points, thres):
+    """
+    Try to fit a single arc to a list of (x,y) points, so that no point
+    or segment between points strays more than thres from the arc.
+
+    Returns (centre, cw) if the points fit an arc, or None.
+    """
+    first, last = points[0], points[-1]
+    centre = circle_centre(first, points[len(points)/2], last)
+    if centre is None:
+        return None
+    radius = math.hypot(first[0]-centre[0], first[1]-centre[1])
+    sweep = 0
+    for p,q in zip(points, points[1:]):
+        if abs(math.hypot(q[0]-centre[0], q[1]-centre[1]) - radius) > thres:
+            return None
+        half_chord = math.hypot(q[0]-p[0], q[1]-p[1]) / 2
+        if half_chord > radius or radius - math.sqrt(radius*radius - half_chord*half_chord) > thres:
+            return None
+        angle = math.atan2((p[0]-centre[0])*(q[1]-centre[1]) - (p[1]-centre[1])*(q[0]-centre[0]),
+                           (p[0]-centre[0])*(q[0]-centre[0]) + (p[1]-centre[1])*(q[1]-centre[1]))
+        if angle * sweep < 0:
+            return None # changed direction
+        sweep += angle
+    if sweep == 0 or abs(sweep) > MAX_ARC_SWEEP:
+        return None
+    return centre, sweep < 0
+
+def _fit_arcs(start, run, absolute, thres):
+    """ Replace chains of moves in a run starting from position start with arcs where they fit """
+    points = run_points(start, run, absolute)
+    i = 0
+    while i < len(run):
+        # grow the arc by doubling its length, then narrow down on the longest fit
+        best = None
+        good, bad = i, None
+        end = i + MIN_ARC_SEGMENTS
+        while end <= len(run):
+            fit = fit_arc(points[i:end+1], thres)
+            if fit is None:
+                bad = end
+                break
+            good, best = end, fit
+            end = i + (end - i) * 2
+        if best is not None:
+            if bad is None:
+                bad = len(run) + 1
+            while bad - good > 1:
+                end = (good + bad) / 2
+                fit = fit_arc(points[i:end+1], thres)
+                if fit is None:
+                    bad = end
+                else:
+                    good, best = end, fit
+            chain = points[i:good+1]
+            if max(point_segment(chain[0], chain[-1], p) for p in chain[1:-1]) < thres:
+                # straight enough to be a single line, leave it for optimise_deviation
+                for c in run[i:good]:
+                    yield c
+            else:
+                yield _arc_command(run[good-1], points[i], points[good], best, absolute)
+            i = good
+        else:
+            yield run[i]
+            i += 1
+
+def _arc_command(c, start, end, (centre, cw), absolute):
+    """ Build an arc command from start to end, taking the other parameters from move c """
+    arc = dict(c)
+    arc["name"] = "G2" if cw else "G3"
+    if not absolute:
+        arc["X"], arc["Y"] = end[0]-start[0], end[1]-start[1]
+    arc["I"], arc["J"] = centre[0]-start[0], centre[1]-start[1]
+    return arc
+
+
+# Default number of seconds to spend improving the order of each run of drills
+# (after the initial nearest neighbour tour), 0 to just use nearest neighbour
+DRILL_OPTIMISE_TIME = 1.0
+
+def optimise_drills(commands, optimise_time=DRILL_OPTIMISE_TIME):
     """ Optimise any sequence of absolute positioned drill commands (G81/G82)
 
     To try and reduce to-ing and fro-ing across workpiece
     """
     drills = []
-    drilltype = None
+    start = None
+    prev_pos = (0,0)
     for pos,units_mm,absolute,c in annotate_state(commands):
         if c["name"] in ("G81","G82") and absolute and "X" in c and "Y" in c:
+            if len(drills) >= WINDOW:
+                drills = order_drills(start, drills, optimise_time)
+                for d in drills:
+                    yield d
+                start = (drills[-1]["X"], drills[-1]["Y"])
+                drills = []
+            if not drills:
+                start = prev_pos if start is None else start
             drills.append(c)
         else:
             if len(drills):
-                for d in order_drills(pos, drills):
+                for d in order_drills(start, drills, optimise_time):
                     yield d
                 drills = []
+            start = None
+            yield c
+        prev_pos = pos
+    for d in order_drills(start, drills, optimise_time):
+        yield d
+
+def order_drills(pos, drills, optimise_time=DRILL_OPTIMISE_TIME):
+    """ Given a list of drill cycles, sort them for minimal distance travelled
+
+    Starts with a nearest neighbour tour from pos, then spends up to
+    optimise_time seconds improving it with 2-opt and Or-opt moves.
+    """
+    if len(drills) < 2:
+        return drills
+    points = [ (d["X"], d["Y"]) for d in drills ] + [ pos ]
+    tree = KDTree(points[:-1])
+    if optimise_time > 0:
+        neighbours = [ [ n for n in tree.nearest_k(p, DRILL_NEIGHBOURS + 1) if n != i ]
+                       for i,p in enumerate(points) ]
+    tour = []
+    while len(tour) < len(drills):
+        closest = tree.nearest(pos)
+        tree.remove(closest)
+        tour.append(closest)
+        pos = points[closest]
+    if optimise_time > 0:
+        tour = improve_tour(points, tour, neighbours, time.time() + optimise_time)
+    return [ drills[i] for i in tour ]
+
+def path_length(pos, points):
+    """ Total distance travelled visiting each (x,y) point in turn, starting from pos """
+    total = 0
+    for p in points:
+        total += math.hypot(p[0]-pos[0], p[1]-pos[1])
+        pos = p
+    return total
+
+
+class KDTree:
+    """ A 2D k-d tree over a list of (x,y) points, for nearest neighbour queries
+
+    Points can be removed from the tree, so it can be used to build up a
+    nearest neighbour tour.
+    """
+    def __init__(self, points):
+        self.points = points
+        self.removed = [ False ] * len(points)
+        # nodes are stored as flat lists, indexed by node number
+        self.index = []
+        self.left = []
+        self.right = []
+        self.parent = []
+        self.alive = [] # number of points not yet removed in each subtree
+        self.node_of = [ None ] * len(points)
+        self.root = self._build(range(len(points)), 0, None)
+
+    def _build(self, indexes, depth, parent):
+        if not indexes:
+            return None
+        axis = depth % 2
+        indexes.sort(key=lambda i: self.points[i][axis])
+        mid = len(indexes) / 2
+        node = len(self.index)
+        self.index.append(indexes[mid])
+        self.left.append(None)
+        self.right.append(None)
+        self.parent.append(parent)
+        self.alive.append(len(indexes))
+        self.node_of[indexes[mid]] = node
+        self.left[node] = self._build(indexes[:mid], depth+1, node)
+        self.right[node] = self._build(indexes[mid+1:], depth+1, node)
+        return node
+
+    def remove(self, i):
+        """ Remove the point with index i from future queries """
+        self.removed[i] = True
+        node = self.node_of[i]
+        while node is not None:
+            self.alive[node] -= 1
+            node = self.parent[node]
+
+    def nearest(self, p):
+        """ Index of the closest point to p which hasn't been removed, or None """
+        result = self.nearest_k(p, 1)
+        return result[0] if result else None
+
+    def nearest_k(self, (x,y), k):
+        """ Indexes of the (up to) k closest points to (x,y) which haven't been removed, closest first """
+        best = [] # heap of (-distance, index)
+        stack = [ (self.root, 0, 0) ]
+        while stack:
+            node, depth, plane_dist = stack.pop()
+            if node is None or self.alive[node] == 0:
+                continue
+            if len(best) == k and plane_dist >= -best[0][0]:
+                continue
+            i = self.index[node]
+            px, py = self.points[i]
+            if not self.removed[i]:
+                dist = math.hypot(px-x, py-y)
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, i))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, (-dist, i))
+            diff = x - px if depth % 2 == 0 else y - py
+            near, far = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+            stack.append((far, depth+1, abs(diff)))
+            stack.append((near, depth+1, 0))
+        return [ i for d,i in sorted(best, reverse=True) ]
+
+
+# Number of nearby points considered as candidates for each tour improvement
+DRILL_NEIGHBOURS = 8
+
+def improve_tour(points, tour, neighbours, deadline):
+    """ Improve an open tour with 2-opt and Or-opt moves, until no more can be found or time.time() passes deadline
+
+    points is a list of (x,y) points with the fixed starting point last, tour is a list of indexes into
+    points (excluding the starting point), neighbours is a list of the indexes of nearby points for each point.
+    """
+    start = len(points) - 1
+    tour = list(tour)
+    position = [ None ] * len(points)
+
+    def dist(a, b):
+        if a is None or b is None:
+            return 0 # the tour ends anywhere, so there's no cost after the last point
+        return math.hypot(points[a][0]-points[b][0], points[a][1]-points[b][1])
+
+    def at(i):
+        if i < 0:
+            return start
+        return tour[i] if i < len(tour) else None
+
+    def reindex(first=0, last=None):
+        for i in range(first, len(tour) if last is None else last+1):
+            position[tour[i]] = i
+
+    def two_opt(i, j):
+        """ Reverse tour[i:j+1] if that makes the tour shorter """
+        a, b, c, d = at(i-1), tour[i], tour[j], at(j+1)
+        if dist(a,c) + dist(b,d) < dist(a,b) + dist(c,d) - 1e-9:
+            tour[i:j+1] = tour[i:j+1][::-1]
+            reindex(i, j)
+            return True
+        return False
+
+    def or_opt(i, length):
+        """ Move tour[i:i+length] next to one of its neighbours if that makes the tour shorter """
+        segment = tour[i:i+length]
+        a, b = at(i-1), at(i+length)
+        gain = dist(a, segment[0]) + dist(segment[-1], b) - dist(a, b)
+        for end in segment[0], segment[-1]:
+            for c in neighbours[end]:
+                if c == start or position[c] is None or i <= position[c] < i+length or c == a:
+                    continue
+                e = at(position[c]+1)
+                if e is not None and i <= position[e] < i+length:
+                    continue
+                forward = dist(c, segment[0]) + dist(segment[-1], e) - dist(c, e)
+                backward = dist(c, segment[-1]) + dist(segment[0], e) - dist(c, e)
+                if min(forward, backward) < gain - 1e-9:
+                    if backward < forward:
+                        segment = segment[::-1]
+                    del tour[i:i+length]
+                    insert = tour.index(c) + 1
+                    tour[insert:insert] = segment
+                    reindex()
+                    return True
+        return False
+
+    reindex()
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(len(tour)):
+            if i % 64 == 0 and time.time() >= deadline:
+                break
+            if i >= len(tour):
+                break
+            a, b = at(i-1), tour[i]
+            for c in neighbours[a]:
+                j = position[c]
+                if j is None or dist(a, c) >= dist(a, b):
+                    continue
+                if j > i and two_opt(i, j) or j < i-1 and two_opt(j+1, i-1):
+                    improved = True
+                    break
+            for length in 1, 2, 3:
+                if i + length <= len(tour) and or_opt(i, length):
+                    improved = True
+                    break
+    return tour
+
+
+def optimise_contours(commands):
+    """
+    Reorder the head-down contours (plunge, then cutting moves) in each
+    absolute positioned section of the program, to minimise the rapid
+    travel between them.
+
+    Closed contours may start from any of their points, and open ones may
+    be cut in reverse, but the path each contour cuts is unchanged.
+    """
+    block = ContourBlock((0,0))
+    feed = None
+    head_down = False
+    prev_pos = (0,0)
+    for pos,units_mm,absolute,c in annotate_state(commands):
+        name = c["name"]
+        lowers = "Z" in c and c["Z"] < 0
+        if not absolute:
+            accepted = False
+        elif block.contour is not None and (name in ("G1", "G2", "G3", "comment")
+                                            or _is_head_command(c) and not block.contour.moves):
+            accepted = block.add_to_contour(c, pos)
+        elif name == "comment" or (name == "G0" and "F" not in c and not lowers
+                                   and not (head_down and ("X" in c or "Y" in c))):
+            accepted = block.add_to_travel(c)
+        elif name == "G1" and lowers and not head_down:
+            if not block.can_start_contour(c, feed):
+                for b in block.flush():
+                    yield b
+                block = ContourBlock(prev_pos)
+            accepted = block.start_contour(c, pos, feed)
+        else:
+            accepted = False
+
+        if not accepted or block.size >= WINDOW:
+            for b in block.flush():
+                yield b
+            if not accepted:
+                yield c
+            block = ContourBlock(pos)
+        if "F" in c:
+            feed = c["F"]
+        if "Z" in c and name in ("G0", "G1", "G2", "G3"):
+            head_down = c["Z"] < 0
+        prev_pos = pos
+    for b in block.flush():
+        yield b
+
+
+class Contour:
+    """ A run of head-down cutting moves, in absolute positioning mode
+
+    Contours are started from an "orientation": 0 to cut as normal, a vertex
+    index to start a closed contour part way around, or -1 to cut in reverse.
+    """
+    def __init__(self, plunge, pos, feed):
+        self.head = [ plunge ] # commands before the first XY move
+        self.moves = [] # commands from the first XY move on
+        self.points = [ pos ] # points[n] is the start of moves[n]
+        self.depth = plunge["Z"]
+        self.feed = plunge.get("F", feed) # plunge feed, which the contour has to start with
+        self.end_feed = self.feed # feed left set after the contour
+        # can only reverse/rotate a plain contour: a plunge (and the likes of pcb2gcode's
+        # "G04 P0" & cutting feed), then XY moves at the same depth and feed
+        self.flexible = True
+
+    def add(self, c, pos):
+        if c["name"] != "comment" and ("X" in c or "Y" in c or self.moves):
+            self.moves.append(c)
+            self.points.append(pos)
+            if ("X" not in c or "Y" not in c or c.get("Z", self.depth) != self.depth
+                or c.get("F", self.end_feed) != self.end_feed):
+                self.flexible = False
+        else:
+            (self.moves if self.moves else self.head).append(c)
+            if self.moves or not (c["name"] == "comment" or _is_head_command(c)):
+                self.flexible = False
+        self.end_feed = c.get("F", self.end_feed)
+
+    @property
+    def closed(self):
+        return self.flexible and len(self.points) > 2 and _same_point(self.points[0], self.points[-1])
+
+    def orientations(self):
+        """ Return the orientations this contour can be cut in """
+        if self.closed:
+            return range(len(self.points) - 1)
+        if self.flexible and self.moves:
+            return [ 0, -1 ]
+        return [ 0 ]
+
+    def entry(self, orientation):
+        return self.points[-1] if orientation == -1 else self.points[orientation]
+
+    def exit(self, orientation):
+        return self.points[0] if orientation == -1 else self.points[orientation] if orientation else self.points[-1]
+
+    def commands(self, orientation):
+        """ Commands to cut this contour, starting from the entry with orientation """
+        if orientation == 0:
+            return self.head + self.moves
+        if orientation > 0:
+            return self.head + self.moves[orientation:] + self.moves[:orientation]
+        moves = []
+        for i in reversed(range(len(self.moves))):
+            c = dict(self.moves[i])
+            c["X"], c["Y"] = self.points[i]
+            if c["name"] in ("G2", "G3"):
+                c["name"] = "G3" if c["name"] == "G2" else "G2"
+                centre = (self.points[i][0] + c["I"], self.points[i][1] + c["J"])
+                c["I"], c["J"] = centre[0] - self.points[i+1][0], centre[1] - self.points[i+1][1]
+            moves.append(c)
+        return self.head + moves
+
+
+class ContourBlock:
+    """ A section of the program made up of travel (head up rapids and comments)
+    and contours, which can be cut in any order """
+    def __init__(self, start):
+        self.start = start
+        self.travel = [] # current travel, after the last contour
+        self.travels = [] # travel before each contour
+        self.contours = []
+        self.contour = None # contour currently being added to
+        self.pending = [] # comments which could be the end of the contour, or the start of the travel
+        self.size = 0 # number of commands in the block
+
+    def _end_contour(self):
+        self.contour = None
+        self.travel += self.pending
+        self.pending = []
+
+    def add_to_travel(self, c):
+        self.size += 1
+        self._end_contour()
+        self.travel.append(c)
+        return True
+
+    def can_start_contour(self, c, feed):
+        if not self.contours:
+            return True
+        first = self.contours[0]
+        return c["Z"] == first.depth and c.get("F", feed) == first.feed
+
+    def start_contour(self, c, pos, feed):
+        self.size += 1
+        self._end_contour()
+        self.travels.append(self.travel)
+        self.travel = []
+        self.contour = Contour(c, pos, feed)
+        self.contours.append(self.contour)
+        return True
+
+    def add_to_contour(self, c, pos):
+        self.size += 1
+        if c["name"] == "comment":
+            self.pending.append(c)
+            return True
+        for p in self.pending:
+            self.contour.add(p, pos)
+        self.pending = []
+        self.contour.add(c, pos)
+        if "Z" in c and c["Z"] >= 0: # head lifted, end of the contour
+            self.contour.flexible = False
+            self._end_contour()
+        return True
+
+    def flush(self):
+        """ Return the commands in this block, with the contours reordered
+
+        Each contour starts with its plunge feed set, and if the contours
+        now finish on a different feed the original one is set again after
+        them, so the feed is always as it was for whatever follows.
+        """
+        self._end_contour()
+        if len(self.contours) < 2:
+            result = []
+            for travel, contour in zip(self.travels, self.contours):
+                result += travel + contour.commands(0)
+            return result + self.travel
+
+        contours = list(self.contours)
+        pinned = None
+        if not any(_is_rapid(c) for c in self.travel):
+            # nothing moves the head after the block, so it has to finish in the same place
+            pinned = contours.pop()
+
+        entries = [ (n, o) for n, contour in enumerate(contours) for o in contour.orientations() ]
+        tree = KDTree([ contours[n].entry(o) for n, o in entries ])
+        entries_of = [ [] for _ in contours ]
+        for i, (n, o) in enumerate(entries):
+            entries_of[n].append(i)
+
+        order = []
+        pos = self.start
+        for _ in contours:
+            n, o = entries[tree.nearest(pos)]
+            for i in entries_of[n]:
+                tree.remove(i)
+            order.append((contours[n], o))
+            pos = contours[n].exit(o)
+        if pinned is not None:
+            order.append((pinned, 0))
+
+        result = []
+        pos = self.start
+        for travel, (contour, o) in zip(self.travels, order):
+            result += _travel_to(travel, pos, contour.entry(o), contour.head[0].get("line"))
+            commands = contour.commands(o)
+            if "F" not in commands[0] and contour.feed is not None:
+                # contours may now follow a different feed setting
+                commands[0] = dict(commands[0], F=contour.feed)
+            result += commands
+            pos = contour.exit(o)
+        end_feed = self.contours[-1].end_feed
+        if order[-1][0].end_feed != end_feed and end_feed is not None:
+            feed = { "name" : "G1", "F" : end_feed }
+            if "line" in self.contours[-1].head[0]:
+                feed["line"] = self.contours[-1].head[0]["line"]
+            result.append(feed)
+        return result + self.travel
+
+
+def _is_head_command(c):
+    """ Can c come between a plunge and the first cutting move without stopping the
+    contour being reordered? A feed setting, or a dwell for no time (which
+    pcb2gcode adds after every plunge, so G64 path blending doesn't smooth it) """
+    if c["name"] == "G1":
+        return not any(k in c for k in "XYZ")
+    return c["name"] == "G4" and not c.get("P", 0)
+
+def _same_point(a, b):
+    return abs(a[0]-b[0]) < 1e-6 and abs(a[1]-b[1]) < 1e-6
+
+def _is_rapid(c):
+    return c["name"] == "G0" and ("X" in c or "Y" in c)
+
+def _travel_to(travel, pos, target, line):
+    """ Rewrite travel commands (comments, retracts & rapids) from pos to finish at target instead """
+    rapids = [ c for c in travel if _is_rapid(c) ]
+    if not rapids:
+        if _same_point(pos, target):
+            return travel
+        rapid = { "name" : "G0", "X" : target[0], "Y" : target[1] }
+        if line is not None:
+            rapid["line"] = line
+        return travel + [ rapid ]
+    result = []
+    for c in travel:
+        if c is rapids[-1]:
+            result.append(dict(c, X=target[0], Y=target[1]))
+        elif not _is_rapid(c):
+            result.append(c)
+    return result
+
+
+# Default longest hop between contours (mm) which can be made with the head down
+MAX_HOP = 1.0
+
+# Default distance (mm) a head-down hop may stray from toolpaths which are cut anyway
+HOP_CLEARANCE = 0.025
+
+def optimise_head_lifts(commands, max_hop_mm=MAX_HOP, clearance_mm=HOP_CLEARANCE):
+    """
+    Look for places where the head is lifted after a contour, moved a
+    short distance and lowered back to the same depth for the next
+    contour. Keep the head down for the hop instead, if it's no longer
+    than max_hop_mm and stays within clearance_mm of the toolpaths cut
+    before it or in the contour that follows.
+    """
+    lifter = HeadLifter(max_hop_mm, clearance_mm)
+    for pos,units_mm,absolute,c in annotate_state(commands):
+        for r in lifter.add(c, pos, units_mm, absolute):
+            yield r
+    for r in lifter.flush():
+        yield r
+
+
+class HeadLifter:
+    """ State for optimise_head_lifts, holds back the commands between two contours
+    until it knows if the head needs to be lifted between them """
+    def __init__(self, max_hop_mm, clearance_mm):
+        if clearance_mm <= 0:
+            raise ValueError("Hop clearance must be more than 0mm (was %s)" % clearance_mm)
+        self.max_hop_mm = max_hop_mm
+        self.clearance_mm = clearance_mm
+        self.units_mm = True
+        self.grid = SegmentGrid(max_hop_mm, 10 * WINDOW)
+        self.pos = (0,0)
+        self.head_down = False
+        self.depth = None
+        self.feed = None
+        self.held = None # (command, position) tuples for the lift, hop & plunge
+        self.hop_end = None
+        self.contour = None # (command, position) tuples for the contour after the hop
+
+    def add(self, c, pos, units_mm, absolute):
+        if units_mm != self.units_mm:
+            self.units_mm = units_mm
+            self.grid = SegmentGrid(self._units(self.max_hop_mm), 10 * WINDOW)
+        if self.held is None:
+            if absolute and self.head_down and c["name"] == "G0" and _is_retract(c):
+                self.held = [ (c, pos) ]
+                self.hop_start = self.pos
+                self.hop_end = None
+                self.contour = None
+                self.pos = pos
+                return []
+            self._track(c, pos)
+            return [ c ]
+
+        name = c["name"]
+        if len(self.held) + len(self.contour or []) >= WINDOW:
+            pass # held back enough, give up on this hop
+        elif self.contour is None:
+            if name == "comment" or (name == "G0" and _is_retract(c)):
+                self.held.append((c, pos))
+                return []
+            if (name == "G0" and self.hop_end is None and "F" not in c and c.get("Z", 0) >= 0
+                and "X" in c and "Y" in c):
+                self.held.append((c, pos))
+                self.hop_end = pos
+                return []
+            if (name == "G1" and self.hop_end is not None and "X" not in c and "Y" not in c
+                and c.get("Z") == self.depth and c.get("F", self.feed) == self.feed):
+                self.held.append((c, pos))
+                self.contour = []
+                return []
+        elif name in ("G1", "G2", "G3") and "X" in c and "Y" in c and c.get("Z", self.depth) == self.depth:
+            self.contour.append((c, pos))
+            return []
+        elif name == "comment":
+            self.contour.append((c, pos))
+            return []
+        return self.flush() + self.add(c, pos, units_mm, absolute)
+
+    def flush(self):
+        """ Return the held commands, with the hop made head down if possible """
+        if self.held is None:
+            return []
+        held, contour = self.held, self.contour
+        self.held = self.contour = None
+        if contour is None:
+            can_hop = False
+            contour = []
+        else:
+            # the following contour is cut anyway, so it counts as already cut
+            pos = self.hop_end
+            for c,end in contour:
+                for a,b in _cut_segments(c, pos, end):
+                    self.grid.add(a, b)
+                pos = end
+            can_hop = self._can_hop()
+
+        if can_hop:
+            result = [ h for h,pos in held if h["name"] == "comment" ]
+            if not _same_point(self.hop_start, self.hop_end):
+                rapid = [ h for h,pos in held if _is_rapid(h) ][0]
+                hop = { "name" : "G1", "X" : self.hop_end[0], "Y" : self.hop_end[1] }
+                if "line" in rapid:
+                    hop["line"] = rapid["line"]
+                self._track(hop, self.hop_end)
+                result.append(hop)
+        else:
+            result = []
+            for h,pos in held:
+                self._track(h, pos)
+                result.append(h)
+        for c,pos in contour:
+            self._track(c, pos, False)
+            result.append(c)
+        return result
+
+    def _units(self, mm):
+        return mm if self.units_mm else mm / MM_PER_INCH
+
+    def _can_hop(self):
+        """ Is the hop short enough, and within the clearance of the toolpath everywhere? """
+        length = math.hypot(self.hop_end[0]-self.hop_start[0], self.hop_end[1]-self.hop_start[1])
+        if length > self._units(self.max_hop_mm):
+            return False
+        clearance = self._units(self.clearance_mm)
+        samples = int(math.ceil(length / (clearance / 2)))
+        for n in range(samples + 1):
+            t = float(n) / samples if samples else 0
+            p = (self.hop_start[0] + t * (self.hop_end[0]-self.hop_start[0]),
+                 self.hop_start[1] + t * (self.hop_end[1]-self.hop_start[1]))
+            if not self.grid.near(p, clearance):
+                return False
+        return True
+
+    def _track(self, c, pos, add_cuts=True):
+        """ Update the head state for command c, which finishes at pos """
+        if c["name"] in ("G0", "G1", "G2", "G3"):
+            if "Z" in c:
+                self.head_down = c["Z"] < 0
+                if self.head_down:
+                    self.depth = c["Z"]
+            if self.head_down and add_cuts:
+                for a,b in _cut_segments(c, self.pos, pos):
+                    self.grid.add(a, b)
+        if "F" in c:
+            self.feed = c["F"]
+        self.pos = pos
+
+
+def _is_retract(c):
+    return "Z" in c and c["Z"] >= 0 and "X" not in c and "Y" not in c and "F" not in c
+
+def _cut_segments(c, start, end):
+    """ Return a list of (a,b) line segments approximating the path of command c from start to end """
+    if c["name"] == "comment" or _same_point(start, end):
+        return []
+    if c["name"] not in ("G2", "G3"):
+        return [ (start, end) ]
+    centre = (start[0] + c.get("I",0), start[1] + c.get("J",0))
+    radius = math.hypot(start[0]-centre[0], start[1]-centre[1])
+    a0 = math.atan2(start[1]-centre[1], start[0]-centre[0])
+    a1 = math.atan2(end[1]-centre[1], end[0]-centre[0])
+    sweep = a1 - a0
+    if c["name"] == "G2" and sweep > 0:
+        sweep -= 2*math.pi
+    elif c["name"] == "G3" and sweep < 0:
+        sweep += 2*math.pi
+    count = max(1, int(abs(sweep) / (math.pi / 16)))
+    points = [ start ] + [ (centre[0] + radius*math.cos(a0 + sweep*n/count),
+                            centre[1] + radius*math.sin(a0 + sweep*n/count)) for n in range(1, count) ] + [ end ]
+    return zip(points, points[1:])
+
+
+class SegmentGrid:
+    """ Spatial hash of line segments, for finding whether a point is near any of them
+
+    Only the most recent limit segments are kept.
+    """
+    def __init__(self, cell, limit=None):
+        self.cell = float(cell) if cell > 0 else 1.0
+        self.cells = {}
+        self.limit = limit
+        self.added = collections.deque() # (keys, segment) in the order they were added
+
+    def _key(self, (x,y)):
+        return (int(math.floor(x / self.cell)), int(math.floor(y / self.cell)))
+
+    def add(self, a, b):
+        # record the segment in each cell it passes through (sampled every half a cell)
+        length = math.hypot(b[0]-a[0], b[1]-a[1])
+        steps = int(length / (self.cell / 2)) + 1
+        keys = set(self._key((a[0] + (b[0]-a[0])*n/steps, a[1] + (b[1]-a[1])*n/steps)) for n in range(steps+1))
+        for key in keys:
+            self.cells.setdefault(key, []).append((a,b))
+        self.added.append((keys, (a,b)))
+        if self.limit is not None and len(self.added) > self.limit:
+            keys, segment = self.added.popleft()
+            for key in keys:
+                self.cells[key].remove(segment)
+                if not self.cells[key]:
+                    del self.cells[key]
+
+    def near(self, p, distance):
+        """ Is p within distance (which should be under half a cell) of any segment? """
+        kx, ky = self._key(p)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for a,b in self.cells.get((kx+dx, ky+dy), []):
+                    if point_segment(a, b, p) <= distance:
+                        return True
+        return False
+
+
+# Commands that don't depend on the feed or spindle settings
+_NEUTRAL_COMMANDS = ("comment", "message", "G20", "G21", "G64", "G90", "G91", "G94")
+
+def optimise_feeds(commands, stats=None):
+    """
+    Track the effective feed rate (F) and spindle speed (S) through the
+    program, and remove any settings which don't change them or which
+    are overridden before anything uses them.
+
+    Unchanged F words on commands which also move something are left
+    alone, as they don't cause any controller traffic.
+
+    If a stats dict is passed, it's updated with counts of the "feed_removed"
+    and "spindle_removed" settings, and the number of "serial_commands" saved
+    by the controller not having to make those changes.
+    """
+    if stats is None:
+        stats = {}
+    for key in "feed_removed", "spindle_removed", "serial_commands":
+        stats.setdefault(key, 0)
+    feed = None
+    spindle = None
+    held = [] # commands held back while we see if a setting is overridden
+    pending_feed = None # index in held of the command whose F might be overridden
+    pending_spindle = None # index in held of the S command which might be overridden
+    for c in commands:
+        name = c["name"]
+        if name in ("G20", "G21"):
+            feed = None # feed is in different units now
+        if "F" in c and name in ("G0", "G1", "G2", "G3"):
+            if c["F"] == feed:
+                # AMC2500.set_speed already skips unchanged speeds, so only
+                # commands with nothing else to do are worth dropping
+                if set(c.keys()) <= set([ "name", "line", "F" ]):
+                    stats["feed_removed"] += 1
+                    continue
+            else:
+                if pending_feed is not None:
+                    # previous setting was never used
+                    held[pending_feed] = dict(held[pending_feed])
+                    del held[pending_feed]["F"]
+                    stats["feed_removed"] += 1
+                    stats["serial_commands"] += 4 # VS, VM, AT, SS
+                feed = c["F"]
+                pending_feed = len(held) if not ("X" in c and "Y" in c) else None
+        elif "F" in c:
+            feed = c["F"]
+        if name == "S":
+            if c["S"] == spindle:
+                stats["spindle_removed"] += 1
+                stats["serial_commands"] += 1 # SS
+                continue
+            if pending_spindle is not None:
+                held[pending_spindle] = None
+                stats["spindle_removed"] += 1
+                stats["serial_commands"] += 1
+            spindle = c["S"]
+            pending_spindle = len(held)
+
+        held.append(c)
+        uses_feed, uses_spindle = _uses_settings(c)
+        if ((pending_feed is None and pending_spindle is None) or len(held) >= WINDOW
+            or (pending_feed is not None and uses_feed) or (pending_spindle is not None and uses_spindle)):
+            for h in held:
+                if h is not None and not _is_empty_move(h):
+                    yield h
+            held = []
+            pending_feed = pending_spindle = None
+    for h in held:
+        if h is not None and not _is_empty_move(h):
+            yield h
+
+def _uses_settings(c):
+    """ Return a tuple of (uses_feed, uses_spindle) for whether command c depends on those settings """
+    name = c["name"]
+    uses_feed = (name in ("G1", "G2", "G3") and "X" in c and "Y" in c
+                 or name not in _NEUTRAL_COMMANDS + ("G0", "G1", "S", "M3", "M5"))
+    uses_spindle = name not in _NEUTRAL_COMMANDS + ("S",)
+    return uses_feed, uses_spindle
+
+def _is_empty_move(c):
+    """ Is c a G0/G1 with nothing left to do? """
+    return c["name"] in ("G0", "G1") and not any(k in c for k in "XYZF")
+
+
+# Commands with an X & Y position, which panelise offsets for each copy
+_MOVES = ("G0", "G1", "G2", "G3", "G81", "G82")
+
+def panelise(commands, rows, columns, (pitch_x, pitch_y)):
+    """ Generator which repeats commands for a panel of rows x columns
+    copies of a board, with copies pitch_x and pitch_y mm apart
+
+    Everything is made absolute, so each copy is the same commands with
+    its offset added. The program is split at tool changes (M6), and each
+    part is repeated for every copy before the next tool change, going
+    back and forth along the rows or columns (whichever travels less.)
+    Parts which only drill (no cutting moves) are only repeated for the
+    drill cycles, so each run of drills covers the whole panel in one go
+    and can be ordered across it by optimise_drills. An M2 only ends the
+    last copy.
+    """
+    yield { "name" : "G90" }
+    part = []
+    count = 0
+    for pos, units_mm, absolute, c in annotate_state(commands):
+        if c["name"] == "M6":
+            for p in _panel_part(part, rows, columns, (pitch_x, pitch_y), count % 2):
+                yield p
+            count += 1
+            part = []
+            yield c
+        else:
+            part.append((_absolute_command(c, pos, absolute), units_mm, pos))
+    for p in _panel_part(part, rows, columns, (pitch_x, pitch_y), count % 2):
+        yield p
+
+def _absolute_command(c, pos, absolute):
+    if c["name"] == "G91":
+        return dict(c, name="G90")
+    if absolute or c["name"] not in _MOVES:
+        return c
+    c = dict(c)
+    if "X" in c:
+        c["X"] = pos[0]
+    if "Y" in c:
+        c["Y"] = pos[1]
+    return c
+
+def _offset_command(c, (dx, dy), units_mm):
+    if c["name"] not in _MOVES:
+        return c
+    scale = 1 if units_mm else 1 / MM_PER_INCH
+    c = dict(c)
+    if "X" in c:
+        c["X"] += dx * scale
+    if "Y" in c:
+        c["Y"] += dy * scale
+    return c
+
+def _panel_part(part, rows, columns, pitch, backwards):
+    """ Repeat one part of a program (between tool changes) across the panel """
+    moves = [ (pos if units_mm else (pos[0]*MM_PER_INCH, pos[1]*MM_PER_INCH))
+              for c, units_mm, pos in part if c["name"] in _MOVES ]
+    if not moves:
+        return [ c for c, units_mm, pos in part ]
+    offsets = panel_order(rows, columns, pitch, moves[0], moves[-1])
+    if backwards: # start where the last part left off
+        offsets.reverse()
+    result = []
+    if not any(c["name"] in ("G1", "G2", "G3") for c, units_mm, pos in part):
+        drills = []
+        for c, units_mm, pos in part + [ ({ "name" : None }, True, None) ]:
+            if c["name"] in ("G81", "G82"):
+                drills.append((c, units_mm))
+                continue
+            for offset in offsets:
+                result += [ _offset_command(d, offset, d_mm) for d, d_mm in drills ]
+            drills = []
+            if c["name"] is not None:
+                result.append(_offset_command(c, offsets[0], units_mm))
+        return result
+    for n, offset in enumerate(offsets):
+        result += [ _offset_command(c, offset, units_mm) for c, units_mm, pos in part
+                    if c["name"] != "M2" or n == len(offsets) - 1 ]
+    return result
+
+def panel_order(rows, columns, (pitch_x, pitch_y), start, end):
+    """ Return the offsets of the copies in a panel, in the order to cut them
+
+    start and end are where a copy's moves start and end (in mm, from its
+    own origin), to pick the order with the shortest travel between copies.
+    """
+    def back_and_forth(rows, columns, swap):
+        order = []
+        for a in range(rows):
+            for b in (range(columns) if a % 2 == 0 else reversed(range(columns))):
+                r, c = (b, a) if swap else (a, b)
+                order.append((c * pitch_x, r * pitch_y))
+        return order
+    def travel(order):
+        return sum(math.hypot(b[0] + start[0] - a[0] - end[0], b[1] + start[1] - a[1] - end[1])
+                   for a, b in zip(order, order[1:]))
+    return min(back_and_forth(rows, columns, False), back_and_forth(columns, rows, True), key=travel)
+
+
+# Optimiser passes, by name. Each is called as fn(commands, settings, stats) and returns
+# the new commands. settings is a dict like DEFAULT_SETTINGS, and the pass can record
+# anything it likes to report in the stats dict.
+PASSES = {
+    "arcs" : lambda commands, settings, stats: optimise_arcs(commands, settings["max_deviation"]),
+    "deviation" : lambda commands, settings, stats: optimise_deviation(commands, settings["max_deviation"]),
+    "steps" : lambda commands, settings, stats: optimise_steps(commands),
+    "contours" : lambda commands, settings, stats: optimise_contours(commands),
+    "head_lifts" : lambda commands, settings, stats: optimise_head_lifts(commands, settings["max_hop"],
+                                                                         settings["hop_clearance"]),
+    "feeds" : lambda commands, settings, stats: optimise_feeds(commands, stats),
+    "drills" : lambda commands, settings, stats: optimise_drills(commands, settings["drill_time"]),
+    }
+
+# The order passes run in by default
+DEFAULT_PASSES = [ "arcs", "deviation", "steps", "contours", "head_lifts", "feeds", "drills" ]
+
+# Passes which only look at one stretch of head-down cutting at a time, so
+# they can be run on separate chunks of the program in parallel
+CHUNKABLE_PASSES = [ "arcs", "deviation", "steps", "feeds" ]
+
+DEFAULT_SETTINGS = {
+    "max_deviation" : 0.025,
+    "drill_time" : DRILL_OPTIMISE_TIME,
+    "max_hop" : MAX_HOP,
+    "hop_clearance" : HOP_CLEARANCE,
+    }
+
+def run_passes(commands, passes, settings=DEFAULT_SETTINGS, lazy=False, processes=1):
+    """ Run the named optimiser passes over commands, in order
+
+    Returns a tuple of (commands, reports) where reports has a dict for each pass:
+    - name is the name of the pass
+    - time is the number of seconds the pass took
+    - commands_removed is the change in the number of commands
+    - rapid_saved is the change in rapid travel distance (mm)
+    - seconds_saved is the change in estimated machine time (seconds)
+    - stats is any extra stats the pass recorded
+
+    If lazy is set, commands is returned as a generator which runs the
+    passes as it goes, and the reports are only filled in once it's finished.
+
+    If processes is more than 1, consecutive CHUNKABLE_PASSES are run on
+    chunks of the program in a pool of that many processes (see
+    optimise_chunks.) The commands are the same as running them serially,
+    but each pass's time is then the total across all the processes.
+    """
+    for name in passes:
+        if name not in PASSES:
+            raise ValueError("Unknown optimiser pass '%s' (should be one of %s)" % (name, ", ".join(DEFAULT_PASSES)))
+    meters = [ _Meter(commands) ]
+    reports = []
+    metered = [] # (report, meter before, meter after) for each pass run serially
+    stages = [ [ name ] for name in passes ]
+    if processes > 1:
+        stages = []
+        for name in passes:
+            if stages and name in CHUNKABLE_PASSES and stages[-1][-1] in CHUNKABLE_PASSES:
+                stages[-1].append(name)
+            else:
+                stages.append([ name ])
+    for stage in stages:
+        stage_reports = [ { "name" : name, "stats" : {} } for name in stage ]
+        reports += stage_reports
+        if stage[0] in CHUNKABLE_PASSES and processes > 1:
+            meters.append(_Meter(optimise_chunks(iter(meters[-1]), stage, settings, processes, stage_reports)))
+        else:
+            meters.append(_Meter(PASSES[stage[0]](iter(meters[-1]), settings, stage_reports[0]["stats"])))
+            metered.append((stage_reports[0], meters[-2], meters[-1]))
+
+    def stream():
+        for c in meters[-1]:
+            yield c
+        for report, before, after in metered:
+            report.update({ "time" : after.time - before.time,
+                            "commands_removed" : before.estimate["commands"] - after.estimate["commands"],
+                            "rapid_saved" : before.estimate["rapid_distance"] - after.estimate["rapid_distance"],
+                            "seconds_saved" : before.estimate["seconds"] - after.estimate["seconds"] })
+    if lazy:
+        return stream(), reports
+    return list(stream()), reports
+
+
+class _Meter:
+    """ Wraps a stream of commands, totalling the time spent producing them
+    (including in any earlier passes) and estimating their cost """
+    def __init__(self, commands):
+        self.commands = iter(commands)
+        self.time = 0
+        self.estimator = ProgramEstimator()
+
+    @property
+    def estimate(self):
+        return self.estimator.result
+
+    def __iter__(self):
+        for pos,units_mm,absolute,c in annotate_state(self._timed()):
+            self.estimator.add(pos, units_mm, c)
             yield c
 
-def order_drills(pos, drills):
-    """ Given a list of drill cycles, sort them for minimal distance travelled (greedy, non-optimal) """
-    while len(drills):
-        # sort by distance from current point
-        closest = min(drills, key=lambda a: math.hypot(pos[0]-a["X"],pos[1]-a["Y"]))
-        yield closest
-        pos = (closest["X"], closest["Y"])
-        drills.remove(closest)
+    def _timed(self):
+        while True:
+            start = time.time()
+            try:
+                c = self.commands.next()
+            except StopIteration:
+                return
+            finally:
+                self.time += time.time() - start
+            yield c
+
+
+# Chunks sent to the process pool have at least this many commands, if the
+# program can be split that often
+CHUNK_SIZE = 5000
+
+def optimise_chunks(commands, passes, settings, processes, reports):
+    """
+    Run the named passes (all CHUNKABLE_PASSES) over chunks of commands in
+    a pool of processes, yielding the optimised commands in order.
+
+    The reports (a dict for each pass, as for run_passes) are filled in
+    with the totals across all of the chunks once they're all done.
+    """
+    for report in reports:
+        report.update({ "time" : 0, "commands_removed" : 0, "rapid_saved" : 0, "seconds_saved" : 0 })
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = collections.deque()
+        for prelude, chunk in split_chunks(commands, CHUNK_SIZE):
+            results.append(pool.apply_async(_optimise_chunk, (prelude + chunk, passes, settings)))
+            while len(results) > 2 * processes: # don't read ahead too far
+                for c in _chunk_result(results.popleft(), reports):
+                    yield c
+        while results:
+            for c in _chunk_result(results.popleft(), reports):
+                yield c
+        pool.close()
+    finally:
+        pool.terminate()
+
+def _optimise_chunk(commands, passes, settings):
+    """ Run passes over one chunk in a pool process, returning (commands, reports) """
+    optimised, reports = run_passes(commands, passes, settings)
+    return [ c for c in optimised if not c.get("prelude") ], reports
+
+def _chunk_result(result, reports):
+    """ Wait for a chunk's result, add its reports to the totals and return its commands """
+    optimised, chunk_reports = result.get()
+    for report, chunk_report in zip(reports, chunk_reports):
+        for key in "time", "commands_removed", "rapid_saved", "seconds_saved":
+            report[key] += chunk_report[key]
+        for key, value in chunk_report["stats"].items():
+            report["stats"][key] = report["stats"].get(key, 0) + value
+    return optimised
+
+def split_chunks(commands, min_size):
+    """
+    Split commands into chunks of at least min_size commands that can be
+    optimised independently, yielding tuples of (prelude, chunk).
+
+    Chunks only start at head-up moves or tool changes, when there's no feed
+    or spindle setting waiting to be used. The prelude is a few commands
+    (marked with a "prelude" key, to strip out afterwards) which put the
+    passes back into the state they would have been in at the start of the
+    chunk: the units, positioning mode, position, feed and spindle speed.
+    """
+    chunk = []
+    prelude = []
+    state = ((0,0), True, False)
+    feed = spindle = None
+    pending_feed = pending_spindle = False # settings which might not have been used yet
+    for pos,units_mm,absolute,c in annotate_state(commands):
+        name = c["name"]
+        head_up = name == "G0" and c.get("Z", -1) >= 0 or name == "G1" and _is_retract(c)
+        if len(chunk) >= min_size and not (pending_feed or pending_spindle) and (head_up or name == "M6"):
+            yield prelude, chunk
+            prelude = _prelude(state, feed, spindle)
+            chunk = []
+        chunk.append(c)
+        state = (pos, units_mm, absolute)
+        if name in ("G20", "G21"):
+            feed = None
+        # follows optimise_feeds, but assumes any F or S might be left pending
+        if "F" in c:
+            feed = c["F"]
+            if name in ("G0", "G1", "G2", "G3"):
+                pending_feed = not ("X" in c and "Y" in c)
+        if name == "S":
+            spindle = c["S"]
+            pending_spindle = True
+        uses_feed, uses_spindle = _uses_settings(c)
+        if pending_feed and uses_feed or pending_spindle and uses_spindle:
+            pending_feed = pending_spindle = False
+    if chunk:
+        yield prelude, chunk
+
+def _prelude(((x, y), units_mm, absolute), feed, spindle):
+    """ Return the commands which set up the state at the start of a chunk (see split_chunks) """
+    prelude = [ { "name" : "G21" if units_mm else "G20" },
+                { "name" : "G90" },
+                { "name" : "G0", "X" : x, "Y" : y } ]
+    if feed is not None:
+        prelude[-1]["F"] = feed # a G0 with X & Y sets the feed without leaving it pending
+    if not absolute:
+        prelude.append({ "name" : "G91" })
+    if spindle is not None:
+        prelude.append({ "name" : "S", "S" : spindle })
+    for c in prelude:
+        c["prelude"] = True
+    return prelude
+
+
+# Rough timing model of the AMC2500, for estimating what optimisation saves
+MAX_SPEED_MM_S = 1500 / (4000 / 25.4) # AMC2500.set_max_speed, used for all rapids
+ROUND_TRIP_TIME = 0.05 # seconds for a command and the controller's reply at 9600 baud
+WRITE_TIME = 0.01 # seconds for a command without a reply (AMC2500._write)
+HEAD_TIME = 0.3 # seconds for the head to go up or down
+SPINDLE_TIME = 0.3 # seconds for the spindle to change speed
+DRILL_FEED = 1.0 # mm/s the head drills down at, for a drill cycle without F
+DRILL_DWELL = 1.2 # least seconds to dwell for a drill cycle without P, so the hole gets drilled
+
+def drill_dwell(c, units_mm):
+    """ Seconds to dwell with the head down for a drill cycle, P if it's
+    given (G82) or else long enough to drill down to Z at the cycle's F
+    (or DRILL_FEED without one), but never less than DRILL_DWELL
+
+    R doesn't matter, the head always goes all the way up and down.
+    """
+    if "P" in c:
+        return c["P"]
+    scale = 1 if units_mm else MM_PER_INCH
+    feed = c["F"] * scale / 60 if c.get("F", 0) > 0 else DRILL_FEED
+    return max(DRILL_DWELL, -c.get("Z", 0) * scale / feed)
+
+def estimate_program(commands):
+    """ Estimate the cost of running commands on the controller, returns a dict of:
+    - commands is the number of commands
+    - moves is the number of commands moving the head in X/Y
+    - rapid_distance & cut_distance are the distances travelled with the head up & down (mm)
+    - head_changes, feed_changes, spindle_changes are the number of times each setting changes
+    - seconds is the estimated machine time
+    """
+    estimator = ProgramEstimator()
+    for pos,units_mm,absolute,c in annotate_state(commands):
+        estimator.add(pos, units_mm, c)
+    return estimator.result
+
+
+class ProgramEstimator:
+    """ Builds up an estimate_program result one command at a time """
+    def __init__(self):
+        self.result = dict((key, 0) for key in ("commands", "moves", "rapid_distance", "cut_distance",
+                                                "head_changes", "feed_changes", "spindle_changes", "seconds"))
+        self.prev = (0,0)
+        self.head_down = False
+        self.feed = None
+        self.spindle = None
 
+    def add(self, pos, units_mm, c):
+        """ Add command c, which finishes at pos (as given by annotate_state) """
+        result = self.result
+        name = c["name"]
+        scale = 1 if units_mm else MM_PER_INCH
+        seconds = 0
+        result["commands"] += 1
+        if name in ("G0", "G1", "G2", "G3"):
+            if "F" in c and c["F"] != self.feed:
+                self.feed = c["F"]
+                result["feed_changes"] += 1
+                seconds += 3 * WRITE_TIME + ROUND_TRIP_TIME # VS, VM, AT, SS
+            if "Z" in c and (c["Z"] < 0) != self.head_down:
+                self.head_down = c["Z"] < 0
+                result["head_changes"] += 1
+                seconds += ROUND_TRIP_TIME + HEAD_TIME
+            if "X" in c and "Y" in c:
+                result["moves"] += 1
+                distance = math.hypot(pos[0]-self.prev[0], pos[1]-self.prev[1]) * scale
+                seconds += ROUND_TRIP_TIME
+                if name == "G0" or not self.head_down:
+                    result["rapid_distance"] += distance
+                    seconds += distance / MAX_SPEED_MM_S
+                else:
+                    result["cut_distance"] += distance
+                    seconds += distance / (self.feed * scale / 60 if self.feed else MAX_SPEED_MM_S)
+        elif name in ("G81", "G82"):
+            distance = math.hypot(pos[0]-self.prev[0], pos[1]-self.prev[1]) * scale
+            result["moves"] += 1
+            result["rapid_distance"] += distance
+            result["head_changes"] += 2
+            seconds += distance / MAX_SPEED_MM_S + 3 * ROUND_TRIP_TIME + 2 * HEAD_TIME + drill_dwell(c, units_mm)
+        elif name == "S" and c["S"] != self.spindle:
+            self.spindle = c["S"]
+            result["spindle_changes"] += 1
+            seconds += ROUND_TRIP_TIME + SPINDLE_TIME
+        elif name == "S":
+            seconds += ROUND_TRIP_TIME
+        result["seconds"] += seconds
+        self.prev = pos
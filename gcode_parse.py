@@ -11,20 +11,27 @@ import ply.lex as lex
 # Public interface
 
 def parse(content):
-    lexer.lineno = 1
-    lexer.input(content)
+    """ Parse gcode, yielding a dict for each command
 
+    content is either a string, or an iterable of lines (like an open file)
+    which is read one line at a time.
+    """
+    if isinstance(content, basestring):
+        content = [ content ]
+    lexer.lineno = 1
     ctx = ParserCtx()
-    while True:
-        tok = lexer.token()
-        if tok is None:
-            return
-        try:
-            result = PARSER_FUNCTIONS[tok.type](ctx, tok)
-            if result is not None:
-                yield result
-        except KeyError:
-            raise ParserException("Unexpected token in stream: %s" % tok)
+    for chunk in content:
+        lexer.input(chunk)
+        while True:
+            tok = lexer.token()
+            if tok is None:
+                break
+            try:
+                result = PARSER_FUNCTIONS[tok.type](ctx, tok)
+                if result is not None:
+                    yield result
+            except KeyError:
+                raise ParserException("Unexpected token in stream: %s" % tok)
 
 
 def parse_file(filepath):
@@ -57,7 +64,7 @@ def t_SPINDLE_COMMAND(t):
     return t
 
 def t_PARAM(t):
-    r'[XYZFPR]-?([0-9]+\.)?[0-9]+'
+    r'[XYZIJFPR]-?([0-9]+\.)?[0-9]+'
     t.value = (t.value[0],
                float(t.value[1:]))
     return t
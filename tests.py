@@ -1,12 +1,38 @@
-import unittest
-import gcode_optimise
-from gcode_parse import parse_file
+import json, math, os, pty, random, sys, tempfile, time, unittest, StringIO
+import Queue, threading
+import amc2500, engrave_daemon, engrave_gcode, gcode_optimise
+from gcode_parse import parse, parse_file
 
 def test_equal_commands(tc, a, b):
     for ca,cb in zip(a,b):
         tc.assertEqual(ca, cb, "Commands (%s) & (%s) should be equal" % (ca,cb))
     tc.assertEqual(len(a),len(b), "Commands %d %d should have equal lengths" % (len(a),len(b)))
 
+def curve_gcode(absolute, segments=100):
+    """ Gcode for a quarter circle of radius 10mm, made up of many short segments """
+    lines = [ "G21", "G90" if absolute else "G91", "G01 Z-1.0 F20.0" ]
+    last = (10.0, 0.0)
+    for n in range(1, segments+1):
+        a = math.pi / 2 * n / segments
+        p = (10*math.cos(a), 10*math.sin(a))
+        if absolute:
+            lines.append("X%.5f Y%.5f" % p)
+        else:
+            lines.append("X%.5f Y%.5f" % (p[0]-last[0], p[1]-last[1]))
+        last = p
+    return list(parse("\n".join(lines) + "\n"))
+
+class QuietTestCase(unittest.TestCase):
+    """ Keeps what the simulated serial port and the controllers print out of the test output """
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+
 class TestGcodeOptimiser(unittest.TestCase):
 
     def _deviation_commands(self, threshold):
@@ -38,6 +64,73 @@ class TestGcodeOptimiser(unittest.TestCase):
         old_moves, new_moves = self._deviation_commands(0.9)
         self.assertEqual(old_moves, new_moves, "0.9mm threshold should cause no simplification of movements")
 
+    def test_deviation_curve(self):
+        """ A gently curving trace should be reduced to a handful of moves, within tolerance """
+        commands = curve_gcode(True)
+        commands.insert(0, { "name" : "G0", "X" : 10.0, "Y" : 0.0 })
+        optimised = list(gcode_optimise.optimise_deviation(commands, 0.05))
+        moves = [ (c["X"], c["Y"]) for c in optimised if c["name"] == "G1" and "X" in c ]
+        self.assertTrue(len(moves) < 15, "Curve should simplify from 100 moves, got %d" % len(moves))
+        self.assertEqual(moves[-1], (commands[-1]["X"], commands[-1]["Y"]), "End point should be kept")
+        for c in commands[1:]:
+            if "X" in c:
+                dist = min(gcode_optimise.point_segment(a, b, (c["X"], c["Y"]))
+                           for a,b in zip([ (10.0,0.0) ] + moves, moves))
+                self.assertTrue(dist < 0.05, "Point %s deviates %f from simplified path" % (c, dist))
+
+    def test_deviation_relative(self):
+        """ Relative moves should be merged, keeping the same total displacement """
+        commands = curve_gcode(False)
+        optimised = list(gcode_optimise.optimise_deviation(commands, 0.05))
+        old_moves = [ c for c in commands if c["name"] == "G1" and "X" in c ]
+        new_moves = [ c for c in optimised if c["name"] == "G1" and "X" in c ]
+        self.assertTrue(len(new_moves) < 15, "Curve should simplify from 100 moves, got %d" % len(new_moves))
+        for axis in "X", "Y":
+            self.assertAlmostEqual(sum(c[axis] for c in old_moves), sum(c[axis] for c in new_moves))
+
+    def test_arc_fitting(self):
+        """ A quarter circle made of short segments should become a single arc """
+        for absolute in True, False:
+            commands = curve_gcode(absolute)
+            if absolute:
+                commands.insert(0, { "name" : "G0", "X" : 10.0, "Y" : 0.0 })
+            optimised = list(gcode_optimise.optimise_arcs(commands, 0.01))
+            arcs = [ c for c in optimised if c["name"] in ("G2", "G3") ]
+            self.assertEqual(1, len(arcs), "Expected a single arc, got %s" % optimised)
+            self.assertEqual(0, len([ c for c in optimised if c["name"] == "G1" and "X" in c ]))
+            arc = arcs[0]
+            self.assertEqual("G3", arc["name"], "Quarter circle is counter-clockwise")
+            self.assertAlmostEqual(-10, arc["I"], 3)
+            self.assertAlmostEqual(0, arc["J"], 3)
+            self.assertAlmostEqual(0 if absolute else -10, arc["X"], 3)
+            self.assertAlmostEqual(10, arc["Y"], 3)
+
+    def test_arc_fitting_lines(self):
+        """ Straight lines and short chains shouldn't be fitted with arcs """
+        commands = parse_file("testdata/deviate_1mm.ngc")
+        self.assertEqual(commands, list(gcode_optimise.optimise_arcs(commands, 0.5)))
+
+    @unittest.skipIf(gcode_optimise.numpy is None, "numpy not installed")
+    def test_numpy_kernels(self):
+        """ numpy kernels should give the same results as the pure Python ones """
+        setting = gcode_optimise.NUMPY_MIN_POINTS
+        try:
+            for absolute in True, False:
+                commands = curve_gcode(absolute, 500)
+                gcode_optimise.NUMPY_MIN_POINTS = None
+                expected = list(gcode_optimise.optimise_deviation(commands, 0.01))
+                gcode_optimise.NUMPY_MIN_POINTS = 2
+                actual = list(gcode_optimise.optimise_deviation(commands, 0.01))
+                self.assertEqual(len(expected), len(actual))
+                for e,a in zip(expected, actual):
+                    self.assertEqual(sorted(e.keys()), sorted(a.keys()))
+                    for k in e:
+                        if k in ("X", "Y"):
+                            self.assertAlmostEqual(e[k], a[k])
+                        else:
+                            self.assertEqual(e[k], a[k])
+        finally:
+            gcode_optimise.NUMPY_MIN_POINTS = setting
 
     def test_drill_optimisation(self):
         commands = list(parse_file("testdata/drill_cycle.ngc"))
@@ -47,6 +140,679 @@ class TestGcodeOptimiser(unittest.TestCase):
         for c in commands:
             self.assertTrue(c in optimised, "All commands in commands should be in optimised set, including %s" % c)
 
+    def test_kdtree_nearest(self):
+        rand = random.Random(1)
+        points = [ (rand.uniform(0,100), rand.uniform(0,100)) for _ in range(500) ]
+        tree = gcode_optimise.KDTree(points)
+        for n in range(250):
+            tree.remove(n)
+        for _ in range(50):
+            p = (rand.uniform(0,100), rand.uniform(0,100))
+            expected = sorted(range(250, 500), key=lambda i: math.hypot(points[i][0]-p[0], points[i][1]-p[1]))
+            self.assertEqual(expected[:5], tree.nearest_k(p, 5))
+
+    def test_drill_tour_improvement(self):
+        """ Improving the drill order should visit every drill, and not travel further than nearest neighbour """
+        rand = random.Random(2)
+        drills = [ { "name" : "G81", "X" : rand.uniform(0,100), "Y" : rand.uniform(0,100) } for _ in range(300) ]
+        greedy = gcode_optimise.order_drills((0,0), drills, 0)
+        improved = gcode_optimise.order_drills((0,0), drills, 0.5)
+        self.assertEqual(sorted(drills), sorted(improved))
+        length = lambda ds: gcode_optimise.path_length((0,0), [ (d["X"], d["Y"]) for d in ds ])
+        self.assertTrue(length(improved) < length(greedy), "Improved tour %f should be shorter than %f" % (length(improved), length(greedy)))
+
+    def _contours_gcode(self, preamble=False):
+        # pcb2gcode style program: closed squares and open lines, cut in a scattered order,
+        # with pcb2gcode's dwell and cutting feed after each plunge if preamble is set
+        lines = [ "G21", "G90", "G00 Z1.0" ]
+        for n in [ 0, 5, 2, 7, 1, 6, 3, 4 ]:
+            x, y = (n % 4) * 20, (n / 4) * 20
+            if n % 2:
+                path = [ (x, y), (x+10, y), (x+10, y+10), (x, y+10), (x, y) ]
+            else:
+                path = [ (x+10, y+5), (x, y+5) ]
+            lines += [ "G00 X%.1f Y%.1f" % path[0], "G01 Z-0.1 F100" ]
+            if preamble:
+                lines += [ "G04 P0 ( dwell for no time -- G64 should not smooth over this point )", "G01 F200" ]
+            lines += [ "G01 X%.1f Y%.1f" % p for p in path[1:] ]
+            lines += [ "G00 Z1.0 ( retract )" ]
+        lines += [ "G00 X0 Y0", "M2" ]
+        return list(parse("\n".join(lines) + "\n"))
+
+    def _cut_segments(self, commands):
+        """ Return (set of head-down segments, total rapid distance) for a program """
+        segments = set()
+        rapid = 0
+        prev = (0,0)
+        down = False
+        for pos,units_mm,absolute,c in gcode_optimise.annotate_state(commands):
+            if "Z" in c:
+                down = c["Z"] < 0
+            if pos != prev:
+                if down:
+                    segments.add(tuple(sorted([ prev, pos ])))
+                else:
+                    rapid += math.hypot(pos[0]-prev[0], pos[1]-prev[1])
+            prev = pos
+        return segments, rapid
+
+    def test_contour_ordering(self):
+        """ Reordering contours should cut the same segments with less rapid travel """
+        commands = self._contours_gcode()
+        optimised = list(gcode_optimise.optimise_contours(commands))
+        old_segments, old_rapid = self._cut_segments(commands)
+        new_segments, new_rapid = self._cut_segments(optimised)
+        self.assertEqual(old_segments, new_segments)
+        self.assertTrue(new_rapid < old_rapid * 0.75, "Rapid travel %f should be well down on %f" % (new_rapid, old_rapid))
+        self.assertEqual(commands[-2:], optimised[-2:], "Return to origin and program end should stay last")
+        self.assertEqual(len([ c for c in commands if "Z" in c ]), len([ c for c in optimised if "Z" in c ]))
+
+    def test_contour_ordering_pcb2gcode(self):
+        """ pcb2gcode's dwell and cutting feed after each plunge shouldn't stop contours being reordered """
+        commands = self._contours_gcode(True)
+        optimised = list(gcode_optimise.optimise_contours(commands))
+        old_segments, old_rapid = self._cut_segments(commands)
+        new_segments, new_rapid = self._cut_segments(optimised)
+        self.assertEqual(old_segments, new_segments)
+        self.assertTrue(new_rapid < old_rapid * 0.75, "Rapid travel %f should be well down on %f" % (new_rapid, old_rapid))
+        feed = None
+        for c in optimised:
+            feed = c.get("F", feed)
+            if c["name"] == "G1" and "Z" in c:
+                self.assertEqual(100, feed)
+            elif c["name"] == "G1" and "X" in c:
+                self.assertEqual(200, feed)
+        self.assertEqual(8, len([ c for c in optimised if c["name"] == "G4" ]))
+
+    def test_contour_ordering_relative(self):
+        """ Contours in relative mode aren't touched """
+        commands = curve_gcode(False)
+        self.assertEqual(commands, list(gcode_optimise.optimise_contours(commands)))
+
+    def test_head_lifts(self):
+        """ Short hops along toolpaths should keep the head down, others shouldn't """
+        commands = list(parse("""G21
+G90
+G00 Z1.0
+G00 X0 Y0
+G01 Z-0.1 F100
+G01 X10 Y0
+G00 Z1.0
+G00 X9.5 Y0
+G01 Z-0.1 F100
+G01 X9.5 Y10
+G00 Z1.0
+G00 X9.5 Y10.5
+G01 Z-0.1 F100
+G01 X0 Y10.5
+G00 Z1.0
+G00 X0 Y0
+M2
+"""))
+        optimised = list(gcode_optimise.optimise_head_lifts(commands, 1.0, 0.025))
+        old_segments, old_rapid = self._cut_segments(commands)
+        new_segments, new_rapid = self._cut_segments(optimised)
+        self.assertEqual(len(commands) - 2, len(optimised), "First hop (along the first cut) should lose its lift & plunge")
+        self.assertEqual(old_segments | set([ ((9.5, 0.0), (10.0, 0.0)) ]), new_segments)
+        # the second hop is away from any cut, so it stays a rapid
+        self.assertEqual(2, len([ c for c in optimised if c["name"] == "G1" and c.get("Z") == -0.1 ]))
+
+    def test_head_lifts_long_hop(self):
+        """ Hops longer than the maximum should always lift the head """
+        commands = self._contours_gcode()
+        self.assertEqual(commands, list(gcode_optimise.optimise_head_lifts(commands, 0.5, 0.025)))
+        self.assertRaises(ValueError, list, gcode_optimise.optimise_head_lifts(commands, 0.5, 0))
+
+    def _effective_settings(self, commands):
+        """ Return a list of (feed, spindle) settings in effect for each XY move """
+        feed, spindle, result = None, None, []
+        for c in commands:
+            feed = c.get("F", feed)
+            spindle = c.get("S", spindle)
+            if "X" in c:
+                result.append((c["name"], c["X"], c["Y"], feed, spindle))
+        return result
+
+    def test_feed_coalescing(self):
+        """ Redundant and overridden F & S settings should go, without changing the settings for any move """
+        commands = list(parse("""G21
+G90
+S10000
+S20000
+G00 Z1.0
+G00 X0 Y0
+G01 Z-0.1 F100
+G01 X10 Y0 F200
+G01 X10 Y10 F200
+G01 F200
+G01 X0 Y10 F200
+G00 Z1.0
+S20000
+G00 X20 Y0
+G01 Z-0.1 F200
+G01 X30 Y0 F200
+M2
+"""))
+        stats = {}
+        optimised = list(gcode_optimise.optimise_feeds(commands, stats))
+        self.assertEqual(self._effective_settings(commands), self._effective_settings(optimised))
+        self.assertEqual(1, len([ c for c in optimised if c["name"] == "S" ]))
+        self.assertFalse("F" in optimised[5], "Overridden F100 should be removed from the plunge")
+        self.assertEqual(2, stats["spindle_removed"])
+        self.assertEqual(2, stats["feed_removed"])
+        self.assertEqual(6, stats["serial_commands"])
+        self.assertEqual(len(commands) - 3, len(optimised))
+
+    def test_pass_reports(self):
+        """ Each pass should report what it saved, and unknown passes should be rejected """
+        commands = self._contours_gcode()
+        optimised, reports = gcode_optimise.run_passes(commands, [ "contours", "feeds" ])
+        self.assertEqual([ "contours", "feeds" ], [ r["name"] for r in reports ])
+        self.assertTrue(reports[0]["rapid_saved"] > 0)
+        self.assertTrue(reports[0]["seconds_saved"] > 0)
+        self.assertEqual(0, reports[0]["commands_removed"])
+        self.assertEqual(0, reports[1]["stats"]["spindle_removed"])
+        self.assertRaises(ValueError, gcode_optimise.run_passes, commands, [ "contours", "nonsense" ])
+
+    def test_lazy_window(self):
+        """ Lazily streamed passes with a tiny lookahead window should still cut the same paths """
+        commands = self._contours_gcode()
+        window = gcode_optimise.WINDOW
+        gcode_optimise.WINDOW = 5
+        try:
+            optimised, reports = gcode_optimise.run_passes(iter(commands), gcode_optimise.DEFAULT_PASSES,
+                                                           lazy=True)
+            self.assertFalse("time" in reports[0])
+            optimised = list(optimised)
+        finally:
+            gcode_optimise.WINDOW = window
+        self.assertEqual(self._cut_segments(commands)[0], self._cut_segments(optimised)[0])
+        self.assertEqual(len(gcode_optimise.DEFAULT_PASSES), len(reports))
+        self.assertTrue(all("time" in r for r in reports))
+
+    def test_substep_merging(self):
+        """ Runs of moves shorter than a motor step should be merged, ending in the same place """
+        for absolute in True, False:
+            lines = [ "G21", "G90" if absolute else "G91", "G01 Z-0.1 F100" ]
+            lines += [ "X%.4f Y0" % ((n+1) * 0.002 if absolute else 0.002) for n in range(10) ]
+            lines += [ "X%.4f Y1" % (0.02 if absolute else 0) ]
+            commands = list(parse("\n".join(lines) + "\n"))
+            optimised = list(gcode_optimise.optimise_steps(commands))
+            moves = [ c for c in optimised if "X" in c ]
+            self.assertEqual(3, len(moves), "Expected 3 step-sized moves, got %s" % moves)
+            end = list(gcode_optimise.annotate_state(optimised))[-1][0]
+            self.assertAlmostEqual(0.02, end[0])
+            self.assertAlmostEqual(1, end[1])
+
+    def test_parallel_chunks(self):
+        """ Optimising chunks in parallel should give exactly the same commands as a serial run """
+        lines = [ "G21", "G90", "S12000", "G00 Z1.0" ]
+        for n in range(40):
+            lines += [ "G00 X%d Y0" % n, "G01 Z-0.1", "G01 F50", "G01 F%d" % (100 + n % 3 * 50) ]
+            lines += [ "G01 X%.3f Y%.3f" % (n + 0.1 * math.sin(i / 3.0), i * 0.5) for i in range(30) ]
+            lines += [ "G00 Z1.0", "G91" if n % 2 else "G90", "S%d" % (12000 + n % 2 * 1000) ]
+        commands = list(parse("\n".join(lines) + "\n"))
+        chunk_size = gcode_optimise.CHUNK_SIZE
+        gcode_optimise.CHUNK_SIZE = 50
+        try:
+            chunks = list(gcode_optimise.split_chunks(commands, 50))
+            self.assertTrue(len(chunks) > 10)
+            self.assertEqual(commands, sum([ chunk for prelude, chunk in chunks ], []))
+            serial, serial_reports = gcode_optimise.run_passes(commands, gcode_optimise.DEFAULT_PASSES)
+            parallel, parallel_reports = gcode_optimise.run_passes(commands, gcode_optimise.DEFAULT_PASSES,
+                                                                   processes=3)
+        finally:
+            gcode_optimise.CHUNK_SIZE = chunk_size
+        test_equal_commands(self, serial, parallel)
+        for s, p in zip(serial_reports, parallel_reports):
+            self.assertEqual(s["commands_removed"], p["commands_removed"])
+            self.assertEqual(s["stats"], p["stats"])
+
+    def test_panel(self):
+        """ A panel should repeat each copy at its offset, and drill each tool's holes across the whole panel """
+        commands = curve_gcode(False)
+        panel = list(gcode_optimise.panelise(commands, 2, 2, (30.0, 20.0)))
+        positions = [ pos for pos, units_mm, absolute, c in gcode_optimise.annotate_state(panel)
+                      if c["name"] == "G1" and "X" in c ]
+        self.assertEqual(400, len(positions))
+        offsets = [ (0, 0), (30, 0), (30, 20), (0, 20) ]
+        for n, offset in enumerate(offsets):
+            copy = positions[n*100:n*100+100]
+            for (x, y), (x0, y0) in zip(copy, positions[:100]):
+                self.assertAlmostEqual(x0 + offset[0], x)
+                self.assertAlmostEqual(y0 + offset[1], y)
+        commands = list(parse_file("testdata/drill_cycle.ngc"))
+        panel = list(gcode_optimise.panelise(commands, 1, 3, (50.0, 0.0)))
+        names = [ c["name"] for c in panel if c["name"] in ("G81", "M6", "M2") ]
+        self.assertEqual([ "M6" ] + [ "G81" ] * 18 + [ "M6" ] + [ "G81" ] * 9 + [ "M2" ], names)
+        drills = [ (c["X"], c["Y"]) for c in panel if c["name"] == "G81" ][18:]
+        self.assertAlmostEqual(1.065 + 100 / 25.4, drills[-1][0])
+
+
+class TestAMC2500(QuietTestCase):
+
+    def test_step_carry(self):
+        """ Relative moves shorter than a step shouldn't be lost by the controller """
+        controller = amc2500.SimController(debug=False, trace=False)
+        controller.set_units_mm()
+        for _ in range(100):
+            controller.move_by(0.01, 0.003)
+        self.assertEqual((int(round(amc2500.STEPS_PER_MM)), int(round(0.3 * amc2500.STEPS_PER_MM))),
+                         controller.state.pos)
+
+    def test_model_controller(self):
+        """ The controller model should add up moves and changes without any serial port or waiting """
+        controller = amc2500.ModelController()
+        controller.set_units_mm()
+        controller.set_speed(10)
+        controller.set_head_down(True)
+        controller.move_by(10, 0)
+        controller.arc_by(0, 10, 0, 5, False) # half circle, out to x=15
+        controller.set_head_down(False)
+        controller.move_to(0, 0)
+        report = controller.report()
+        self.assertAlmostEqual(10 + 5 * math.pi, report["cut_distance"], 1)
+        self.assertAlmostEqual(math.hypot(10, 10), report["rapid_distance"], 1)
+        self.assertAlmostEqual(report["cut_distance"] / 10, report["cut_seconds"], 1)
+        self.assertEqual(1, report["head_lifts"])
+        self.assertAlmostEqual(15, report["size"][0], 1)
+        self.assertAlmostEqual(10, report["size"][1], 1)
+        self.assertTrue(report["fits"])
+        self.assertTrue(report["serial_bytes"] > 0)
+        self.assertTrue(report["wait_seconds"] >= 0.6)
+
+    def test_plan_acceleration(self):
+        """ Planning AT for each move should be quicker on short segments, without any move missing steps """
+        commands = curve_gcode(False)
+        commands[2]["F"] = 300.0
+        commands += [ { "name" : "G0", "Z" : 1.0, "X" : 5.0, "Y" : 5.0 },
+                      { "name" : "G1", "Z" : -1.0, "X" : 30.0, "Y" : 0.0, "F" : 300.0 } ]
+        args = engrave_gcode.parser.parse_args([])
+        planned_args = engrave_gcode.parser.parse_args([ "--plan-acceleration" ])
+        reports = []
+        for a in args, planned_args:
+            controller = amc2500.ModelController()
+            controller.ramps = True
+            controller.plan_acceleration = a.plan_acceleration
+            for op in engrave_gcode.compile_program(commands, a):
+                if op[0] in ("move", "move_to", "arc") and a is planned_args and controller.state.cur_step_speed != amc2500.MAX_SPEED:
+                    (dx, dy) = (op[1] - controller.state.pos[0], op[2] - controller.state.pos[1]) if op[0] == "move_to" else op[1:3]
+                    self.assertTrue(controller._cur_at >= amc2500.least_at(math.hypot(dx, dy), controller.state.cur_step_speed))
+                if op[0] not in ("done", "message", "tool_change"):
+                    controller.run(op)
+            reports.append(controller.report())
+        self.assertTrue(reports[1]["cut_seconds"] < reports[0]["cut_seconds"] / 2)
+        self.assertTrue(reports[1]["seconds"] < reports[0]["seconds"])
+        self.assertEqual(reports[0]["rapid_seconds"], reports[1]["rapid_seconds"])
+        self.assertEqual(reports[0]["cut_distance"], reports[1]["cut_distance"])
+        self.assertTrue(reports[1]["accel_changes"] <= 4)
+
+    def test_metrics(self):
+        """ Controller metrics should count serial traffic, sleeps and limits, and export as Prometheus text or JSON """
+        controller = amc2500.SimController()
+        controller.debug = controller.trace = False
+        controller.metrics = amc2500.Metrics({ "host" : "test" })
+        controller.set_units_mm()
+        controller.set_head_down(True)
+        controller.move_by(-10, 5) # runs into the X- limit
+        controller.set_head_down(False)
+        counters = controller.metrics.snapshot()["counters"]
+        self.assertEqual(1, counters["head_lifts"][""])
+        self.assertEqual(1, counters["limit_events"]["X-"])
+        self.assertEqual(1, counters["serial_commands"]["DA"])
+        self.assertTrue(counters["serial_bytes_in"][""] > 0)
+        self.assertAlmostEqual(0.6, counters["sleep_seconds"]["dwell"], 2)
+        histogram = controller.metrics.snapshot()["histograms"]["response_seconds"]["DA"]
+        self.assertEqual(1, histogram["count"])
+        text = controller.metrics.prometheus()
+        self.assertTrue('amc2500_limit_events_total{host="test",type="X-"} 1.0' in text)
+        self.assertTrue('amc2500_response_seconds_count{host="test",type="DA"} 1' in text)
+        self.assertTrue('amc2500_response_seconds_bucket{host="test",type="DA",le="+Inf"} 1' in text)
+        path = os.path.join(tempfile.mkdtemp(), "metrics.jsonl")
+        for n in range(2):
+            engrave_gcode.export_metrics(controller.metrics, path, "json")
+        lines = open(path).readlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(counters, json.loads(lines[-1])["counters"])
+
+    def test_find_corner(self):
+        """ Homing should find the corner with both axes at once, and report how repeatable it was """
+        controller = amc2500.SimController()
+        controller.debug = controller.trace = False
+        controller.metrics = amc2500.Metrics()
+        controller.set_units_mm()
+        controller.move_by(150, 120)
+        result = controller.find_corner(-1, -1, True)
+        self.assertEqual(None, result["error"])
+        self.assertEqual((0, 0), (controller.ser.x, controller.ser.y))
+        controller.move_by(50, 70)
+        before = controller.metrics.counters[("serial_commands", "DA")]
+        result = controller.find_corner(-1, -1, approach=500)
+        self.assertEqual((0, 0), result["error"])
+        self.assertEqual((0, 0), controller.state.pos)
+        self.assertTrue(controller.metrics.counters[("serial_commands", "DA")] - before <= 6)
+        self.assertEqual(2, controller.metrics.snapshot()["histograms"]["homing_seconds"][""]["count"])
+        controller.ser.y += 5000 # lost too many steps to find the limits near the old corner
+        self.assertEqual((-5000, 0), controller.find_corner(-1, -1, approach=500)["error"])
+        self.assertEqual((0, 0), (controller.ser.x, controller.ser.y))
+        states = len(controller._states)
+        controller._move_by_steps = lambda dx, dy: None # never gets to the limits
+        self.assertRaises(amc2500.AMCError, controller.find_corner, -1, -1)
+        self.assertEqual(None, controller.corner)
+        self.assertEqual(states, len(controller._states))
+
+    def test_adaptive_speed(self):
+        """ Rapids should only speed up after homing finds no missed steps, back off when it does, and remember where they got to """
+        path = os.path.join(tempfile.mkdtemp(), "speeds.json")
+        controller = amc2500.SimController()
+        controller.debug = controller.trace = False
+        controller.speeds = amc2500.SpeedLearner(path, "sim")
+        def rapids():
+            controller.set_units_mm()
+            controller.set_max_speed()
+            for n in range(amc2500.ADAPT_MOVES):
+                controller.move_by(1 if n % 2 == 0 else -1, 1)
+        controller.find_corner(-1, -1)
+        rapids()
+        self.assertEqual((amc2500.MAX_SPEED, amc2500.RAPID_AT), controller.speeds.setting()) # nothing checked yet
+        controller.find_corner(-1, -1)
+        rapids()
+        faster = (amc2500.MAX_SPEED + amc2500.SPEED_STEP, amc2500.RAPID_AT)
+        self.assertEqual(faster, controller.speeds.setting())
+        self.assertEqual(faster[0], controller.state.cur_step_speed)
+        self.assertFalse(controller.speeds.verified)
+        controller.ser.y -= 20 # the head lost 20 steps in x (hardware axes are swapped)
+        self.assertEqual((20, 0), controller.find_corner(-1, -1)["error"])
+        self.assertEqual((amc2500.MAX_SPEED, amc2500.RAPID_AT), controller.speeds.setting())
+        controller.find_corner(-1, -1)
+        rapids()
+        self.assertEqual(amc2500.MAX_SPEED, controller.state.cur_step_speed)
+        learnt = amc2500.SpeedLearner(path, "sim")
+        self.assertEqual((amc2500.MAX_SPEED, amc2500.RAPID_AT), learnt.setting())
+        self.assertTrue(learnt.settled)
+        self.assertEqual((amc2500.MAX_SPEED, amc2500.RAPID_AT), amc2500.SpeedLearner(path, "other").setting())
+
+
+class TestEngraveGcode(QuietTestCase):
+
+    def test_key_monitor(self):
+        """ Keys typed during a job should be picked up in the background, last key first """
+        master, slave = pty.openpty()
+        monitor = engrave_gcode.KeyMonitor(os.fdopen(slave, "r"))
+        monitor.start()
+        try:
+            self.assertEqual(None, monitor.pressed())
+            os.write(master, "pq")
+            deadline = time.time() + 5
+            while monitor.key != "q" and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual("q", monitor.pressed())
+            self.assertEqual(None, monitor.pressed())
+        finally:
+            monitor.stop()
+            os.close(master)
+
+    def test_jog_engine(self):
+        """ Nudges typed while moving should go as one move, and holding a capital should jog until it's let go """
+        controller = amc2500.SimController()
+        controller.debug = controller.trace = False
+        controller.metrics = amc2500.Metrics()
+        controller.set_units_steps()
+        keys = Queue.Queue()
+        for key in "lllj":
+            keys.put((key, time.time()))
+        engine = engrave_gcode.JogEngine(controller, keys)
+        engine.start()
+        try:
+            deadline = time.time() + 5
+            while controller.state.pos == (0, 0) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual((3 * engine.nudge, engine.nudge), controller.state.pos)
+            self.assertEqual(1, controller.metrics.counters[("serial_commands", "DA")])
+            start = time.time()
+            while time.time() - start < engrave_gcode.JOG_RAMP_SECONDS + 0.2: # held long enough to speed up
+                keys.put(("L", time.time()))
+                time.sleep(0.03)
+            released = time.time()
+            while controller.jogging and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(controller.jogging)
+            self.assertTrue(time.time() - released < engrave_gcode.JOG_RELEASE + 0.1)
+            self.assertTrue(controller.state.pos[0] > 3 * engine.nudge + engrave_gcode.JOG_SPEEDS[0] * engrave_gcode.JOG_RAMP_SECONDS)
+            self.assertEqual(engine.nudge, controller.state.pos[1])
+            self.assertEqual(2, controller.metrics.counters[("serial_commands", "VJ")])
+            self.assertEqual(2, controller.metrics.counters[("serial_commands", "JAY")]) # started & stopped
+            self.assertFalse(("serial_commands", "JAX") in controller.metrics.counters)
+            keys.put(("!", time.time()))
+            engine.wait()
+        finally:
+            engine.stop()
+        def broken(dx, dy):
+            raise OSError("serial port went away")
+        controller.move_by = broken
+        keys.put(("l", time.time()))
+        engine = engrave_gcode.JogEngine(controller, keys)
+        engine.start()
+        try:
+            self.assertRaises(OSError, engine.wait) # not as if ! was typed
+        finally:
+            engine.stop()
+
+    def test_journal(self):
+        """ The journal should give back the last whole record, even after rotating or a cut short write """
+        path = os.path.join(tempfile.mkdtemp(), "job.journal")
+        controller = amc2500.ModelController()
+        rotate = engrave_gcode.JOURNAL_ROTATE
+        engrave_gcode.JOURNAL_ROTATE = 7
+        try:
+            journal = engrave_gcode.Journal(path, (120, 340))
+            for n in range(1, 20):
+                controller.move_by(10, 0)
+                journal.record(n, "G1", n, controller)
+            journal.close(False)
+        finally:
+            engrave_gcode.JOURNAL_ROTATE = rotate
+        self.assertTrue(len(open(path).readlines()) < 10)
+        with open(path, "a") as f:
+            f.write('{"index":20,"pos"')
+        zero, record = engrave_gcode.Journal.load(path)
+        self.assertEqual([ 120, 340 ], zero)
+        self.assertEqual(19, record["index"])
+        self.assertEqual([ "G1", 19 ], record["command"])
+        self.assertEqual(list(controller.state.pos), record["pos"])
+        for options in [ "--journal", path ], [ "--journal", path, "--resume" ]:
+            args = engrave_gcode.parser.parse_args(options + [ "--drill-time", "1.0" ])
+            self.assertEqual(0, engrave_gcode._optimise_settings(args)["drill_time"])
+
+    def test_compile_program(self):
+        """ Compiled programs should be all whole steps, and end up where the gcode says """
+        args = engrave_gcode.parser.parse_args([])
+        commands = curve_gcode(False) + [ { "name" : "G0", "Z" : 1.0, "X" : 10.0, "Y" : -10.0, "line" : 999 } ]
+        program = list(engrave_gcode.compile_program(commands, args))
+        self.assertEqual(len(commands), len([ op for op in program if op[0] == "done" ]))
+        moves = [ op for op in program if op[0] in ("move", "move_to", "arc") ]
+        self.assertEqual(101, len(moves))
+        for op in moves:
+            self.assertTrue(all(isinstance(v, int) for v in op[1:5]), "Expected whole steps in %s" % (op,))
+        controller = amc2500.ModelController()
+        for op in program:
+            if op[0] not in ("done", "message", "tool_change"):
+                controller.run(op)
+        self.assertEqual((0, 0), controller.state.pos)
+        self.assertEqual(1, controller.report()["head_lifts"])
+
+    def test_compile_absolute(self):
+        """ Absolute moves should go to where the gcode says from wherever the head really got to """
+        args = engrave_gcode.parser.parse_args([])
+        commands = list(parse("G21\nG90\nG0 X10 Y5\nG1 Z-1 F600\nX20 Y5\nG91\nX1 Y1\nG90\nX30 Y0\n"))
+        program = [ op for op in engrave_gcode.compile_program(commands, args) if op[0] not in ("done", "message") ]
+        self.assertEqual([ ("move_to", 1575, 787), ("move_to", 3150, 787), ("move", 157, 158), ("move_to", 4724, 0) ],
+                         [ op for op in program if op[0] in ("move", "move_to") ])
+        controller = amc2500.ModelController()
+        for op in program:
+            controller.run(op)
+            if op[0] == "move_to" and op[1] == 1575:
+                controller.state.pos = (1500, 787) # as if it stopped short at a limit
+        self.assertEqual((4724, 0), controller.state.pos)
+
+    def test_read_ahead(self):
+        """ Lazy programs should be produced ahead on another thread, in order, passing on any error """
+        produced = []
+        def program():
+            for n in range(10):
+                produced.append(n)
+                yield n
+            raise ValueError("Bad gcode")
+        ops = engrave_gcode.read_ahead(program(), 4)
+        deadline = time.time() + 5
+        while len(produced) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(5, len(produced)) # 4 ready and one waiting for room
+        self.assertEqual(range(10), [ ops.next() for n in range(10) ])
+        self.assertRaises(ValueError, ops.next)
+
+    def test_profile(self):
+        """ Profiling should attribute time to the source line of each command """
+        profile = engrave_gcode.Profile()
+        profile.message(engrave_gcode.FILE_MESSAGE % "/tmp/top.ngc")
+        profile.last -= 2
+        profile.done("G1", 12)
+        profile.last -= 1
+        profile.done("G1", 13)
+        profile.last -= 5
+        profile.skip() # paused, doesn't count
+        profile.done("G0", 14)
+        self.assertAlmostEqual(2, profile.lines[("/tmp/top.ngc", 12, "G1")][0], 1)
+        self.assertAlmostEqual(3, profile.kinds["G1"][0], 1)
+        self.assertEqual(2, profile.kinds["G1"][1])
+        self.assertTrue(profile.kinds["G0"][0] < 1)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            profile.report(1)
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue("top.ngc:12" in report)
+        self.assertFalse("top.ngc:13" in report)
+
+    def test_compile_drills(self):
+        """ A run of drill cycles should be fused ops at rapid speed, dwelling for P or to depth Z """
+        args = engrave_gcode.parser.parse_args([])
+        commands = list(parse("G21\nG90\nG82 X1 Y1 Z-1 R1 P0.5\nG81 X2 Y1 Z-2 R1\nX3 Y1 Z0\nX4 Y1 Z-3 F60\nG0 X0 Y0\n"))
+        program = list(engrave_gcode.compile_program(commands, args))
+        ops = [ op for op in program if op[0] not in ("done", "message") ]
+        drills = [ op for op in ops if op[0] == "drill" ]
+        self.assertEqual([ ("drill", 0.5), ("drill", 2.0 / gcode_optimise.DRILL_FEED),
+                           ("drill", gcode_optimise.DRILL_DWELL), ("drill", 3.0) ], drills)
+        speeds = [ n for n, op in enumerate(ops) if op[0] == "speed" ]
+        self.assertTrue(all(n < ops.index(drills[0]) or n > ops.index(drills[-1]) for n in speeds))
+        self.assertFalse(any(op[0] == "head" and op[1] for op in ops))
+        # 0.08mm deep at F0.11811 inches/minute (3mm/minute) is 1.6s a hole
+        commands = list(parse_file("testdata/drill_cycle.ngc"))
+        drills = [ op for op in engrave_gcode.compile_program(commands, args) if op[0] == "drill" ]
+        self.assertEqual(9, len(drills))
+        for op in drills:
+            self.assertAlmostEqual(1.6, op[1], 2)
+
+    def test_tool_change_corner(self):
+        """ Tool changes should go straight to the corner, remember where it is, and come back """
+        controller = amc2500.SimController()
+        controller.debug = controller.trace = False
+        controller.metrics = amc2500.Metrics()
+        controller.set_units_mm()
+        controller.move_by(100, 80)
+        controller.zero_here()
+        controller.move_by(20, 30)
+        start = controller.state.pos
+        for n in range(2):
+            before = controller.metrics.counters[("serial_commands", "DA")]
+            engrave_gcode.tool_change(controller, None, jog=lambda: self.assertEqual((0, 0), (controller.ser.x, controller.ser.y)))
+            self.assertTrue(controller.metrics.counters[("serial_commands", "DA")] - before <= 4)
+            self.assertEqual(start, controller.state.pos)
+            self.assertEqual((round(-100 * amc2500.STEPS_PER_MM), round(-80 * amc2500.STEPS_PER_MM)), controller.corner)
+        controller.ser.y += 5000 # too far out to find the limits near the old corner
+        controller.move_to_corner()
+        self.assertEqual((0, 0), (controller.ser.x, controller.ser.y))
+        self.assertEqual((round(-100 * amc2500.STEPS_PER_MM) - 5000, round(-80 * amc2500.STEPS_PER_MM)), controller.corner)
+
+
+class TestEngraveDaemon(QuietTestCase):
+
+    def test_daemon_queue(self):
+        """ Jobs submitted to the daemon should run in order, and held jobs should wait to be started """
+        path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+        queue = engrave_daemon.JobQueue(amc2500.ModelController())
+        queue.start_threads()
+        server = engrave_daemon.DaemonServer(path, queue)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            gcode = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "deviate_1mm.ngc")
+            first = engrave_daemon.request(path, { "command" : "submit", "options" : [ gcode ] })["id"]
+            held = engrave_daemon.request(path, { "command" : "submit", "options" : [ gcode ], "hold" : True })["id"]
+            bad = engrave_daemon.request(path, { "command" : "submit", "options" : [ "--resume", gcode ] })["id"]
+            deadline = time.time() + 10
+            def wait_for(id, state):
+                while time.time() < deadline:
+                    jobs = dict((job["id"], job) for job in engrave_daemon.request(path, { "command" : "status" })["jobs"])
+                    if jobs[id]["state"] == state:
+                        return jobs
+                    time.sleep(0.01)
+                self.fail("Job %d never got to %s" % (id, state))
+            wait_for(first, "tool_change") # the test file has an M6
+            engrave_daemon.request(path, { "command" : "continue", "id" : first })
+            jobs = wait_for(held, "ready")
+            self.assertEqual("done", jobs[first]["state"])
+            self.assertEqual(jobs[first]["total"], jobs[first]["done"])
+            jobs = wait_for(bad, "failed") # prepared while the held job waits
+            self.assertTrue("--resume" in jobs[bad]["error"])
+            engrave_daemon.request(path, { "command" : "start", "id" : held })
+            wait_for(held, "tool_change")
+            engrave_daemon.request(path, { "command" : "continue", "id" : held })
+            wait_for(held, "done")
+            self.assertTrue("error" in engrave_daemon.request(path, { "command" : "cancel", "id" : first }))
+        finally:
+            server.shutdown()
+            server.server_close()
+            queue.stop_threads()
+
+    def test_daemon_errors(self):
+        """ Jobs going wrong in unexpected ways should fail, without stalling the queue """
+        path = os.path.join(tempfile.mkdtemp(), "job.ngc")
+        with open(path, "w") as f:
+            f.write("G21\nG90\nG0 X1 Y1\nM2\n")
+        queue = engrave_daemon.JobQueue(amc2500.ModelController())
+        prepare = queue.prepare
+        def broken_prepare(job):
+            if job.id == 1:
+                raise KeyError("X")
+            prepare(job)
+        queue.prepare = broken_prepare
+        queue.start_threads()
+        try:
+            deadline = time.time() + 10
+            def wait_for(job, state):
+                while job.state != state and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(state, job.state)
+            broken, good = queue.submit([ path ]), queue.submit([ path ])
+            wait_for(good, "done")
+            self.assertEqual("failed", broken.state)
+            self.assertTrue("KeyError" in broken.error)
+            def broken_run(op):
+                raise OSError(5, "Input/output error")
+            queue.controller.run = broken_run
+            queue.controller.corner = (-100, -100)
+            job = queue.submit([ path ])
+            wait_for(job, "failed")
+            self.assertTrue("OSError" in job.error)
+            self.assertTrue(queue.paused)
+            self.assertEqual(None, queue.controller.corner)
+        finally:
+            queue.stop_threads()
 
 if __name__ == '__main__':
     unittest.main()